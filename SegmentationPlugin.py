@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-
-from qgis.PyQt.QtCore import QSettings, QTranslator, QCoreApplication
+from qgis.PyQt.QtCore import QSettings, QTranslator, QCoreApplication, QUrl, QTimer
 from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtWidgets import QAction, QMessageBox
-from qgis.core import QgsProject, QgsRasterLayer, QgsPalettedRasterRenderer
-from qgis.PyQt.QtGui import QColor
+from qgis.core import QgsApplication, QgsProject, QgsRasterLayer, QgsVectorLayer
 
 from .resources import *
 from .SegmentationPlugin_dialog import SegmentationPluginDialog
 from .utils.worker import SegmentationWorker
 from .utils.image_utils import ImageProcessor
+from .utils.job_builder import (
+    prepare_input, build_params, default_model_path, resolve_target_gsd, prepare_aoi, aoi_extent
+)
+from .utils.inference_process import close_shared_processes
+from .utils.live_layer import LiveSegmentationLayer
+from .processing_provider.provider import SegmentationProvider
+from .config import OUTPUT_PREVIEW_INTERVAL
 
 import os
 import json
@@ -38,6 +44,16 @@ class SegmentationPlugin:
         self.menu = self.tr(u'&Segmentation Plugin')
         self.first_start = None
         self.worker = None
+        self.exporter = None
+        self.pending_export = None
+        self.live_layer = None
+        # Слой результата, заполняемый во время задания
+        self.preview_layer_id = None
+        self.preview_path = None
+        self.preview_timer = QTimer()
+        self.preview_timer.setInterval(int(OUTPUT_PREVIEW_INTERVAL * 1000))
+        self.preview_timer.timeout.connect(self.repaint_preview_layer)
+        self.provider = None
 
     def tr(self, message):
         return QCoreApplication.translate('SegmentationPlugin', message)
@@ -77,8 +93,15 @@ class SegmentationPlugin:
 
         return action
 
+    def initProcessing(self):
+        """Регистрация провайдера Processing"""
+        self.provider = SegmentationProvider(self.plugin_dir)
+        QgsApplication.processingRegistry().addProvider(self.provider)
+
     def initGui(self):
         """Create the menu entries and toolbar icons inside the QGIS GUI."""
+        self.initProcessing()
+
         icon_path = ':/plugins/SegmentationPlugin/icon.png'
         self.add_action(
             icon_path,
@@ -96,16 +119,36 @@ class SegmentationPlugin:
                 action)
             self.iface.removeToolBarIcon(action)
 
+        if self.provider is not None:
+            QgsApplication.processingRegistry().removeProvider(self.provider)
+            self.provider = None
+
+        self.stop_live_layer()
+        self.remove_preview_layer()
+        
+        # Останавливаем процесс инференса с загруженной моделью
+        close_shared_processes()
+
     def run(self):
         """Run method that performs all the real work"""
         if self.first_start == True:
             self.first_start = False
             self.dlg = SegmentationPluginDialog()
+            self.dlg.pushButton_stop.clicked.connect(self.cancel_processing)
+
+        # Во время обработки диалог показывает ход выполнения
+        if self.worker is not None:
+            self.dlg.show()
+            self.dlg.raise_()
+            return
 
         self.dlg.show()
         result = self.dlg.exec_()
         
-        if result:
+        if result == SegmentationPluginDialog.LIVE_RESULT:
+            self.dlg.save_settings()
+            self.start_live_layer()
+        elif result:
             try:
                 # Сохранение настроек
                 self.dlg.save_settings()
@@ -119,17 +162,31 @@ class SegmentationPlugin:
                 # Подготовка параметров
                 params = self.prepare_parameters()
                 if params is None:
+                    if self.exporter is not None:
+                        self.exporter.cleanup()
+                        self.exporter = None
+                    if self.pending_export is not None:
+                        self.pending_export.cleanup()
+                        self.pending_export = None
                     return  # Ошибка уже показана в prepare_parameters
                 
                 # Запуск обработки в отдельном потоке
-                self.worker = SegmentationWorker(params, self.plugin_dir)
+                self.worker = SegmentationWorker(params, self.plugin_dir, self.pending_export)
+                self.pending_export = None
                 self.worker.progress.connect(self.update_progress)
+                self.worker.telemetry.connect(self.update_telemetry)
+                self.worker.preview_ready.connect(self.add_preview_layer)
                 self.worker.result_ready.connect(self.add_result_layer)
                 self.worker.error.connect(self.handle_error)
+                self.worker.cancelled.connect(self.handle_cancelled)
                 self.worker.finished.connect(self.processing_finished)
                 
                 self.worker.start()
                 
+                # Показываем ход обработки в немодальном диалоге
+                self.dlg.set_running(True)
+                self.dlg.show()
+                
             except Exception as e:
                 QMessageBox.critical(
                     self.dlg,
@@ -143,74 +200,47 @@ class SegmentationPlugin:
             layer = self.dlg.mMapLayerComboBox.currentLayer()
             use_extent = self.dlg.checkBox_use_extent.isChecked()
             
-            # Создаем процессор изображений
-            from .config import SEGMENTATION_COLORS
-            image_processor = ImageProcessor(SEGMENTATION_COLORS)
-            
-            # Сохраняем слой во временный файл
-            temp_input = tempfile.NamedTemporaryFile(suffix='.tif', delete=False)
-            temp_input.close()
-            
-            # Экспортируем слой
-            success = False
             if use_extent:
                 extent = self.iface.mapCanvas().extent()
-                # Пробуем сначала альтернативный метод через GDAL
-                if hasattr(image_processor, 'export_qgis_layer_simple'):
-                    success = image_processor.export_qgis_layer_simple(layer, temp_input.name, extent)
-                
-                # Если не получилось, используем основной метод
-                if not success:
-                    success = image_processor.export_qgis_layer(layer, temp_input.name, extent)
             else:
-                extent = layer.extent()
-                # Пробуем сначала альтернативный метод через GDAL
-                if hasattr(image_processor, 'export_qgis_layer_simple'):
-                    success = image_processor.export_qgis_layer_simple(layer, temp_input.name)
-                
-                # Если не получилось, используем основной метод
-                if not success:
-                    success = image_processor.export_qgis_layer(layer, temp_input.name)
+                extent = None
             
-            if not success or not os.path.exists(temp_input.name):
-                # Удаляем временный файл если он создан
-                try:
-                    os.unlink(temp_input.name)
-                except:
-                    pass
-                
-                QMessageBox.critical(
-                    self.dlg, 
-                    "Ошибка", 
-                    "Не удалось экспортировать растровый слой. Убедитесь, что слой корректный и доступен для чтения."
-                )
-                return None
+            target_gsd = resolve_target_gsd(self.dlg.target_gsd())
             
-            # Определение пути к модели
-            model_path = None
-            if self.dlg.comboBox_model.currentText() == "Загрузить свою модель...":
-                model_path = self.dlg.fileWidget_model.filePath()
-                if not model_path or not os.path.exists(model_path):
-                    QMessageBox.critical(
-                        self.dlg,
-                        "Ошибка",
-                        "Выберите файл модели"
-                    )
+            # Область интереса ограничивает экстент охватом полигонов
+            aoi = None
+            aoi_layer = self.dlg.mMapLayerComboBox_aoi.currentLayer()
+            if aoi_layer is not None:
+                if self.dlg.checkBox_aoi_selected.isChecked():
+                    features = aoi_layer.selectedFeatures()
+                else:
+                    features = aoi_layer.getFeatures()
+                aoi, bounds = prepare_aoi(features, aoi_layer.crs(), layer.crs())
+                if aoi is None:
+                    QMessageBox.critical(self.dlg, "Ошибка", "В области интереса нет полигонов")
+                    return None
+                try:
+                    extent = aoi_extent(extent, layer, bounds)
+                except ValueError as e:
+                    QMessageBox.critical(self.dlg, "Ошибка", str(e))
                     return None
-            elif self.dlg.comboBox_model.currentIndex() > 1:
-                model_name = self.dlg.comboBox_model.currentText()
-                model_path = os.path.join(self.plugin_dir, 'models', model_name)
-            else:
-                # Используем модель по умолчанию
-                model_path = os.path.join(self.plugin_dir, 'models', 'best_model.h5')
             
-            # Проверяем существование модели
-            if model_path and not os.path.exists(model_path):
-                QMessageBox.critical(
-                    self.dlg,
-                    "Ошибка",
-                    f"Файл модели не найден: {model_path}"
+            # Файловые растры читаются напрямую, WMS/XYZ загружаются потоково,
+            # остальные слои экспортируются во временный файл
+            try:
+                prepared = prepare_input(
+                    layer, extent, self.iface.mapCanvas().mapUnitsPerPixel(), defer_export=True,
+                    target_gsd=target_gsd
                 )
+            except Exception as e:
+                QMessageBox.critical(self.dlg, "Ошибка", str(e))
+                return None
+            self.exporter = prepared['exporter']
+            self.pending_export = prepared['export']
+            extent = prepared['extent']
+            
+            model_path = self.selected_model_path()
+            if model_path is None:
                 return None
             
             # Создание временного файла для результата
@@ -218,24 +248,23 @@ class SegmentationPlugin:
             temp_output.close()
             
             # Создаем словарь с JSON-сериализуемыми параметрами
-            params = {
-                'input_path': temp_input.name,
-                'output_path': temp_output.name,
-                'use_api': self.dlg.radioButton_api.isChecked(),
-                'api_url': self.dlg.lineEdit_api_url.text(),
-                'model_path': model_path,
-                'patch_size': self.dlg.spinBox_patch_size.value(),
-                'subdivisions': self.dlg.spinBox_subdivisions.value(),
-                'crs': layer.crs().toWkt(),
-                # Передаем геоданные для использования в subprocess
-                'georeference_data': {
-                    'extent_xmin': extent.xMinimum(),
-                    'extent_xmax': extent.xMaximum(),
-                    'extent_ymin': extent.yMinimum(),
-                    'extent_ymax': extent.yMaximum(),
-                    'crs': layer.crs().toWkt()
-                }
-            }
+            params = build_params(
+                layer,
+                prepared,
+                temp_output.name,
+                model_path,
+                self.dlg.spinBox_patch_size.value(),
+                self.dlg.spinBox_subdivisions.value(),
+                use_api=self.dlg.radioButton_api.isChecked(),
+                api_url=self.dlg.lineEdit_api_url.text(),
+                use_hybrid=self.dlg.radioButton_hybrid.isChecked(),
+                target_gsd=target_gsd,
+                aoi=aoi,
+                output_confidence=self.dlg.checkBox_confidence.isChecked(),
+                output_probabilities=self.dlg.checkBox_probabilities.isChecked(),
+                output_vector=self.dlg.checkBox_vector.isChecked(),
+                output_preview=True
+            )
             
             # Сохраняем ссылки для использования после инференса
             self.reference_layer = layer
@@ -251,10 +280,154 @@ class SegmentationPlugin:
             )
             return None
     
+    def selected_model_path(self):
+        """Путь к выбранной в диалоге модели, None с сообщением об ошибке"""
+        if self.dlg.comboBox_model.currentText() == "Загрузить свою модель...":
+            model_path = self.dlg.fileWidget_model.filePath()
+            if not model_path or not os.path.exists(model_path):
+                QMessageBox.critical(
+                    self.dlg,
+                    "Ошибка",
+                    "Выберите файл модели"
+                )
+                return None
+        elif self.dlg.comboBox_model.currentIndex() > 1:
+            model_name = self.dlg.comboBox_model.currentText()
+            model_path = os.path.join(self.plugin_dir, 'models', model_name)
+        else:
+            # Используем модель по умолчанию
+            model_path = default_model_path(self.plugin_dir)
+        
+        # Проверяем существование модели
+        if not os.path.exists(model_path):
+            QMessageBox.critical(
+                self.dlg,
+                "Ошибка",
+                f"Файл модели не найден: {model_path}"
+            )
+            return None
+        return model_path
+    
+    def start_live_layer(self):
+        """Живой слой для выбранного растра вместо запуска задания"""
+        layer = self.dlg.mMapLayerComboBox.currentLayer()
+        if not layer:
+            QMessageBox.warning(self.dlg, "Предупреждение", "Выберите растровый слой")
+            return
+        
+        model_path = self.selected_model_path()
+        if model_path is None:
+            return
+        
+        job_options = {
+            'model_path': model_path,
+            'patch_size': self.dlg.spinBox_patch_size.value(),
+            'subdivisions': self.dlg.spinBox_subdivisions.value(),
+            'use_api': self.dlg.radioButton_api.isChecked(),
+            'api_url': self.dlg.lineEdit_api_url.text(),
+            'use_hybrid': self.dlg.radioButton_hybrid.isChecked(),
+        }
+        
+        self.stop_live_layer()
+        try:
+            self.live_layer = LiveSegmentationLayer(self.iface.mapCanvas(), layer, self.plugin_dir, job_options)
+        except ValueError as e:
+            QMessageBox.critical(self.dlg, "Ошибка", str(e))
+            return
+        self.live_layer.error.connect(self.handle_live_error)
+        self.live_layer.stopped.connect(self.live_layer_stopped)
+        self.live_layer.start()
+        self.iface.messageBar().pushInfo(
+            "Segmentation Plugin",
+            "Живой слой запущен: сегментируются видимые тайлы. Удалите слой, чтобы остановить"
+        )
+    
+    def stop_live_layer(self):
+        """Останавливает живой слой, если он запущен"""
+        if self.live_layer is not None:
+            self.live_layer.stop()
+            self.live_layer = None
+    
+    def live_layer_stopped(self):
+        self.live_layer = None
+    
+    def handle_live_error(self, error_message):
+        """Ошибка тайла живого слоя - слой останавливается"""
+        self.iface.messageBar().pushCritical(
+            "Segmentation Plugin",
+            f"Живой слой остановлен: {error_message}"
+        )
+    
     def update_progress(self, value):
         """Обновление прогресс-бара"""
         self.dlg.progressBar.setValue(value)
     
+    def update_telemetry(self, message):
+        """Отображение скорости обработки и оставшегося времени"""
+        if message.get('type') == 'stage':
+            stage_names = {
+                'export': "Экспорт слоя",
+                'load_model': "Загрузка модели",
+                'read_input': "Чтение изображения",
+                'inference': "Инференс",
+                'save': "Сохранение результата",
+            }
+            if message.get('status') == 'started':
+                self.dlg.label_status.setText(stage_names.get(message['name'], message['name']) + "...")
+            return
+        
+        text = f"Тайлы: {message['tiles_done']}/{message['tiles_total']}"
+        text += f" • {message['tiles_per_sec']:.2f} тайл/с"
+        eta = message.get('eta_sec')
+        if eta is not None:
+            minutes, seconds = divmod(int(eta), 60)
+            text += f" • осталось ~{minutes:02d}:{seconds:02d}"
+        self.dlg.label_status.setText(text)
+    
+    def add_preview_layer(self, path):
+        """Слой результата, который заполняется по ходу задания
+        
+        Файл создается в начале инференса, незаписанная часть - nodata.
+        Слой перечитывается по таймеру и заменяется итоговым по завершении.
+        """
+        self.remove_preview_layer()
+        self.preview_path = path
+        layer = QgsRasterLayer(path, "Segmentation Result (обработка)")
+        if not layer.isValid():
+            return
+        ImageProcessor.apply_class_palette(layer)
+        QgsProject.instance().addMapLayer(layer)
+        self.preview_layer_id = layer.id()
+        self.preview_timer.start()
+    
+    def repaint_preview_layer(self):
+        """Перечитывает заполняемый файл результата"""
+        layer = QgsProject.instance().mapLayer(self.preview_layer_id) if self.preview_layer_id else None
+        if layer is None:
+            # Слой удален пользователем
+            self.preview_timer.stop()
+            return
+        layer.reload()
+        layer.setExtent(layer.dataProvider().extent())
+        layer.triggerRepaint()
+    
+    def remove_preview_layer(self, output_path=None):
+        """Убирает слой предпросмотра и оставшийся промежуточный файл"""
+        self.preview_timer.stop()
+        if self.preview_layer_id is not None:
+            if QgsProject.instance().mapLayer(self.preview_layer_id) is not None:
+                QgsProject.instance().removeMapLayer(self.preview_layer_id)
+            self.preview_layer_id = None
+        
+        # Открытый в QGIS файл процесс инференса мог не удалить (Windows)
+        path = self.preview_path
+        self.preview_path = None
+        if path and path != output_path and path.endswith('.part.tif') and os.path.exists(path):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+    
     def add_result_layer(self, metadata_path):
         """Добавление результата как нового слоя"""
         try:
@@ -265,6 +438,8 @@ class SegmentationPlugin:
             # Путь к результату
             output_path = metadata['output_path']
             
+            self.remove_preview_layer(output_path)
+            
             if not os.path.exists(output_path):
                 raise Exception(f"Файл результата не найден: {output_path}")
             
@@ -276,37 +451,34 @@ class SegmentationPlugin:
                 QgsProject.instance().addMapLayer(result_layer)
                 
                 # Применяем палитровый рендерер для одноканального изображения
-                if result_layer.bandCount() == 1:
-                    # Создаем палитру классов
-                    classes = []
-                    colors = metadata.get('classes', [])
-                    
-                    # Если нет цветов в метаданных, используем из конфига
-                    if not colors:
-                        from .config import SEGMENTATION_COLORS, CLASS_NAMES
-                        colors = SEGMENTATION_COLORS
-                    else:
-                        from .config import CLASS_NAMES
-                    
-                    for i, color in enumerate(colors):
-                        class_name = CLASS_NAMES[i] if i < len(CLASS_NAMES) else f"Class {i}"
-                        paletteClass = QgsPalettedRasterRenderer.Class(
-                            i,
-                            QColor(color[0], color[1], color[2]),
-                            class_name
-                        )
-                        classes.append(paletteClass)
-                    
-                    # Применяем рендерер
-                    renderer = QgsPalettedRasterRenderer(
-                        result_layer.dataProvider(),
-                        1,
-                        classes
-                    )
-                    result_layer.setRenderer(renderer)
+                ImageProcessor.apply_class_palette(result_layer, metadata.get('classes'))
                 
                 result_layer.triggerRepaint()
                 
+                # Уверенность модели для контроля качества
+                confidence_path = metadata.get('confidence_path')
+                if confidence_path and os.path.exists(confidence_path):
+                    confidence_layer = QgsRasterLayer(confidence_path, "Segmentation Confidence")
+                    if confidence_layer.isValid():
+                        QgsProject.instance().addMapLayer(confidence_layer)
+                
+                # Полигоны классов, векторизованные при записи маски
+                vector_path = metadata.get('vector_path')
+                if vector_path and os.path.exists(vector_path):
+                    vector_layer = QgsVectorLayer(vector_path + '|layername=segments',
+                                                  "Segmentation Polygons", 'ogr')
+                    if vector_layer.isValid():
+                        ImageProcessor.apply_class_categories(vector_layer, metadata.get('classes'))
+                        QgsProject.instance().addMapLayer(vector_layer)
+                
+                # Площади классов, посчитанные при записи, - таблица в проекте
+                stats_path = metadata.get('class_stats_csv')
+                if stats_path and os.path.exists(stats_path):
+                    uri = QUrl.fromLocalFile(stats_path).toString() + '?type=csv&detectTypes=yes&geomType=none'
+                    stats_layer = QgsVectorLayer(uri, "Площади классов", 'delimitedtext')
+                    if stats_layer.isValid():
+                        QgsProject.instance().addMapLayer(stats_layer)
+                
                 self.iface.messageBar().pushSuccess(
                     "Segmentation Plugin",
                     "Сегментация выполнена успешно!"
@@ -332,12 +504,46 @@ class SegmentationPlugin:
             "Ошибка сегментации",
             f"Произошла ошибка: {error_message}"
         )
-        self.dlg.progressBar.setValue(0)
+        self.processing_finished()
+    
+    def cancel_processing(self):
+        """Запрос остановки текущей обработки"""
+        if self.worker is None:
+            return
+        
+        self.dlg.pushButton_stop.setEnabled(False)
+        self.dlg.label_status.setText("Остановка после текущего батча...")
+        if self.exporter is not None:
+            self.exporter.cancel()
+        self.worker.cancel()
+    
+    def handle_cancelled(self, report):
+        """Обработка остановленного запуска"""
+        input_path = self.worker.params.get('input_path') if self.worker else None
+        if input_path and os.path.exists(input_path):
+            try:
+                os.unlink(input_path)
+            except:
+                pass
+        
+        message = "Обработка остановлена"
+        if report.get('tiles_total'):
+            message += (
+                f": отброшено {report['tiles_done']} из {report['tiles_total']} тайлов"
+                f" ({report.get('seconds_discarded', 0)} с вычислений)"
+            )
+        self.iface.messageBar().pushInfo("Segmentation Plugin", message)
     
     def processing_finished(self):
         """Завершение обработки"""
         self.dlg.progressBar.setValue(0)
+        self.dlg.set_running(False)
         self.worker = None
+        self.remove_preview_layer()
+        
+        if self.exporter is not None:
+            self.exporter.cleanup()
+            self.exporter = None
     
     def cleanup_temp_files(self, metadata_path):
         """Очистка временных файлов"""
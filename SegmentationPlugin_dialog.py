@@ -4,8 +4,13 @@ from qgis.PyQt.QtCore import QSettings
 from qgis.gui import QgsMapLayerComboBox, QgsFileWidget
 from qgis.core import QgsMapLayerProxyModel
 
+from .config import MODEL_GSD
+
 
 class SegmentationPluginDialog(QtWidgets.QDialog):
+    # Код завершения диалога кнопкой живого слоя
+    LIVE_RESULT = 2
+    
     def __init__(self, parent=None):
         """Constructor."""
         super(SegmentationPluginDialog, self).__init__(parent)
@@ -50,6 +55,47 @@ class SegmentationPluginDialog(QtWidgets.QDialog):
         self.checkBox_use_extent = QtWidgets.QCheckBox("Использовать текущий экстент")
         self.gridLayout_input.addWidget(self.checkBox_use_extent, 1, 0, 1, 2)
         
+        # Разрешение обработки: крупный экстент можно обработать по обзорам
+        self.label_resolution = QtWidgets.QLabel("Разрешение:")
+        self.gridLayout_input.addWidget(self.label_resolution, 2, 0)
+        
+        self.comboBox_resolution = QtWidgets.QComboBox()
+        self.comboBox_resolution.addItem("Исходное", None)
+        self.comboBox_resolution.addItem("Как при обучении модели", 'model')
+        self.comboBox_resolution.addItem("Заданное", 'custom')
+        if MODEL_GSD is None:
+            # Разрешение обучения не задано - режим недоступен, а не исходное разрешение
+            item = self.comboBox_resolution.model().item(1)
+            item.setEnabled(False)
+            item.setToolTip("Разрешение обучения модели не задано (MODEL_GSD в config.py)")
+        self.comboBox_resolution.setToolTip(
+            "При разрешении грубее исходного растр читается из обзоров "
+            "с уменьшением - быстрый предварительный просмотр крупных территорий"
+        )
+        self.gridLayout_input.addWidget(self.comboBox_resolution, 2, 1)
+        
+        self.doubleSpinBox_gsd = QtWidgets.QDoubleSpinBox()
+        self.doubleSpinBox_gsd.setDecimals(3)
+        self.doubleSpinBox_gsd.setRange(0.001, 100000)
+        self.doubleSpinBox_gsd.setValue(1.0)
+        self.doubleSpinBox_gsd.setSuffix(" ед./пикс.")
+        self.doubleSpinBox_gsd.setEnabled(False)
+        self.gridLayout_input.addWidget(self.doubleSpinBox_gsd, 3, 1)
+        
+        # Область интереса: обрабатываются только патчи, пересекающие полигоны
+        self.label_aoi = QtWidgets.QLabel("Область интереса:")
+        self.gridLayout_input.addWidget(self.label_aoi, 4, 0)
+        
+        self.mMapLayerComboBox_aoi = QgsMapLayerComboBox()
+        self.mMapLayerComboBox_aoi.setFilters(QgsMapLayerProxyModel.PolygonLayer)
+        self.mMapLayerComboBox_aoi.setAllowEmptyLayer(True)
+        self.mMapLayerComboBox_aoi.setLayer(None)
+        self.gridLayout_input.addWidget(self.mMapLayerComboBox_aoi, 4, 1)
+        
+        self.checkBox_aoi_selected = QtWidgets.QCheckBox("Только выбранные объекты")
+        self.checkBox_aoi_selected.setEnabled(False)
+        self.gridLayout_input.addWidget(self.checkBox_aoi_selected, 5, 1)
+        
         self.verticalLayout.addWidget(self.groupBox_input)
         
         # Группа настроек модели
@@ -87,6 +133,12 @@ class SegmentationPluginDialog(QtWidgets.QDialog):
         self.radioButton_api = QtWidgets.QRadioButton("API инференс")
         self.gridLayout_inference.addWidget(self.radioButton_api, 0, 1)
         
+        self.radioButton_hybrid = QtWidgets.QRadioButton("Локально + API")
+        self.radioButton_hybrid.setToolTip(
+            "Патчи обрабатываются одновременно локальной моделью и сервером API"
+        )
+        self.gridLayout_inference.addWidget(self.radioButton_hybrid, 0, 2)
+        
         # API URL
         self.label_api_url = QtWidgets.QLabel("API URL:")
         self.gridLayout_inference.addWidget(self.label_api_url, 1, 0)
@@ -94,7 +146,7 @@ class SegmentationPluginDialog(QtWidgets.QDialog):
         self.lineEdit_api_url = QtWidgets.QLineEdit()
         self.lineEdit_api_url.setText("http://localhost:8080")
         self.lineEdit_api_url.setEnabled(False)
-        self.gridLayout_inference.addWidget(self.lineEdit_api_url, 1, 1)
+        self.gridLayout_inference.addWidget(self.lineEdit_api_url, 1, 1, 1, 2)
         
         self.verticalLayout.addWidget(self.groupBox_inference)
         
@@ -123,6 +175,26 @@ class SegmentationPluginDialog(QtWidgets.QDialog):
         self.spinBox_subdivisions.setValue(2)
         self.gridLayout_params.addWidget(self.spinBox_subdivisions, 1, 1)
         
+        # Растры для контроля качества, записываются в том же проходе, что и маска
+        self.checkBox_confidence = QtWidgets.QCheckBox("Сохранять уверенность модели")
+        self.checkBox_confidence.setToolTip(
+            "Максимальная вероятность и отрыв от второго класса (<результат>_confidence.tif)"
+        )
+        self.gridLayout_params.addWidget(self.checkBox_confidence, 2, 0, 1, 2)
+        
+        self.checkBox_probabilities = QtWidgets.QCheckBox("Сохранять вероятности классов")
+        self.checkBox_probabilities.setToolTip(
+            "Вероятности всех классов в uint8 (<результат>_probs.tif)"
+        )
+        self.gridLayout_params.addWidget(self.checkBox_probabilities, 3, 0, 1, 2)
+        
+        self.checkBox_vector = QtWidgets.QCheckBox("Сохранять полигоны классов")
+        self.checkBox_vector.setToolTip(
+            "Векторизация маски по мере записи (<результат>_polygons.gpkg). "
+            "Упрощение и минимальная площадь - VECTOR_SIMPLIFY и VECTOR_MIN_AREA в config.py"
+        )
+        self.gridLayout_params.addWidget(self.checkBox_vector, 4, 0, 1, 2)
+        
         self.verticalLayout.addWidget(self.groupBox_params)
         
         # Прогресс-бар
@@ -130,6 +202,10 @@ class SegmentationPluginDialog(QtWidgets.QDialog):
         self.progressBar.setValue(0)
         self.verticalLayout.addWidget(self.progressBar)
         
+        # Строка состояния обработки (скорость, оставшееся время)
+        self.label_status = QtWidgets.QLabel("")
+        self.verticalLayout.addWidget(self.label_status)
+        
         # Кнопки
         self.button_box = QtWidgets.QDialogButtonBox()
         self.button_box.setOrientation(QtCore.Qt.Horizontal)
@@ -138,6 +214,21 @@ class SegmentationPluginDialog(QtWidgets.QDialog):
         )
         self.button_box.accepted.connect(self.accept)
         self.button_box.rejected.connect(self.reject)
+        
+        # Остановка запущенной обработки
+        self.pushButton_stop = self.button_box.addButton(
+            "Остановить", QtWidgets.QDialogButtonBox.ActionRole
+        )
+        self.pushButton_stop.setVisible(False)
+        
+        # Сегментация видимой части карты по мере навигации, без запуска задания
+        self.pushButton_live = self.button_box.addButton(
+            "Живой слой", QtWidgets.QDialogButtonBox.ActionRole
+        )
+        self.pushButton_live.setToolTip(
+            "Сегментировать только видимые тайлы с разрешением по масштабу карты"
+        )
+        self.pushButton_live.clicked.connect(lambda: self.done(self.LIVE_RESULT))
         self.verticalLayout.addWidget(self.button_box)
     
     def init_ui(self):
@@ -167,12 +258,16 @@ class SegmentationPluginDialog(QtWidgets.QDialog):
         """Подключение сигналов"""
         self.radioButton_api.toggled.connect(self.on_inference_type_changed)
         self.radioButton_local.toggled.connect(self.on_inference_type_changed)
+        self.radioButton_hybrid.toggled.connect(self.on_inference_type_changed)
         self.comboBox_model.currentIndexChanged.connect(self.on_model_selection_changed)
+        self.comboBox_resolution.currentIndexChanged.connect(self.on_resolution_changed)
+        self.mMapLayerComboBox_aoi.layerChanged.connect(self.on_aoi_layer_changed)
     
     def on_inference_type_changed(self):
         """Обработка изменения типа инференса"""
         is_api = self.radioButton_api.isChecked()
-        self.lineEdit_api_url.setEnabled(is_api)
+        is_hybrid = self.radioButton_hybrid.isChecked()
+        self.lineEdit_api_url.setEnabled(is_api or is_hybrid)
         self.groupBox_model.setEnabled(not is_api)
     
     def on_model_selection_changed(self, index):
@@ -183,12 +278,49 @@ class SegmentationPluginDialog(QtWidgets.QDialog):
             self.fileWidget_model.setEnabled(False)
             self.fileWidget_model.setFilePath("")
     
+    def on_resolution_changed(self, index):
+        """Поле разрешения доступно только для заданного значения"""
+        self.doubleSpinBox_gsd.setEnabled(self.comboBox_resolution.currentData() == 'custom')
+    
+    def on_aoi_layer_changed(self, layer):
+        """Выбор объектов доступен только при заданной области интереса"""
+        self.checkBox_aoi_selected.setEnabled(layer is not None)
+    
+    def target_gsd(self):
+        """Выбранное разрешение: None, 'model' или единиц CRS на пиксель"""
+        mode = self.comboBox_resolution.currentData()
+        if mode == 'custom':
+            return self.doubleSpinBox_gsd.value()
+        return mode
+    
+    def set_running(self, running):
+        """Переключение диалога в режим отображения хода обработки"""
+        for group in (self.groupBox_input, self.groupBox_model,
+                      self.groupBox_inference, self.groupBox_params):
+            group.setEnabled(not running)
+        self.button_box.button(QtWidgets.QDialogButtonBox.Ok).setEnabled(not running)
+        self.pushButton_live.setEnabled(not running)
+        self.pushButton_stop.setVisible(running)
+        self.pushButton_stop.setEnabled(running)
+        if running:
+            self.setWindowModality(QtCore.Qt.NonModal)
+        else:
+            self.label_status.setText("")
+            self.on_inference_type_changed()
+    
     def save_settings(self):
         """Сохранение настроек"""
         self.settings.setValue('api_url', self.lineEdit_api_url.text())
         self.settings.setValue('patch_size', self.spinBox_patch_size.value())
         self.settings.setValue('subdivisions', self.spinBox_subdivisions.value())
         self.settings.setValue('use_api', self.radioButton_api.isChecked())
+        self.settings.setValue('use_hybrid', self.radioButton_hybrid.isChecked())
+        self.settings.setValue('resolution_mode', self.comboBox_resolution.currentIndex())
+        self.settings.setValue('target_gsd', self.doubleSpinBox_gsd.value())
+        self.settings.setValue('aoi_selected_only', self.checkBox_aoi_selected.isChecked())
+        self.settings.setValue('output_confidence', self.checkBox_confidence.isChecked())
+        self.settings.setValue('output_probabilities', self.checkBox_probabilities.isChecked())
+        self.settings.setValue('output_vector', self.checkBox_vector.isChecked())
     
     def load_settings(self):
         """Загрузка сохраненных настроек"""
@@ -196,12 +328,30 @@ class SegmentationPluginDialog(QtWidgets.QDialog):
         patch_size = int(self.settings.value('patch_size', 256))
         subdivisions = int(self.settings.value('subdivisions', 2))
         use_api = self.settings.value('use_api', False, type=bool)
+        use_hybrid = self.settings.value('use_hybrid', False, type=bool)
+        resolution_mode = self.settings.value('resolution_mode', 0, type=int)
+        target_gsd = self.settings.value('target_gsd', 1.0, type=float)
+        aoi_selected_only = self.settings.value('aoi_selected_only', False, type=bool)
+        output_confidence = self.settings.value('output_confidence', False, type=bool)
+        output_probabilities = self.settings.value('output_probabilities', False, type=bool)
+        output_vector = self.settings.value('output_vector', False, type=bool)
         
         self.lineEdit_api_url.setText(api_url)
         self.spinBox_patch_size.setValue(patch_size)
         self.spinBox_subdivisions.setValue(subdivisions)
-        
-        if use_api:
+        if self.comboBox_resolution.itemData(resolution_mode) == 'model' and MODEL_GSD is None:
+            resolution_mode = 0
+        self.comboBox_resolution.setCurrentIndex(resolution_mode)
+        self.doubleSpinBox_gsd.setValue(target_gsd)
+        self.on_resolution_changed(resolution_mode)
+        self.checkBox_aoi_selected.setChecked(aoi_selected_only)
+        self.checkBox_confidence.setChecked(output_confidence)
+        self.checkBox_probabilities.setChecked(output_probabilities)
+        self.checkBox_vector.setChecked(output_vector)
+        
+        if use_hybrid:
+            self.radioButton_hybrid.setChecked(True)
+        elif use_api:
             self.radioButton_api.setChecked(True)
         else:
             self.radioButton_local.setChecked(True)
@@ -20,6 +20,55 @@ SEGMENTATION_COLORS = [
 DEFAULT_PATCH_SIZE = 256
 DEFAULT_SUBDIVISIONS = 2
 DEFAULT_NUM_CLASSES = 6
+DEFAULT_BATCH_SIZE = 16  # Патчей в одном вызове модели
+# Разрешение снимков, на которых обучена модель (единиц CRS на пиксель);
+# используется режимом "как при обучении", None - режим недоступен
+MODEL_GSD = None
+
+# Потайловый API инференс
+API_TILED = True  # Отправлять изображение патчами, а не одним запросом
+API_TILE_CONCURRENCY = 4  # Параллельных запросов
+API_TILE_RETRIES = 3  # Повторов патча при сбое
+API_TILE_TIMEOUT = 60  # Таймаут запроса патча, секунд
+# Кодеки передачи по убыванию предпочтения, выбирается первый общий с сервером
+API_CODEC_PREFERENCE = ['raw+zstd', 'raw+lz4', 'webp', 'png']
+# Кодеки маски классов в ответе сервера
+API_MASK_CODEC_PREFERENCE = ['raw+zstd', 'raw+lz4', 'png', 'rle']
+API_CACHE_PRECHECK = True  # Проверять кэш сервера по хэшу до загрузки изображения
+API_JOB_MIN_PIXELS = 4096 * 4096  # С этого размера растр обрабатывается асинхронным заданием
+API_STREAM = True  # Без потайловой отправки принимать патчи ответа по мере готовности
+
+# Результат - маска классов с таблицей цветов
+OUTPUT_RGB = False  # Дополнительно сохранять RGB-изображение (только без геопривязки)
+OUTPUT_COG = True  # Cloud Optimized GeoTIFF с внутренними обзорами
+OUTPUT_COMPRESS = 'ZSTD'  # Сжатие результата (DEFLATE, если GDAL собран без ZSTD)
+OUTPUT_BLOCK_SIZE = 512  # Размер тайла результата
+OUTPUT_NODATA = 255  # Значение вне данных
+OUTPUT_CONFIDENCE = False  # <результат>_confidence.tif: максимальная вероятность и отрыв от второго класса
+OUTPUT_PROBABILITIES = False  # <результат>_probs.tif: вероятности всех классов в uint8
+OUTPUT_VECTOR = False  # <результат>_polygons.gpkg: полигоны классов, векторизованные по полосам
+VECTOR_SIMPLIFY = 0.0  # Допуск упрощения полигонов в единицах карты (0 - без упрощения)
+VECTOR_MIN_AREA = 0.0  # Полигоны меньшей площади (в единицах карты) не сохраняются
+OUTPUT_PREVIEW_INTERVAL = 5.0  # Как часто (с) заполняемый результат обновляется для слоя предпросмотра
+
+# Приведение не-uint8 растров (например, 16 бит) к uint8
+INPUT_STRETCH = 'minmax'  # 'minmax' или 'percentile'
+INPUT_STRETCH_PERCENTILES = (2.0, 98.0)  # Процентили для режима 'percentile'
+INPUT_STRETCH_PER_BAND = False  # Свой диапазон для каждого канала, иначе общий
+INPUT_STRETCH_SAMPLE = 1024  # Сторона выборки для оценки диапазона, пикселей
+
+# Живой слой: сегментация видимых на карте тайлов по запросу (utils/live_layer.py)
+LIVE_TILE_SIZE = 512  # Сторона тайла в пикселях результата
+LIVE_TILE_MARGIN = 32  # Контекст вокруг тайла в пикселях результата, обрезается при показе
+LIVE_CACHE_TILES = 256  # Готовых тайлов в кэше
+LIVE_UPDATE_DELAY_MS = 300  # Пауза после смены экстента карты до пересчета очереди
+LIVE_REPAINT_MS = 500  # Наименьший интервал перерисовки слоя
+
+# Локальный сервер инференса (utils/inference_server.py)
+SERVER_MAX_BATCH = 32  # Патчей в общем батче модели
+SERVER_MAX_WAIT_MS = 10  # Ожидание патчей других запросов, мс
+SERVER_CACHE_MEMORY_MB = 256  # Кэш результатов в памяти
+SERVER_CACHE_DISK_MB = 2048  # Кэш результатов на диске (0 - отключен)
 
 # Выбор алгоритма предсказания
 USE_SIMPLE_ALGORITHM = False  # По умолчанию используем оптимизированную версию
@@ -255,6 +255,10 @@ if errorlevel 1 goto :INSTALL_ERROR
 echo Installing python-multipart...
 .venv\Scripts\python.exe -m pip install --no-cache-dir python-multipart==0.0.6
 
+REM Необязательные кодеки сжатия для API (без них используется WebP/PNG)
+echo Installing lz4 and zstandard...
+.venv\Scripts\python.exe -m pip install --no-cache-dir lz4==4.3.3 zstandard==0.22.0
+
 REM Финальная проверка numpy
 echo.
 echo Final check of critical packages...
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Провайдер Processing для алгоритмов плагина
+"""
+import os
+
+from qgis.core import QgsProcessingProvider
+from qgis.PyQt.QtGui import QIcon
+
+from .segmentation_algorithm import SegmentationAlgorithm
+
+
+class SegmentationProvider(QgsProcessingProvider):
+    """Провайдер Processing плагина сегментации"""
+
+    def __init__(self, plugin_dir):
+        super().__init__()
+        self.plugin_dir = plugin_dir
+
+    def loadAlgorithms(self):
+        self.addAlgorithm(SegmentationAlgorithm(self.plugin_dir))
+
+    def id(self):
+        return 'segmentation'
+
+    def name(self):
+        return 'Segmentation Plugin'
+
+    def icon(self):
+        return QIcon(os.path.join(self.plugin_dir, 'icon.png'))
+
+    def supportedOutputRasterLayerExtensions(self):
+        # Процесс инференса пишет только GeoTIFF
+        return ['tif']
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Алгоритм Processing для сегментации растра
+
+Принимает те же параметры, что и диалог плагина, а также допуск упрощения и
+минимальную площадь полигонов классов. Задания выполняются в общем
+постоянном процессе инференса, поэтому при пакетной обработке модель
+загружается один раз для всех элементов.
+"""
+import json
+import os
+
+from qgis.core import (
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingContext,
+    QgsProcessingException,
+    QgsProcessingLayerPostProcessorInterface,
+    QgsProcessingOutputVectorLayer,
+    QgsProcessingParameterBoolean,
+    QgsProcessingParameterExtent,
+    QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterFile,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterRasterDestination,
+    QgsProcessingParameterRasterLayer,
+    QgsProcessingParameterString,
+    QgsRasterDataProvider,
+)
+
+from ..config import DEFAULT_PATCH_SIZE, DEFAULT_SUBDIVISIONS, VECTOR_SIMPLIFY, VECTOR_MIN_AREA
+from ..utils.image_utils import ImageProcessor
+from ..utils.inference_process import shared_process
+from ..utils.job_builder import (
+    prepare_input, build_params, default_model_path, resolve_target_gsd, prepare_aoi, aoi_extent
+)
+
+
+class ClassPalettePostProcessor(QgsProcessingLayerPostProcessorInterface):
+    """Назначает палитру классов слою результата после загрузки в проект"""
+
+    instance = None
+
+    def postProcessLayer(self, layer, context, feedback):
+        ImageProcessor.apply_class_palette(layer)
+        layer.triggerRepaint()
+
+    @staticmethod
+    def create():
+        # Ссылка хранится, чтобы объект не был удален сборщиком мусора
+        ClassPalettePostProcessor.instance = ClassPalettePostProcessor()
+        return ClassPalettePostProcessor.instance
+
+
+class ClassCategoriesPostProcessor(QgsProcessingLayerPostProcessorInterface):
+    """Назначает цвета классов слою полигонов после загрузки в проект"""
+
+    instance = None
+
+    def postProcessLayer(self, layer, context, feedback):
+        ImageProcessor.apply_class_categories(layer)
+        layer.triggerRepaint()
+
+    @staticmethod
+    def create():
+        ClassCategoriesPostProcessor.instance = ClassCategoriesPostProcessor()
+        return ClassCategoriesPostProcessor.instance
+
+
+class SegmentationAlgorithm(QgsProcessingAlgorithm):
+    """Семантическая сегментация растрового слоя"""
+
+    INPUT = 'INPUT'
+    EXTENT = 'EXTENT'
+    TARGET_GSD = 'TARGET_GSD'
+    AOI = 'AOI'
+    OUTPUT_CONFIDENCE = 'OUTPUT_CONFIDENCE'
+    OUTPUT_PROBABILITIES = 'OUTPUT_PROBABILITIES'
+    OUTPUT_VECTOR = 'OUTPUT_VECTOR'
+    VECTOR_SIMPLIFY = 'VECTOR_SIMPLIFY'
+    VECTOR_MIN_AREA = 'VECTOR_MIN_AREA'
+    OUTPUT_POLYGONS = 'OUTPUT_POLYGONS'
+    MODEL = 'MODEL'
+    PATCH_SIZE = 'PATCH_SIZE'
+    SUBDIVISIONS = 'SUBDIVISIONS'
+    USE_API = 'USE_API'
+    API_URL = 'API_URL'
+    OUTPUT = 'OUTPUT'
+
+    def __init__(self, plugin_dir):
+        super().__init__()
+        self.plugin_dir = plugin_dir
+
+    def createInstance(self):
+        return SegmentationAlgorithm(self.plugin_dir)
+
+    def name(self):
+        return 'segment_raster'
+
+    def displayName(self):
+        return 'Сегментация растра'
+
+    def shortHelpString(self):
+        return (
+            "Семантическая сегментация растрового слоя моделью плагина "
+            "(локально или через API). Модель загружается один раз и "
+            "переиспользуется при пакетной обработке."
+        )
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterRasterLayer(
+            self.INPUT, 'Растровый слой'
+        ))
+        self.addParameter(QgsProcessingParameterExtent(
+            self.EXTENT, 'Экстент (по умолчанию весь слой)', optional=True
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.TARGET_GSD, 'Разрешение обработки, единиц CRS на пиксель (0 - исходное, для WMS/XYZ обязательно)',
+            QgsProcessingParameterNumber.Double, defaultValue=0.0, minValue=0.0, optional=True
+        ))
+        self.addParameter(QgsProcessingParameterFeatureSource(
+            self.AOI, 'Область интереса (полигоны)', [QgsProcessing.TypeVectorPolygon], optional=True
+        ))
+        self.addParameter(QgsProcessingParameterFile(
+            self.MODEL, 'Файл модели (по умолчанию best_model.h5)',
+            fileFilter='Model Files (*.h5 *.keras *.tflite)', optional=True
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.PATCH_SIZE, 'Размер патча', QgsProcessingParameterNumber.Integer,
+            defaultValue=DEFAULT_PATCH_SIZE, minValue=128, maxValue=512
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.SUBDIVISIONS, 'Подразделения', QgsProcessingParameterNumber.Integer,
+            defaultValue=DEFAULT_SUBDIVISIONS, minValue=1, maxValue=4
+        ))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.USE_API, 'API инференс', defaultValue=False
+        ))
+        self.addParameter(QgsProcessingParameterString(
+            self.API_URL, 'API URL', defaultValue='http://localhost:8080'
+        ))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.OUTPUT_CONFIDENCE, 'Сохранять уверенность модели (<результат>_confidence.tif)',
+            defaultValue=False
+        ))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.OUTPUT_PROBABILITIES, 'Сохранять вероятности классов (<результат>_probs.tif)',
+            defaultValue=False
+        ))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.OUTPUT_VECTOR, 'Сохранять полигоны классов (<результат>_polygons.gpkg)',
+            defaultValue=False
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.VECTOR_SIMPLIFY, 'Допуск упрощения полигонов, единиц карты',
+            QgsProcessingParameterNumber.Double, defaultValue=VECTOR_SIMPLIFY, minValue=0.0
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.VECTOR_MIN_AREA, 'Минимальная площадь полигона, единиц карты',
+            QgsProcessingParameterNumber.Double, defaultValue=VECTOR_MIN_AREA, minValue=0.0
+        ))
+        self.addParameter(QgsProcessingParameterRasterDestination(
+            self.OUTPUT, 'Результат сегментации'
+        ))
+        self.addOutput(QgsProcessingOutputVectorLayer(
+            self.OUTPUT_POLYGONS, 'Полигоны классов', QgsProcessing.TypeVectorPolygon
+        ))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        layer = self.parameterAsRasterLayer(parameters, self.INPUT, context)
+        if layer is None:
+            raise QgsProcessingException(self.invalidRasterError(parameters, self.INPUT))
+
+        extent = None
+        if parameters.get(self.EXTENT):
+            extent = self.parameterAsExtent(parameters, self.EXTENT, context, layer.crs())
+
+        use_api = self.parameterAsBoolean(parameters, self.USE_API, context)
+        model_path = self.parameterAsFile(parameters, self.MODEL, context)
+        if not model_path:
+            model_path = default_model_path(self.plugin_dir)
+        if not use_api and not os.path.exists(model_path):
+            raise QgsProcessingException(f"Файл модели не найден: {model_path}")
+
+        output_path = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
+
+        target_gsd = resolve_target_gsd(self.parameterAsDouble(parameters, self.TARGET_GSD, context))
+        # У WMS/XYZ нет собственного разрешения, а масштаба карты, как в диалоге, здесь нет
+        native_size = layer.dataProvider().capabilities() & QgsRasterDataProvider.Size
+        if not native_size and not target_gsd:
+            raise QgsProcessingException(
+                "У слоя нет собственного разрешения (WMS, XYZ): укажите разрешение обработки"
+            )
+
+        # Выбранные объекты учитываются самим источником Processing
+        aoi = None
+        aoi_source = self.parameterAsSource(parameters, self.AOI, context)
+        if aoi_source is not None:
+            aoi, bounds = prepare_aoi(aoi_source.getFeatures(), aoi_source.sourceCrs(), layer.crs())
+            if aoi is None:
+                raise QgsProcessingException("В области интереса нет полигонов")
+            try:
+                extent = aoi_extent(extent, layer, bounds)
+            except ValueError as e:
+                raise QgsProcessingException(str(e))
+
+        try:
+            prepared = prepare_input(layer, extent, fallback_units_per_pixel=target_gsd,
+                                     target_gsd=target_gsd)
+        except Exception as e:
+            raise QgsProcessingException(str(e))
+
+        params = build_params(
+            layer,
+            prepared,
+            output_path,
+            model_path,
+            self.parameterAsInt(parameters, self.PATCH_SIZE, context),
+            self.parameterAsInt(parameters, self.SUBDIVISIONS, context),
+            use_api=use_api,
+            api_url=self.parameterAsString(parameters, self.API_URL, context),
+            target_gsd=target_gsd,
+            aoi=aoi,
+            output_confidence=self.parameterAsBoolean(parameters, self.OUTPUT_CONFIDENCE, context),
+            output_probabilities=self.parameterAsBoolean(parameters, self.OUTPUT_PROBABILITIES, context),
+            output_vector=self.parameterAsBoolean(parameters, self.OUTPUT_VECTOR, context),
+            vector_simplify=self.parameterAsDouble(parameters, self.VECTOR_SIMPLIFY, context),
+            vector_min_area=self.parameterAsDouble(parameters, self.VECTOR_MIN_AREA, context)
+        )
+
+        try:
+            metadata_path = self._run_job(params, feedback)
+        finally:
+            self._cleanup(prepared)
+
+        if metadata_path is None:
+            return {}
+
+        vector_path = None
+        if os.path.exists(metadata_path):
+            with open(metadata_path, 'r') as f:
+                vector_path = json.load(f).get('vector_path')
+            os.unlink(metadata_path)
+
+        results = {self.OUTPUT: output_path}
+        if context.willLoadLayerOnCompletion(output_path):
+            details = context.layerToLoadOnCompletionDetails(output_path)
+            details.setPostProcessor(ClassPalettePostProcessor.create())
+
+        if vector_path and os.path.exists(vector_path):
+            vector_uri = vector_path + '|layername=segments'
+            results[self.OUTPUT_POLYGONS] = vector_uri
+            if context.willLoadLayerOnCompletion(output_path):
+                details = QgsProcessingContext.LayerDetails(
+                    'Segmentation Polygons', context.project(), self.OUTPUT_POLYGONS
+                )
+                details.setPostProcessor(ClassCategoriesPostProcessor.create())
+                context.addLayerToLoadOnCompletion(vector_uri, details)
+
+        return results
+
+    def _run_job(self, params, feedback):
+        """Выполняет задание в общем процессе, возвращает путь к метаданным"""
+        job = shared_process(self.plugin_dir).submit(params)
+        feedback.canceled.connect(job.cancel)
+        if feedback.isCanceled():
+            job.cancel()
+
+        try:
+            for message in job.messages():
+                msg_type = message.get('type')
+                if 'percent' in message:
+                    feedback.setProgress(message['percent'])
+
+                if msg_type == 'stage' and message.get('status') == 'finished':
+                    feedback.pushInfo(f"{message['name']}: {message['seconds']} с")
+                elif msg_type == 'result':
+                    return message['metadata_path']
+                elif msg_type == 'cancelled':
+                    feedback.pushInfo("Обработка остановлена")
+                    return None
+                elif msg_type == 'error':
+                    if feedback.isCanceled():
+                        return None
+                    raise QgsProcessingException(f"Ошибка инференса: {message.get('message')}")
+        finally:
+            feedback.canceled.disconnect(job.cancel)
+
+        return None
+
+    @staticmethod
+    def _cleanup(prepared):
+        """Удаляет временные входные данные задания"""
+        if prepared['exporter'] is not None:
+            prepared['exporter'].cleanup()
+        input_path = prepared['input_path']
+        if input_path and os.path.exists(input_path):
+            try:
+                os.unlink(input_path)
+            except OSError:
+                pass
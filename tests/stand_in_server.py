@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Локальный сервер-заглушка для тестов клиентов API
+
+Настоящий InferenceServer с детерминированной моделью вместо Keras;
+обработчик запросов можно заставить отклонять каждый N-й POST с 503 или
+отвечать с задержкой.
+"""
+import threading
+import time
+
+import numpy as np
+
+from config import DEFAULT_NUM_CLASSES
+from utils.inference_server import InferenceHandler, InferenceServer
+from utils.prediction import predict_img_tiled
+
+
+def fake_predict(patches):
+    """Класс пикселя по яркости: (B, H, W, 3) -> вероятности (B, H, W, классы)"""
+    classes = patches.astype(np.int64).sum(axis=3) * DEFAULT_NUM_CLASSES // (3 * 256)
+    return np.eye(DEFAULT_NUM_CLASSES, dtype=np.float32)[classes]
+
+
+def soft_predict(patches):
+    """Мягкие вероятности, как у локальной модели, с тем же argmax, что у fake_predict"""
+    return 0.5 * fake_predict(patches) + 0.5 / DEFAULT_NUM_CLASSES
+
+
+def make_image(height=700, width=900):
+    rng = np.random.default_rng(1)
+    return rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+
+
+class StandInHandler(InferenceHandler):
+    """Обработчик, который часть запросов /predict/ отклоняет или задерживает"""
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.posts += 1
+            fail = server.fail_every and server.posts % server.fail_every == 0
+        if server.delay:
+            time.sleep(server.delay)
+        if fail:
+            self.rfile.read(int(self.headers['Content-Length']))
+            self._send_json({'detail': 'overloaded'}, status=503)
+            return
+        super().do_POST()
+
+
+class StandInServer:
+    """InferenceServer с fake_predict на свободном порту в фоновом потоке"""
+
+    def __init__(self, fail_every=0, delay=0.0, cache=None):
+        self.server = InferenceServer(('127.0.0.1', 0), fake_predict, 'stand-in', max_batch=8,
+                                      max_wait_ms=1, cache=cache)
+        self.server.RequestHandlerClass = StandInHandler
+        self.server.lock = threading.Lock()
+        self.server.posts = 0
+        self.server.fail_every = fail_every
+        self.server.delay = delay
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def expected_votes(image, window_size, subdivisions):
+    """Смешивание one-hot масок патчей, как в клиенте"""
+    def one_hot_masks(patches):
+        return np.eye(DEFAULT_NUM_CLASSES, dtype=np.float32)[np.argmax(fake_predict(patches), axis=3)]
+    return predict_img_tiled(image, window_size, subdivisions, DEFAULT_NUM_CLASSES, one_hot_masks)
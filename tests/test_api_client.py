@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Потайловый клиент API против локального сервера-заглушки
+
+Заглушка (stand_in_server.py) - настоящий InferenceServer с
+детерминированной моделью вместо Keras.
+"""
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from config import DEFAULT_NUM_CLASSES, SEGMENTATION_COLORS
+from utils.api_client import TiledApiClient
+from utils.ipc import CancelToken, InferenceCancelled
+from utils.prediction import compute_tile_coords
+from utils.result_cache import ResultCache
+
+from stand_in_server import StandInServer, expected_votes, fake_predict, make_image
+
+
+class TiledApiClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = None
+        self.client = None
+
+    def tearDown(self):
+        if self.client is not None:
+            self.client.close()
+        if self.server is not None:
+            self.server.close()
+
+    def connect(self, **server_kwargs):
+        self.server = StandInServer(**server_kwargs)
+        self.client = TiledApiClient(self.server.url, SEGMENTATION_COLORS, concurrency=4, retries=3,
+                                     timeout=30, backoff=0.01, codec_preference=('png',),
+                                     mask_codec_preference=('png',))
+        return self.client
+
+    def test_tiles_blend_like_local_prediction(self):
+        """Каждый пятый запрос отклоняется с 503 и повторяется"""
+        client = self.connect(fail_every=5)
+        image = make_image()
+        progress = []
+
+        votes = client.predict_tiled(image, 256, 2, DEFAULT_NUM_CLASSES,
+                                     progress_callback=lambda done, total: progress.append((done, total)))
+
+        np.testing.assert_allclose(votes, expected_votes(image, 256, 2), atol=1e-5)
+        self.assertEqual(progress[-1][0], progress[-1][1])
+        self.assertGreater(self.server.server.posts, progress[-1][1])
+
+    def test_small_image_is_one_padded_tile(self):
+        client = self.connect()
+        image = make_image(100, 150)
+
+        votes = client.predict_tiled(image, 256, 2, DEFAULT_NUM_CLASSES)
+
+        self.assertEqual(votes.shape, (100, 150, DEFAULT_NUM_CLASSES))
+        np.testing.assert_array_equal(np.argmax(votes, axis=2),
+                                      np.argmax(fake_predict(image[np.newaxis])[0], axis=2))
+
+    def test_cache_precheck_counts_each_tile_once(self):
+        """Промах проверки кэша и загрузка патча - один промах"""
+        client = self.connect(cache=ResultCache(memory_bytes=64 * 1024 ** 2))
+        image = make_image()
+        tiles = len(compute_tile_coords(700, 900, 256, 2)[0])
+
+        first = client.predict_tiled(image, 256, 2, DEFAULT_NUM_CLASSES)
+        stats = self.server.server.cache.stats()
+        self.assertEqual((stats['cache_hits'], stats['cache_misses']), (0, tiles))
+
+        second = client.predict_tiled(image, 256, 2, DEFAULT_NUM_CLASSES)
+        stats = self.server.server.cache.stats()
+        self.assertEqual((stats['cache_hits'], stats['cache_misses']), (tiles, tiles))
+        self.assertEqual(stats['cache_hit_rate'], 0.5)
+        self.assertEqual(client.stats.as_dict()['cache_hits'], tiles)
+        np.testing.assert_array_equal(first, second)
+
+    def test_cancel_does_not_wait_for_slow_tiles(self):
+        """Отмена во время ожидания ответов не ждет отправленные запросы"""
+        client = self.connect(delay=3.0)
+        token = CancelToken()
+        threading.Timer(0.3, token.cancel).start()
+
+        started = time.monotonic()
+        with self.assertRaises(InferenceCancelled):
+            client.predict_tiled(make_image(), 256, 2, DEFAULT_NUM_CLASSES, cancel_check=token.check)
+        self.assertLess(time.monotonic() - started, 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
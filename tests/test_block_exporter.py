@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Протокол потоковой загрузки блоков: BlockStreamExporter пишет сырой файл и
+индекс, StreamedRasterSource читает окна по мере готовности блоков.
+
+Тесты протокола заполняют файлы потока сами и идут без QGIS. Тесты
+экспортера используют провайдер-заглушку поверх файла .npy и требуют
+qgis.core (запуск из окружения QGIS, см. make test).
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from utils.raster_source import StreamedRasterSource
+
+try:
+    from qgis.core import Qgis, QgsRasterDataProvider, QgsRectangle
+    from utils.block_exporter import BlockStreamExporter
+except ImportError:
+    BlockStreamExporter = None
+
+
+BLOCK = 16
+
+
+def make_image(height=40, width=56):
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+
+
+def block_origins(image, block_size=BLOCK):
+    height, width = image.shape[:2]
+    return [(x, y) for y in range(0, height, block_size) for x in range(0, width, block_size)]
+
+
+class StreamFiles:
+    """Файлы потока в формате BlockStreamExporter, которые заполняет тест"""
+
+    def __init__(self, directory, image, block_size=BLOCK):
+        self.image = image
+        self.block_size = block_size
+        self.path = os.path.join(directory, 'input.raw')
+        self.index = os.path.join(directory, 'input.idx')
+        self.data = np.memmap(self.path, mode='w+', dtype=image.dtype, shape=image.shape)
+        open(self.index, 'w').close()
+
+    def source(self, **kwargs):
+        height, width, bands = self.image.shape
+        return StreamedRasterSource({
+            'type': 'stream',
+            'path': self.path,
+            'index': self.index,
+            'width': width,
+            'height': height,
+            'bands': bands,
+            'dtype': self.image.dtype.name,
+            'block_size': self.block_size,
+        }, poll_interval=0.005, **kwargs)
+
+    def put(self, x, y):
+        bs = self.block_size
+        block = self.image[y:y + bs, x:x + bs]
+        self.data[y:y + bs, x:x + bs] = block
+        self.data.flush()
+        self._record({'x': x, 'y': y, 'width': block.shape[1], 'height': block.shape[0]})
+
+    def error(self, message):
+        self._record({'error': message})
+
+    def done(self):
+        self._record({'done': True})
+
+    def _record(self, record):
+        with open(self.index, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+class StreamedSourceTest(unittest.TestCase):
+    """Чтение окон по индексу без QGIS"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image = make_image()
+        self.files = StreamFiles(self.directory, self.image)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_blocks_out_of_order(self):
+        """Окно ждет свои блоки, пришедшие в обратном порядке"""
+        source = self.files.source(timeout=10)
+
+        def writer():
+            for x, y in reversed(block_origins(self.image)):
+                time.sleep(0.01)
+                self.files.put(x, y)
+            self.files.done()
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            # Первый блок строки пишется последним
+            np.testing.assert_array_equal(source.read_window(0, 0, 20, 20), self.image[:20, :20])
+            np.testing.assert_array_equal(source.read(), self.image)
+        finally:
+            thread.join()
+
+    def test_window_needs_only_its_blocks(self):
+        self.files.put(48, 32)
+        source = self.files.source(timeout=0.5)
+
+        np.testing.assert_array_equal(source.read_window(48, 32, 8, 8), self.image[32:40, 48:56])
+        self.assertFalse(source.done)
+
+    def test_partial_tail_line_is_read_later(self):
+        self.files.put(0, 0)
+        with open(self.files.index, 'a') as f:
+            f.write('{"x": 16, "y"')
+        source = self.files.source(timeout=0.5)
+
+        np.testing.assert_array_equal(source.read_window(0, 0, 16, 16), self.image[:16, :16])
+        with open(self.files.index, 'a') as f:
+            f.write(': 0, "width": 16, "height": 16}\n')
+        self.files.data[0:16, 16:32] = self.image[0:16, 16:32]
+        np.testing.assert_array_equal(source.read_window(16, 0, 16, 16), self.image[:16, 16:32])
+
+    def test_error_record(self):
+        self.files.put(0, 0)
+        self.files.error('HTTP 503')
+        source = self.files.source(timeout=5)
+
+        with self.assertRaisesRegex(RuntimeError, 'HTTP 503'):
+            source.read_window(16, 0, 16, 16)
+
+    def test_done_record(self):
+        for x, y in block_origins(self.image):
+            self.files.put(x, y)
+        self.files.done()
+        source = self.files.source(timeout=0.5)
+
+        np.testing.assert_array_equal(source[0:40, 0:56], self.image)
+        self.assertTrue(source.done)
+
+    def test_done_with_missing_blocks(self):
+        self.files.put(0, 0)
+        self.files.done()
+        source = self.files.source(timeout=5)
+
+        with self.assertRaisesRegex(RuntimeError, 'часть блоков отсутствует'):
+            source.read_window(0, 0, 32, 16)
+
+    def test_timeout(self):
+        source = self.files.source(timeout=0.05)
+
+        with self.assertRaises(TimeoutError):
+            source.read_window(0, 0, 16, 16)
+
+
+class FileBackedProvider:
+    """Провайдер-заглушка: блоки читаются из файла .npy с задержкой
+
+    Задержка уменьшается к концу растра, так что нижние блоки приходят
+    раньше верхних.
+    """
+
+    def __init__(self, path, extent, fail_at=None, delay=0.02):
+        self.path = path
+        self.array = np.load(path, mmap_mode='r')
+        self.extent = extent
+        self.fail_at = fail_at
+        self.delay = delay
+
+    def clone(self):
+        return FileBackedProvider(self.path, self.extent, self.fail_at, self.delay)
+
+    def dataType(self, band):
+        return Qgis.Byte
+
+    def bandCount(self):
+        return self.array.shape[2]
+
+    def capabilities(self):
+        return QgsRasterDataProvider.Size
+
+    def block(self, band, extent, width, height):
+        height_px, width_px = self.array.shape[:2]
+        x = int(round((extent.xMinimum() - self.extent.xMinimum()) / self.extent.width() * width_px))
+        y = int(round((self.extent.yMaximum() - extent.yMaximum()) / self.extent.height() * height_px))
+        if (x, y) == self.fail_at:
+            raise IOError('HTTP 503')
+        time.sleep(self.delay * (1 - (y * width_px + x) / (height_px * width_px)))
+        return _Block(np.ascontiguousarray(self.array[y:y + height, x:x + width, band - 1]))
+
+
+class _Block:
+    def __init__(self, data):
+        self._data = data
+
+    def data(self):
+        return self._data.tobytes()
+
+
+class _Layer:
+    def __init__(self, provider):
+        self.provider = provider
+
+    def dataProvider(self):
+        return self.provider
+
+
+@unittest.skipIf(BlockStreamExporter is None, 'нужен qgis.core')
+class BlockStreamExporterTest(unittest.TestCase):
+    """Экспортер с провайдером-заглушкой поверх файла"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.image = make_image()
+        self.path = os.path.join(self.directory, 'image.npy')
+        np.save(self.path, self.image)
+        height, width = self.image.shape[:2]
+        self.extent = QgsRectangle(1000, 2000, 1000 + width * 2, 2000 + height * 2)
+        self.exporter = None
+
+    def tearDown(self):
+        if self.exporter is not None:
+            self.exporter.cleanup()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def export(self, **provider_kwargs):
+        provider = FileBackedProvider(self.path, self.extent, **provider_kwargs)
+        height, width = self.image.shape[:2]
+        self.exporter = BlockStreamExporter(_Layer(provider), self.extent, width, height,
+                                            block_size=BLOCK, max_workers=3)
+        self.exporter.start()
+        return StreamedRasterSource(self.exporter.input_source(), poll_interval=0.005, timeout=10)
+
+    def index_records(self):
+        with open(self.exporter.index_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_blocks_out_of_order(self):
+        source = self.export()
+
+        np.testing.assert_array_equal(source.read(), self.image)
+        records = self.index_records()
+        origins = [(record['x'], record['y']) for record in records if 'x' in record]
+        self.assertEqual(sorted(origins, key=lambda o: (o[1], o[0])), block_origins(self.image))
+        self.assertNotEqual(origins, block_origins(self.image))
+        self.assertEqual(records[-1], {'done': True})
+        self.assertEqual(self.exporter.blocks_done, self.exporter.blocks_total)
+
+    def test_error_record(self):
+        source = self.export(fail_at=(16, 0))
+
+        with self.assertRaisesRegex(RuntimeError, 'HTTP 503'):
+            source.read()
+        self.assertIn({'error': 'HTTP 503'}, self.index_records())
+        self.assertEqual(self.exporter.error, 'HTTP 503')
+        self.assertNotIn({'done': True}, self.index_records())
+
+
+if __name__ == '__main__':
+    unittest.main()
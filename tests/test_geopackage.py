@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Служебные таблицы GeoPackage, собранного через sqlite3
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import numpy as np
+
+from utils.geopackage import GeoPackageWriter
+
+
+SQUARE = [np.array([[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]], dtype=np.float64)]
+
+
+class GeoPackageWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'segments.gpkg')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write(self, crs):
+        writer = GeoPackageWriter(self.path, crs=crs)
+        writer.add([SQUARE], 1, 'Здания', 100.0)
+        writer.close()
+        connection = sqlite3.connect(self.path)
+        self.addCleanup(connection.close)
+        return connection
+
+    def srs_ids(self, connection):
+        return sorted(row[0] for row in connection.execute('SELECT srs_id FROM gpkg_spatial_ref_sys'))
+
+    def test_required_srs_without_crs(self):
+        connection = self.write(None)
+
+        self.assertEqual(self.srs_ids(connection), [-1, 0, 4326])
+        organization, code = connection.execute(
+            'SELECT organization, organization_coordsys_id FROM gpkg_spatial_ref_sys WHERE srs_id = 4326'
+        ).fetchone()
+        self.assertEqual((organization, code), ('EPSG', 4326))
+
+    def test_layer_srs_added(self):
+        connection = self.write('EPSG:3857')
+
+        self.assertEqual(self.srs_ids(connection), [-1, 0, 3857, 4326])
+        self.assertEqual(connection.execute('SELECT srs_id FROM gpkg_contents').fetchone()[0], 3857)
+
+    def test_wgs84_layer_srs_is_not_duplicated(self):
+        connection = self.write('EPSG:4326')
+
+        self.assertEqual(self.srs_ids(connection), [-1, 0, 4326])
+        self.assertEqual(connection.execute('SELECT count(*) FROM "segments"').fetchone()[0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Гибридный инференс: локальная модель и сервер-заглушка над одной очередью
+"""
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from config import DEFAULT_NUM_CLASSES, SEGMENTATION_COLORS
+from utils.api_client import TiledApiClient
+from utils.hybrid import HybridExecutor
+from utils.ipc import CancelToken, InferenceCancelled
+
+from stand_in_server import StandInServer, expected_votes, make_image, soft_predict
+
+
+class HybridExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = None
+        self.client = None
+
+    def tearDown(self):
+        if self.client is not None:
+            self.client.close()
+        if self.server is not None:
+            self.server.close()
+
+    def executor(self, pred_func=soft_predict, **server_kwargs):
+        self.server = StandInServer(**server_kwargs)
+        self.client = TiledApiClient(self.server.url, SEGMENTATION_COLORS, concurrency=4, retries=2,
+                                     timeout=30, backoff=0.01, codec_preference=('png',),
+                                     mask_codec_preference=('png',))
+        return HybridExecutor(pred_func, self.client, batch_size=4)
+
+    def test_both_sides_blend_like_local_prediction(self):
+        """Мягкие вероятности локальной модели голосуют так же, как маски API"""
+        executor = self.executor()
+        image = make_image()
+
+        votes = executor.predict(image, 256, 2, DEFAULT_NUM_CLASSES)
+
+        np.testing.assert_allclose(votes, expected_votes(image, 256, 2), atol=1e-5)
+        self.assertGreater(executor.counts['api'], 0)
+        self.assertGreater(executor.counts['local'], 0)
+
+    def test_cancel_does_not_wait_for_api(self):
+        """Отмена не ждет ответов API, отправленных до нее"""
+        def slow_masks(patches):
+            time.sleep(0.2)
+            return soft_predict(patches)
+
+        executor = self.executor(slow_masks, delay=3.0)
+        token = CancelToken()
+        threading.Timer(0.3, token.cancel).start()
+
+        started = time.monotonic()
+        with self.assertRaises(InferenceCancelled):
+            executor.predict(make_image(), 256, 2, DEFAULT_NUM_CLASSES, cancel_check=token.check)
+        self.assertLess(time.monotonic() - started, 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Очередь заданий общего процесса инференса и отмена
+
+Вместо utils/inference_runner.py в каталоге плагина-заглушки лежит
+скрипт, который выполняет задания через настоящий CommandReader: задание
+спит params['seconds'], проверяя флаг отмены (или игнорируя его с
+params['hang']). Предзагрузка спит model_path секунд.
+"""
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import unittest
+
+from utils.inference_process import InferenceProcess
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVE_SCRIPT = '''
+import sys, time
+sys.path.insert(0, {repo!r})
+from utils.ipc import open_channel, CommandReader, Telemetry
+
+channel = open_channel()
+reader = CommandReader(sys.stdin, channel)
+reader.start()
+while True:
+    command = reader.next_job()
+    if command is None:
+        break
+    if command['type'] == 'preload':
+        time.sleep(float(command['model_path']))
+        continue
+    telemetry = Telemetry(channel, job=command['id'])
+    telemetry.send('started')
+    params = command['params']
+    token = reader.cancel_token
+    deadline = time.monotonic() + params['seconds']
+    while time.monotonic() < deadline:
+        if token.cancelled and not params.get('hang'):
+            telemetry.send('cancelled', tiles_done=0, tiles_total=0)
+            break
+        time.sleep(0.01)
+    else:
+        telemetry.send('result', metadata_path='')
+'''
+
+
+@unittest.skipIf(os.name == 'nt', 'заглушка интерпретатора - shell-скрипт')
+class InferenceProcessCancelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.plugin_dir, 'utils'))
+        with open(os.path.join(self.plugin_dir, 'utils', 'inference_runner.py'), 'w') as f:
+            f.write(SERVE_SCRIPT.format(repo=REPO_DIR))
+
+        # create_clean_env задает PYTHONHOME каталога .venv, заглушка его сбрасывает
+        bin_dir = os.path.join(self.plugin_dir, '.venv', 'bin')
+        os.makedirs(bin_dir)
+        python = os.path.join(bin_dir, 'python')
+        with open(python, 'w') as f:
+            f.write(f'#!/bin/sh\nunset PYTHONHOME\nexec {sys.executable} "$@"\n')
+        os.chmod(python, os.stat(python).st_mode | stat.S_IEXEC)
+
+        self.process = InferenceProcess(self.plugin_dir)
+        self.process.CANCEL_GRACE_PERIOD = 0.5
+
+    def tearDown(self):
+        self.process.close()
+        shutil.rmtree(self.plugin_dir, ignore_errors=True)
+
+    def terminal(self, job):
+        return [message for message in job.messages()][-1]
+
+    def wait_started(self, job, timeout=10):
+        deadline = time.monotonic() + timeout
+        while self.process.running != job.id:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_cancel_queued_job_keeps_running_job(self):
+        running = self.process.submit({'seconds': 1.5})
+        queued = self.process.submit({'seconds': 1.0})
+        self.wait_started(running)
+
+        queued.cancel()
+        started = time.monotonic()
+        self.assertEqual(self.terminal(queued)['type'], 'cancelled')
+        self.assertLess(time.monotonic() - started, 1.0)
+
+        # Дольше CANCEL_GRACE_PERIOD - процесс не должен быть завершен
+        self.assertEqual(self.terminal(running)['type'], 'result')
+        self.assertTrue(self.process.is_running())
+
+    def test_cancel_running_job(self):
+        job = self.process.submit({'seconds': 5})
+        self.wait_started(job)
+
+        job.cancel()
+        self.assertEqual(self.terminal(job)['type'], 'cancelled')
+        self.assertIsNone(self.process.running)
+
+    def test_hung_job_terminates_process(self):
+        job = self.process.submit({'seconds': 30, 'hang': True})
+        self.wait_started(job)
+
+        job.cancel()
+        message = self.terminal(job)
+        self.assertEqual(message['type'], 'error')
+        self.assertIn('Процесс инференса завершился', message['message'])
+
+    def test_no_termination_while_preloading(self):
+        self.process.preload('1.0')
+        job = self.process.submit({'seconds': 0.2})
+
+        # Задание ждет окончания загрузки модели дольше CANCEL_GRACE_PERIOD
+        job.cancel()
+        self.assertEqual(self.terminal(job)['type'], 'cancelled')
+        time.sleep(1.0)
+        self.assertTrue(self.process.is_running())
+
+
+if __name__ == '__main__':
+    unittest.main()
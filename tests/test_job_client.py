@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Асинхронные задания API: создание, прерывание, возобновление и пересоздание
+задания, потерянного сервером, против локального сервера-заглушки
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+from config import DEFAULT_NUM_CLASSES, SEGMENTATION_COLORS
+from utils.ipc import InferenceCancelled
+from utils.job_client import JobApiClient, JobState, prune_job_states
+from utils.prediction import compute_tile_coords
+
+from stand_in_server import StandInServer, expected_votes, make_image
+
+
+WINDOW = 256
+SUBDIVISIONS = 2
+
+
+def cancel_after(tiles):
+    """cancel_check, прерывающий обработку после tiles готовых патчей"""
+    def check(done, total):
+        if done >= tiles:
+            raise InferenceCancelled(done, total)
+    return check
+
+
+class JobApiClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.state_dir = tempfile.mkdtemp()
+        self.image = make_image()
+        self.expected = expected_votes(self.image, WINDOW, SUBDIVISIONS)
+        self.total = len(compute_tile_coords(*self.image.shape[:2], WINDOW, SUBDIVISIONS)[0])
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.close()
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+
+    def client(self):
+        client = JobApiClient(self.server.url, SEGMENTATION_COLORS, concurrency=4, retries=2,
+                              timeout=30, backoff=0.01, codec_preference=('png',),
+                              mask_codec_preference=('png',))
+        client.POLL_WAIT_IDLE = 0.5
+        self.clients.append(client)
+        return client
+
+    def predict(self, client, **kwargs):
+        return client.predict_job(self.image, WINDOW, SUBDIVISIONS, DEFAULT_NUM_CLASSES,
+                                  self.state_dir, **kwargs)
+
+    def forget_tiles(self, indices):
+        """Стирает скачанные патчи из состояния, как при сбое до сохранения"""
+        state = JobState(self.state_dir, self.total, WINDOW)
+        state.done[list(indices)] = 0
+        state.flush()
+        del state
+
+    def test_create(self):
+        client = self.client()
+
+        votes = self.predict(client)
+
+        np.testing.assert_allclose(votes, self.expected, atol=1e-5)
+        self.assertEqual(client.resumed_tiles, 0)
+        self.assertIsNotNone(self.server.server.jobs.get(client.job_id))
+
+        client.finish()
+        self.assertIsNone(self.server.server.jobs.get(client.job_id))
+
+    def test_sink(self):
+        """С sink маски из состояния смешиваются полосами по порядку строк"""
+        votes = np.zeros_like(self.expected)
+        rows = []
+
+        def sink(row, strip):
+            rows.append(row)
+            votes[row:row + len(strip)] = strip
+
+        self.assertIsNone(self.predict(self.client(), sink=sink))
+
+        self.assertEqual(rows, sorted(rows))
+        np.testing.assert_allclose(votes / votes.sum(axis=2, keepdims=True), self.expected, atol=1e-5)
+
+    def test_interrupt_and_resume(self):
+        first = self.client()
+        with self.assertRaises(InferenceCancelled):
+            self.predict(first, cancel_check=cancel_after(10))
+
+        second = self.client()
+        votes = self.predict(second)
+
+        np.testing.assert_allclose(votes, self.expected, atol=1e-5)
+        self.assertGreaterEqual(second.resumed_tiles, 10)
+        self.assertEqual(second.job_id, first.job_id)
+
+    def test_resume_downloads_without_upload(self):
+        """Сервер хранит все патчи: при возобновлении ничего не загружается"""
+        self.predict(self.client())
+        self.forget_tiles(range(0, self.total, 2))
+
+        client = self.client()
+        votes = self.predict(client)
+
+        np.testing.assert_allclose(votes, self.expected, atol=1e-5)
+        self.assertEqual(client.stats.as_dict()['bytes_sent'], 0)
+        self.assertEqual(client.resumed_tiles, self.total - len(range(0, self.total, 2)))
+
+    def test_recreate_lost_job(self):
+        first = self.client()
+        self.predict(first)
+        self.server.server.jobs.delete(first.job_id)
+        forgotten = range(0, self.total, 3)
+        self.forget_tiles(forgotten)
+
+        client = self.client()
+        votes = self.predict(client)
+
+        np.testing.assert_allclose(votes, self.expected, atol=1e-5)
+        self.assertNotEqual(client.job_id, first.job_id)
+        # Загружены только недостающие патчи
+        self.assertEqual(client.stats.as_dict()['requests'], len(forgotten) * 2)
+
+
+
+class PruneJobStatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def state(self, name, age):
+        directory = os.path.join(self.root, name)
+        JobState(directory, 4, 8).flush()
+        stamp = time.time() - age
+        for entry in os.listdir(directory) + ['']:
+            os.utime(os.path.join(directory, entry), (stamp, stamp))
+        return directory
+
+    def test_old_states_removed(self):
+        old = self.state('old', 7200)
+        fresh = self.state('fresh', 60)
+        kept = self.state('kept', 7200)
+
+        prune_job_states(self.root, ttl=3600, keep=kept)
+
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.isdir(fresh))
+        self.assertTrue(os.path.isdir(kept))
+
+    def test_missing_root(self):
+        prune_job_states(os.path.join(self.root, 'missing'), ttl=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
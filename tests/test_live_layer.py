@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Планировщик тайлов живого слоя: один отправленный тайл, без отмены
+отправленных и без ожидания потока при остановке
+
+Вместо общего процесса инференса - заглушка, задания которой завершаются
+по команде теста. Нужен qgis (запуск из окружения QGIS, см. make test).
+"""
+import threading
+import time
+import unittest
+
+try:
+    from qgis.PyQt.QtCore import QCoreApplication
+    from utils.live_layer import LiveTileScheduler
+except ImportError:
+    LiveTileScheduler = None
+
+
+class FakeJob:
+    def __init__(self, params):
+        self.params = params
+        self.cancelled = False
+        self.released = threading.Event()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def messages(self):
+        self.released.wait()
+        yield {'type': 'result', 'metadata_path': ''}
+
+
+class FakeProcess:
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, params):
+        job = FakeJob(params)
+        self.jobs.append(job)
+        return job
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('условие не выполнено')
+        QCoreApplication.processEvents()
+        time.sleep(0.01)
+
+
+def tasks(*keys):
+    return [(key, {'output_path': f'{key}.tif'}) for key in keys]
+
+
+@unittest.skipIf(LiveTileScheduler is None, 'нужен qgis')
+class LiveTileSchedulerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QCoreApplication.instance() or QCoreApplication([])
+
+    def setUp(self):
+        self.scheduler = LiveTileScheduler('')
+        self.process = self.scheduler.process = FakeProcess()
+        self.ready = []
+        self.scheduler.tile_ready.connect(lambda key, path: self.ready.append(key))
+        self.scheduler.start()
+
+    def tearDown(self):
+        if self.scheduler.stopped:
+            return
+        finished = []
+        self.scheduler.stop(lambda: finished.append(True))
+        for job in self.process.jobs:
+            job.released.set()
+        wait_until(lambda: finished)
+
+    def test_one_tile_submitted(self):
+        self.scheduler.update(tasks('a', 'b', 'c'))
+        wait_until(lambda: self.process.jobs)
+        time.sleep(0.1)
+        self.assertEqual(len(self.process.jobs), 1)
+
+        self.process.jobs[0].released.set()
+        wait_until(lambda: len(self.process.jobs) == 2)
+        wait_until(lambda: self.ready == ['a'])
+        self.assertEqual(self.process.jobs[1].params['output_path'], 'b.tif')
+
+    def test_running_tile_is_not_cancelled(self):
+        self.scheduler.update(tasks('a', 'b'))
+        wait_until(lambda: self.process.jobs)
+
+        self.scheduler.update(tasks('c'))
+        self.assertFalse(self.process.jobs[0].cancelled)
+        self.assertEqual([key for key, _ in self.scheduler.pending], ['c'])
+
+        self.process.jobs[0].released.set()
+        wait_until(lambda: len(self.process.jobs) == 2)
+        self.assertEqual(self.process.jobs[1].params['output_path'], 'c.tif')
+
+    def test_stop_does_not_wait_for_running_tile(self):
+        self.scheduler.update(tasks('a', 'b'))
+        wait_until(lambda: self.process.jobs)
+        finished = []
+
+        started = time.monotonic()
+        self.scheduler.stop(lambda: finished.append(True))
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertFalse(finished)
+        self.assertFalse(self.process.jobs[0].cancelled)
+
+        self.process.jobs[0].released.set()
+        wait_until(lambda: finished)
+        self.assertEqual(self.ready, [])
+        self.assertEqual(len(self.process.jobs), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
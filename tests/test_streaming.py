@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Смешивание по полосам через RollingCanvas: локальное предсказание,
+потайловый API и потоковый ответ сервера-заглушки против predict_img_tiled
+"""
+import io
+import unittest
+
+import numpy as np
+import requests
+
+from config import DEFAULT_NUM_CLASSES, SEGMENTATION_COLORS
+from utils.api_client import TiledApiClient, TileRequestError, blend_tile_stream
+from utils.prediction import predict_img_streamed, predict_img_tiled
+from utils.wire_codecs import encode_chunks, frame_bytes, multipart_body
+
+from stand_in_server import StandInServer, expected_votes, make_image, soft_predict
+
+
+# Стороны не кратны шагу сетки; последняя - меньше окна
+SHAPES = [(700, 900), (300, 517), (100, 150)]
+
+
+class StripCollector:
+    """sink, собирающий полосы голосов в массив"""
+
+    def __init__(self, height, width):
+        self.votes = np.zeros((height, width, DEFAULT_NUM_CLASSES), dtype=np.float32)
+        self.next_row = 0
+
+    def __call__(self, row, votes):
+        # Полосы идут подряд, без пропусков и повторов
+        assert row == self.next_row, (row, self.next_row)
+        self.votes[row:row + len(votes)] = votes
+        self.next_row = row + len(votes)
+
+    def normalized(self):
+        """Голоса RollingCanvas не делятся на сумму весов, в отличие от BlendCanvas"""
+        return self.votes / self.votes.sum(axis=2, keepdims=True)
+
+
+class PredictStreamedTest(unittest.TestCase):
+
+    def test_matches_tiled_prediction(self):
+        for height, width in SHAPES:
+            for subdivisions in (1, 2):
+                with self.subTest(shape=(height, width), subdivisions=subdivisions):
+                    image = make_image(height, width)
+                    sink = StripCollector(height, width)
+
+                    predict_img_streamed(image, 256, subdivisions, DEFAULT_NUM_CLASSES, soft_predict, sink,
+                                         batch_size=5)
+
+                    self.assertEqual(sink.next_row, height)
+                    expected = predict_img_tiled(image, 256, subdivisions, DEFAULT_NUM_CLASSES, soft_predict)
+                    np.testing.assert_allclose(sink.normalized(), expected, atol=1e-5)
+
+
+class StreamedApiTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = None
+        self.client = None
+
+    def tearDown(self):
+        if self.client is not None:
+            self.client.close()
+        if self.server is not None:
+            self.server.close()
+
+    def test_tiled_client_sink(self):
+        """Ответы приходят не по порядку (повторы после 503), буфер - один патч"""
+        self.server = StandInServer(fail_every=4)
+        self.client = TiledApiClient(self.server.url, SEGMENTATION_COLORS, concurrency=4, retries=3,
+                                     timeout=30, backoff=0.01, codec_preference=('png',),
+                                     mask_codec_preference=('png',))
+        self.client.REORDER_BUFFER = 1
+        for height, width in SHAPES:
+            with self.subTest(shape=(height, width)):
+                image = make_image(height, width)
+                sink = StripCollector(height, width)
+
+                result = self.client.predict_tiled(image, 256, 2, DEFAULT_NUM_CLASSES, sink=sink)
+
+                self.assertIsNone(result)
+                self.assertEqual(sink.next_row, height)
+                np.testing.assert_allclose(sink.normalized(), expected_votes(image, 256, 2), atol=1e-5)
+
+    def test_server_stream(self):
+        self.server = StandInServer()
+        for height, width in SHAPES:
+            with self.subTest(shape=(height, width)):
+                image = make_image(height, width)
+                sinks = []
+
+                def open_sink(h, w):
+                    sinks.append(StripCollector(h, w))
+                    return sinks[-1]
+
+                body = multipart_body(encode_chunks(image, 'png'), 'png')
+                with requests.post(f'{self.server.url}/predict/', data=body,
+                                   headers={'Content-Type': body.content_type},
+                                   params={'patch_size': 256, 'subdivisions': 2,
+                                           'response_format': 'stream', 'response_codec': 'png'},
+                                   stream=True, timeout=30) as response:
+                    response.raise_for_status()
+                    done, received = blend_tile_stream(response, DEFAULT_NUM_CLASSES, open_sink)
+
+                self.assertEqual(len(sinks), 1)
+                self.assertEqual(sinks[0].next_row, height)
+                self.assertGreater(received, 0)
+                np.testing.assert_allclose(sinks[0].normalized(), expected_votes(image, 256, 2), atol=1e-5)
+
+    def test_stream_without_grid_frame(self):
+        response = requests.Response()
+        response.raw = io.BytesIO(frame_bytes({'type': 'end'}))
+
+        with self.assertRaisesRegex(TileRequestError, 'без кадра сетки'):
+            blend_tile_stream(response, DEFAULT_NUM_CLASSES, lambda h, w: None)
+
+
+if __name__ == '__main__':
+    unittest.main()
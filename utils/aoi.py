@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Область интереса (AOI): полигоны, внутри которых выполняется сегментация
+
+Полигоны приходят в параметрах задания как GeoJSON-геометрии в CRS растра
+вместе с номерами объектов слоя.
+Для отбора патчей они растеризуются на грубую сетку с all_touched, поэтому
+патч пропускается, только если в нем гарантированно нет пикселей AOI, и
+смешивание внутри AOI совпадает с обработкой без нее. Маска полной
+точности строится по полосам при записи результата: пиксели вне AOI
+получают nodata.
+"""
+import numpy as np
+
+
+class AoiMask:
+    """Растеризация AOI на сетку растра результата"""
+
+    # Наибольшая сторона грубой сетки для отбора патчей, ячеек
+    MAX_GRID = 2048
+
+    def __init__(self, geometries, transform, height, width, ids=None):
+        from rasterio.features import rasterize
+        from rasterio.transform import Affine
+
+        self.geometries = geometries
+        self.ids = ids if ids is not None else list(range(len(geometries)))
+        self.transform = transform
+        self.height = height
+        self.width = width
+        self.tiles_total = 0
+        self.tiles_kept = 0
+
+        # Ячейка грубой сетки - cell x cell пикселей
+        self.cell = max(1, -(-max(height, width) // self.MAX_GRID))
+        self.grid = rasterize(
+            geometries,
+            out_shape=(-(-height // self.cell), -(-width // self.cell)),
+            transform=transform * Affine.scale(self.cell),
+            all_touched=True,
+            dtype=np.uint8
+        ).astype(bool)
+
+    @classmethod
+    def from_params(cls, params, height, width):
+        """AOI задания для растра height x width, None если она не задана"""
+        aoi = params.get('aoi')
+        geo_data = params.get('georeference_data')
+        if not aoi or not geo_data:
+            return None
+
+        from rasterio.transform import from_bounds
+
+        transform = from_bounds(
+            geo_data['extent_xmin'],
+            geo_data['extent_ymin'],
+            geo_data['extent_xmax'],
+            geo_data['extent_ymax'],
+            width,
+            height
+        )
+        return cls(aoi['geometries'], transform, height, width, aoi.get('ids'))
+
+    def intersects(self, y, x, height, width):
+        """Есть ли в окне пиксели AOI (с запасом до ячейки сетки)"""
+        c = self.cell
+        return bool(self.grid[y // c:-(-(y + height) // c), x // c:-(-(x + width) // c)].any())
+
+    def tile_filter(self, window_size):
+        """Функция (y, x) -> bool для отбора патчей сетки"""
+        def keep(y, x):
+            self.tiles_total += 1
+            if self.intersects(y, x, window_size, window_size):
+                self.tiles_kept += 1
+                return True
+            return False
+        return keep
+
+    def labels(self, row, rows):
+        """Номера полигонов AOI с 1 для полосы строк (rows, W), 0 - вне AOI
+
+        Где полигоны перекрываются, пиксель относится к последнему.
+        """
+        from rasterio.features import rasterize
+        from rasterio.transform import Affine
+
+        return rasterize(
+            ((geometry, index + 1) for index, geometry in enumerate(self.geometries)),
+            out_shape=(rows, self.width),
+            transform=self.transform * Affine.translation(0, row),
+            dtype=np.int32
+        )
+
+    def as_dict(self):
+        return {
+            'tiles_total': self.tiles_total,
+            'tiles_skipped': self.tiles_total - self.tiles_kept,
+        }
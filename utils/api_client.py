@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Клиент API инференса с потайловой отправкой
+
+Изображение режется на патчи той же сеткой, что и в predict_img_tiled.
+Патчи отправляются параллельно через одну keep-alive сессию, каждый патч
+повторяется при сбое, ответы смешиваются локально. Сбой одного запроса
+больше не теряет всю обработку, а большие экстенты не упираются в таймаут
+одного запроса.
+
+Если сервер кэширует результаты, перед загрузкой патча проверяется кэш
+по хэшу пикселей (GET /result/<хэш>), и при попадании патч не отправляется.
+
+С sink ответы смешиваются по порядку строк через RollingCanvas, как в
+predict_img_streamed: готовые полосы сразу уходят в файл результата, а
+ответы, пришедшие раньше предыдущих патчей, ждут в ограниченном буфере.
+
+Отмена проверяется и во время ожидания ответов: отправленные запросы не
+дожидаются (каждый может идти timeout x число попыток), сессия закрывается,
+а повторы уже выполняющихся патчей прекращаются.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.prediction import compute_tile_coords, BlendCanvas, RollingCanvas
+from utils.wire_codecs import (
+    encode_chunks, decode, multipart_body, server_info, negotiate_codecs,
+    codec_for_content_type, iter_frames, TransferStats
+)
+from utils.result_cache import content_hash
+from utils.palette import rgb_to_mask
+
+
+class TileRequestError(Exception):
+    """Патч не обработан после всех попыток"""
+
+
+class TiledApiClient:
+    """Параллельная отправка патчей в API /predict/"""
+
+    # Как часто проверять отмену во время ожидания ответов, секунд
+    CANCEL_POLL_INTERVAL = 0.2
+    # Ответов, ожидающих предыдущие по порядку строк патчи (режим с sink)
+    REORDER_BUFFER = 64
+
+    def __init__(self, api_url, colors, concurrency=4, retries=3, timeout=60, backoff=0.5,
+                 codec_preference=('png',), mask_codec_preference=('png',), cache_precheck=True):
+        self.api_url = api_url.rstrip('/')
+        self.colors = np.array(colors, dtype=np.uint8)
+        self.concurrency = max(1, int(concurrency))
+        self.retries = max(0, int(retries))
+        self.timeout = timeout
+        self.backoff = backoff
+
+        # Пул соединений не меньше числа параллельных запросов,
+        # иначе лишние соединения закрываются после каждого ответа
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.concurrency,
+            max_retries=0
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        info = server_info(self.session, self.api_url)
+        self.codec, self.mask_codec = negotiate_codecs(info, codec_preference, mask_codec_preference)
+        self.cache_precheck = cache_precheck and bool(info.get('cache'))
+        self.stats = TransferStats(self.codec)
+        self._stopped = threading.Event()
+
+    def close(self):
+        self.session.close()
+
+    def abort(self):
+        """Прекращает повторы выполняющихся патчей и закрывает сессию"""
+        self._stopped.set()
+        self.session.close()
+
+    def predict_tiled(self, input_img, window_size, subdivisions, nb_classes,
+                      progress_callback=None, cancel_check=None, tile_filter=None, sink=None):
+        """Предсказание по патчам через API
+
+        Args:
+            input_img: изображение (H, W, 3) uint8 или источник со срезами
+            window_size, subdivisions: параметры сетки, как в predict_img_tiled
+            nb_classes: количество классов
+            progress_callback: функция (обработано, всего)
+            cancel_check: функция (обработано, всего), прерывает обработку
+            tile_filter: отбор патчей сетки, как в predict_img_tiled
+            sink: функция (строка, голоса), как в predict_img_streamed; с ней
+                голоса выдаются полосами и не собираются в массив
+
+        Returns:
+            numpy array с голосами классов (H, W, nb_classes), с sink - None
+        """
+        h, w = input_img.shape[:2]
+
+        # Изображение меньше окна - один дополненный патч
+        if h <= window_size and w <= window_size:
+            padded = np.zeros((window_size, window_size, 3), dtype=np.uint8)
+            padded[:h, :w] = input_img[:h, :w]
+            if cancel_check:
+                cancel_check(0, 1)
+            mask = self.predict_tile(padded)
+            if progress_callback:
+                progress_callback(1, 1)
+            votes = one_hot(mask, nb_classes)[:h, :w]
+            if sink is None:
+                return votes
+            sink(0, votes)
+            return None
+
+        coords, overlap = compute_tile_coords(h, w, window_size, subdivisions, tile_filter)
+        total = len(coords)
+        if sink is None:
+            canvas = BlendCanvas(h, w, nb_classes, window_size, overlap)
+            max_ahead = total
+        else:
+            # RollingCanvas принимает патчи по неубыванию строки
+            coords.sort()
+            canvas = RollingCanvas(h, w, nb_classes, window_size, overlap, sink)
+            max_ahead = self.concurrency * 2 + self.REORDER_BUFFER
+        done = 0
+
+        # В работе не больше двух патчей на поток, чтобы не держать
+        # в памяти все изображение
+        max_in_flight = self.concurrency * 2
+        pending = {}
+        next_index = 0
+        # Готовые маски патчей, которые еще не добавлены в холст
+        ready = {}
+        added = 0
+
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            while done < total:
+                while (next_index < total and len(pending) < max_in_flight
+                       and next_index - added < max_ahead):
+                    if cancel_check:
+                        cancel_check(done, total)
+                    y, x = coords[next_index]
+                    patch = np.ascontiguousarray(input_img[y:y+window_size, x:x+window_size])
+                    future = executor.submit(self.predict_tile, patch)
+                    pending[future] = next_index
+                    next_index += 1
+
+                finished, _ = wait(pending, timeout=self.CANCEL_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    index = pending.pop(future)
+                    mask = future.result()
+                    done += 1
+                    if sink is None:
+                        canvas.add(*coords[index], one_hot(mask, nb_classes))
+                    else:
+                        ready[index] = mask
+                while added in ready:
+                    canvas.add(*coords[added], one_hot(ready.pop(added), nb_classes))
+                    added += 1
+
+                if finished and progress_callback:
+                    progress_callback(done, total)
+                if cancel_check:
+                    cancel_check(done, total)
+        except BaseException:
+            # Отмена или сбой патча: выполняющиеся запросы не дожидаемся
+            self.abort()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown(wait=True)
+
+        if sink is None:
+            return canvas.result()
+        canvas.close()
+        return None
+
+    def predict_tile(self, patch):
+        """Отправляет один патч, возвращает маску классов (window, window)"""
+        api_params = {
+            'patch_size': patch.shape[0],
+            'subdivisions': 1,
+            'response_format': 'mask',
+            'response_codec': self.mask_codec
+        }
+
+        if self.cache_precheck:
+            response = fetch_cached(self.session, self.api_url, content_hash(patch),
+                                    api_params, self.timeout)
+            if response is not None:
+                self.stats.add(0, len(response.content), 0.0, cached=True)
+                return self._decode_mask(response, patch.shape[:2])
+
+        started = time.perf_counter()
+        chunks = encode_chunks(patch, self.codec)
+        encode_seconds = time.perf_counter() - started
+
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if attempt and self._stopped.wait(self.backoff * 2 ** (attempt - 1)):
+                break
+            body = multipart_body(chunks, self.codec, name='tile')
+            try:
+                response = self.session.post(
+                    f"{self.api_url}/predict/",
+                    data=body,
+                    headers={'Content-Type': body.content_type},
+                    params=api_params,
+                    timeout=self.timeout
+                )
+                # Ошибки клиента не исправятся повтором
+                if 400 <= response.status_code < 500:
+                    response.raise_for_status()
+                if response.status_code >= 500:
+                    last_error = f"HTTP {response.status_code}"
+                    continue
+                self.stats.add(len(body), len(response.content), encode_seconds)
+                return self._decode_mask(response, patch.shape[:2])
+            except (requests.ConnectionError, requests.Timeout) as e:
+                last_error = str(e)
+
+        raise TileRequestError(
+            f"Патч не обработан после {self.retries + 1} попыток: {last_error}"
+        )
+
+    def _decode_mask(self, response, shape):
+        """Маска классов из ответа API (RGB по палитре или индексы классов)"""
+        codec = codec_for_content_type(response.headers.get('Content-Type')) or 'png'
+        mask = decode_mask(response.content, codec, self.colors)
+
+        if mask.shape != tuple(shape):
+            raise TileRequestError(
+                f"Размер ответа {mask.shape} не совпадает с патчем {tuple(shape)}"
+            )
+        return mask
+
+
+def one_hot(mask, nb_classes):
+    """Голос классов патча для смешивания"""
+    return np.eye(nb_classes, dtype=np.float32)[np.minimum(mask, nb_classes - 1)]
+
+
+def fetch_cached(session, api_url, image_hash, params, timeout=10):
+    """Готовый результат из кэша сервера или None
+
+    Запрос без тела: изображение загружается только при промахе.
+    """
+    try:
+        response = session.get(
+            f"{api_url.rstrip('/')}/result/{image_hash}",
+            params=params,
+            timeout=timeout
+        )
+    except (requests.ConnectionError, requests.Timeout):
+        return None
+    return response if response.status_code == 200 else None
+
+
+def decode_mask(content, codec, colors):
+    """Маска классов из закодированного ответа
+
+    Одноканальный ответ (индексы, RLE или PNG с палитрой) используется
+    как есть, RGB от сервера без response_format=mask переводится
+    в индексы по цветам классов.
+    """
+    result = decode(content, codec)
+    if result.ndim == 2:
+        return result.astype(np.uint8, copy=False)
+    return rgb_to_mask(result, colors)
+
+
+def blend_tile_stream(response, nb_classes, open_sink, progress_callback=None, cancel_check=None):
+    """Смешивание потокового ответа /predict/ полосами через RollingCanvas
+
+    open_sink(высота, ширина) вызывается по кадру сетки и возвращает
+    sink(строка, голоса), как в predict_img_streamed. В памяти - только
+    полоса результата высотой в окно.
+
+    Returns:
+        (число патчей, получено байт)
+
+    Raises:
+        TileRequestError: ошибка сервера, оборванный поток или поток без кадра сетки
+    """
+    canvas = None
+    done = total = received = 0
+    for header, prediction in iter_tile_frames(response, nb_classes):
+        received += header.get('length', 0)
+        if prediction is None:
+            total = header['tiles']
+            sink = open_sink(header['height'], header['width'])
+            canvas = RollingCanvas(header['height'], header['width'], nb_classes,
+                                   header['window'], header['overlap'], sink)
+            continue
+        if canvas is None:
+            raise TileRequestError("Патч в потоке ответа до кадра сетки")
+
+        canvas.add(header['y'], header['x'], prediction)
+        done += 1
+        if progress_callback:
+            progress_callback(done, total)
+        if cancel_check:
+            cancel_check(done, total)
+
+    if canvas is None:
+        raise TileRequestError("Поток ответа без кадра сетки")
+    canvas.close()
+    return done, received
+
+
+def iter_tile_frames(response, nb_classes):
+    """Кадры потокового ответа /predict/ (response_format=stream)
+
+    Первым отдается кадр с размерами растра и сеткой (предсказание None),
+    затем кадры патчей с голосами классов (window, window, nb_classes).
+    Кадр ошибки сервера и оборванный поток поднимают TileRequestError.
+    """
+    for header, payload in iter_frames(response.raw):
+        kind = header.get('type')
+        if kind == 'end':
+            return
+        if kind == 'error':
+            raise TileRequestError(f"Ошибка сервера: {header.get('detail')}")
+        if kind != 'tile':
+            yield header, None
+            continue
+
+        array = decode(payload, header['codec'])
+        if header.get('content') == 'probs':
+            prediction = array.astype(np.float32) / 255.0
+        else:
+            prediction = one_hot(array, nb_classes)
+        yield header, prediction
+
+    raise TileRequestError("Поток ответа оборван до последнего патча")
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Пакетная сегментация каталога снимков без QGIS
+
+Запуск из окружения плагина:
+    python utils/batch_cli.py scenes/ "extra/*.tif" -o results/
+
+Для каждого снимка пишется геопривязанная маска, по всем маскам строится
+VRT-мозаика. Уже обработанные снимки пропускаются, модель загружается один раз.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+PLUGIN_DIR = os.environ.get('PLUGIN_DIR', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if PLUGIN_DIR not in sys.path:
+    sys.path.insert(0, PLUGIN_DIR)
+
+from config import (DEFAULT_PATCH_SIZE, DEFAULT_SUBDIVISIONS, DEFAULT_BATCH_SIZE, SEGMENTATION_COLORS,
+                    CLASS_NAMES, MODEL_GSD, VECTOR_SIMPLIFY, VECTOR_MIN_AREA)
+from utils.inference_runner import InferenceRunner
+from utils.ipc import Telemetry
+from utils.vrt import build_vrt_mosaic
+
+
+SCENE_EXTENSIONS = ('.tif', '.tiff', '.jp2', '.img', '.vrt')
+
+
+def collect_scenes(inputs):
+    """Раскрывает пути, каталоги и glob-шаблоны в список снимков"""
+    scenes = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                scenes.extend(
+                    os.path.join(root, name) for name in files
+                    if name.lower().endswith(SCENE_EXTENSIONS)
+                )
+        elif any(char in item for char in '*?['):
+            scenes.extend(glob.glob(item, recursive=True))
+        else:
+            scenes.append(item)
+
+    unique = []
+    seen = set()
+    for path in scenes:
+        path = os.path.abspath(path)
+        if path not in seen and os.path.isfile(path):
+            seen.add(path)
+            unique.append(path)
+    return sorted(unique)
+
+
+def output_path_for(scene, output_dir):
+    """Путь к маске снимка"""
+    stem = os.path.splitext(os.path.basename(scene))[0]
+    return os.path.join(output_dir, f"{stem}_segmentation.tif")
+
+
+def is_done(output_path):
+    """Снимок обработан, если записаны и маска, и метаданные"""
+    metadata_path = output_path.replace('.tif', '_metadata.json')
+    return os.path.exists(output_path) and os.path.exists(metadata_path)
+
+
+def scene_params(scene, output_path, args):
+    """Параметры инференса для одного снимка"""
+    import rasterio
+
+    with rasterio.open(scene) as src:
+        bounds = src.bounds
+        crs = src.crs.to_wkt() if src.crs else None
+
+    return {
+        'input_path': None,
+        'input_source': {'path': scene, 'window': None},
+        'output_path': output_path,
+        'use_api': False,
+        'model_path': args.model,
+        'patch_size': args.patch_size,
+        'subdivisions': args.subdivisions,
+        'batch_size': args.batch_size,
+        'target_gsd': MODEL_GSD if args.gsd == 'model' else args.gsd,
+        'output_confidence': args.confidence,
+        'output_probabilities': args.probabilities,
+        'output_vector': args.vector,
+        'vector_simplify': args.simplify,
+        'vector_min_area': args.min_area,
+        'crs': crs,
+        'georeference_data': {
+            'extent_xmin': bounds.left,
+            'extent_xmax': bounds.right,
+            'extent_ymin': bounds.bottom,
+            'extent_ymax': bounds.top,
+            'crs': crs
+        }
+    }
+
+
+def build_mosaic(output_paths, vrt_path):
+    """VRT-мозаика из масок с одинаковой системой координат"""
+    import rasterio
+
+    sources = []
+    mosaic_crs = None
+    for path in output_paths:
+        with rasterio.open(path) as src:
+            crs = src.crs.to_wkt() if src.crs else ''
+            if mosaic_crs is None:
+                mosaic_crs = crs
+            elif crs != mosaic_crs:
+                print(f"  пропущен в мозаике (другая СК): {path}")
+                continue
+            sources.append({
+                'path': path,
+                'width': src.width,
+                'height': src.height,
+                'bounds': tuple(src.bounds),
+            })
+
+    if not sources:
+        return None
+    return build_vrt_mosaic(vrt_path, sources, mosaic_crs, colors=SEGMENTATION_COLORS,
+                            class_names=CLASS_NAMES[:len(SEGMENTATION_COLORS)])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Пакетная сегментация снимков с построением VRT-мозаики"
+    )
+    parser.add_argument('inputs', nargs='+', help="Файлы, каталоги или glob-шаблоны")
+    parser.add_argument('-o', '--output-dir', required=True, help="Каталог для масок")
+    parser.add_argument('--model', default=os.path.join(PLUGIN_DIR, 'models', 'best_model.h5'),
+                        help="Файл модели")
+    parser.add_argument('--patch-size', type=int, default=DEFAULT_PATCH_SIZE)
+    parser.add_argument('--subdivisions', type=int, default=DEFAULT_SUBDIVISIONS)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--gsd', type=lambda value: value if value == 'model' else float(value),
+                        default=None,
+                        help="Разрешение обработки в единицах CRS на пиксель или 'model' (MODEL_GSD)")
+    parser.add_argument('--confidence', action='store_true',
+                        help="Сохранять растр уверенности модели рядом с маской")
+    parser.add_argument('--probabilities', action='store_true',
+                        help="Сохранять вероятности классов в uint8 рядом с маской")
+    parser.add_argument('--vector', action='store_true',
+                        help="Сохранять полигоны классов в GeoPackage рядом с маской")
+    parser.add_argument('--simplify', type=float, default=VECTOR_SIMPLIFY,
+                        help="Допуск упрощения полигонов в единицах карты")
+    parser.add_argument('--min-area', type=float, default=VECTOR_MIN_AREA,
+                        help="Минимальная площадь полигона в единицах карты")
+    parser.add_argument('--mosaic', default=None,
+                        help="Путь к VRT-мозаике (по умолчанию <output-dir>/mosaic.vrt)")
+    parser.add_argument('--overwrite', action='store_true',
+                        help="Обработать заново уже сегментированные снимки")
+    args = parser.parse_args(argv)
+    if args.gsd == 'model' and MODEL_GSD is None:
+        parser.error("--gsd model: разрешение обучения модели не задано (MODEL_GSD в config.py)")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    scenes = collect_scenes(args.inputs)
+    if not scenes:
+        print("Снимки не найдены")
+        return 1
+
+    from utils.model_loader import load_model
+
+    # Модель загружается один раз и переиспользуется для всех снимков
+    started = time.perf_counter()
+    pending = [s for s in scenes if args.overwrite or not is_done(output_path_for(s, args.output_dir))]
+    if pending:
+        load_model(args.model)
+    model_seconds = time.perf_counter() - started
+
+    processed, skipped, failed = [], [], []
+    total_pixels = 0
+    total_tiles = 0
+    compute_seconds = 0.0
+
+    for index, scene in enumerate(scenes, 1):
+        output_path = output_path_for(scene, args.output_dir)
+        prefix = f"[{index}/{len(scenes)}] {os.path.basename(scene)}"
+
+        if not args.overwrite and is_done(output_path):
+            skipped.append(output_path)
+            print(f"{prefix}: уже обработан")
+            continue
+
+        telemetry = Telemetry()
+        scene_started = time.perf_counter()
+        try:
+            params = scene_params(scene, output_path, args)
+            metadata_path = InferenceRunner(params, telemetry).run_local()
+        except Exception as e:
+            failed.append(scene)
+            print(f"{prefix}: ошибка - {e}")
+            continue
+
+        seconds = time.perf_counter() - scene_started
+        with open(metadata_path, 'r') as f:
+            metadata = json.load(f)
+
+        import rasterio
+        with rasterio.open(output_path) as src:
+            pixels = src.width * src.height
+
+        processed.append(output_path)
+        total_pixels += pixels
+        total_tiles += telemetry.tiles_total
+        compute_seconds += seconds
+        print(
+            f"{prefix}: {pixels / 1e6:.1f} Мпикс, {telemetry.tiles_total} тайлов "
+            f"за {seconds:.1f} с ({metadata.get('timings', {})})"
+        )
+
+    # Мозаика из всех готовых масок, включая пропущенные
+    outputs = [path for path in processed + skipped if os.path.exists(path)]
+    mosaic_path = args.mosaic or os.path.join(args.output_dir, 'mosaic.vrt')
+    if outputs:
+        size = build_mosaic(sorted(outputs), mosaic_path)
+        if size:
+            print(f"Мозаика: {mosaic_path} ({size[0]}x{size[1]})")
+
+    # Сводка производительности
+    total_seconds = time.perf_counter() - started
+    print("-" * 60)
+    print(f"Обработано: {len(processed)}, пропущено: {len(skipped)}, ошибок: {len(failed)}")
+    print(f"Загрузка модели: {model_seconds:.1f} с, всего: {total_seconds:.1f} с")
+    if compute_seconds > 0:
+        print(
+            f"Производительность: {total_pixels / 1e6 / compute_seconds:.2f} Мпикс/с, "
+            f"{total_tiles / compute_seconds:.2f} тайл/с, "
+            f"{len(processed) / compute_seconds * 3600:.1f} снимков/ч"
+        )
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Параллельная загрузка блоков растра для провайдеров, недоступных GDAL напрямую
+(WMS, XYZ, WCS и т.п.)
+
+Блоки запрашиваются через QgsRasterDataProvider.block на клонах провайдера
+и пишутся в сырой файл (H, W, C) по мере готовности. О каждом готовом блоке
+дописывается строка в индексный файл, поэтому процесс инференса может
+начинать обработку до окончания загрузки.
+"""
+import os
+import json
+import queue
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from qgis.core import Qgis, QgsRasterDataProvider, QgsRectangle
+
+
+# Соответствие типов данных QGIS и numpy
+QGIS_DTYPES = {
+    Qgis.Byte: 'uint8',
+    Qgis.UInt16: 'uint16',
+    Qgis.Int16: 'int16',
+    Qgis.UInt32: 'uint32',
+    Qgis.Int32: 'int32',
+    Qgis.Float32: 'float32',
+    Qgis.Float64: 'float64',
+}
+
+ARGB_TYPES = (Qgis.ARGB32, Qgis.ARGB32_Premultiplied)
+
+
+class BlockStreamExporter:
+    """Потоковый экспорт экстента слоя блоками в несколько потоков"""
+
+    def __init__(self, layer, extent, width, height, block_size=512, max_workers=4):
+        self.layer = layer
+        self.extent = QgsRectangle(extent)
+        self.width = int(width)
+        self.height = int(height)
+        self.block_size = block_size
+        self.max_workers = max_workers
+
+        provider = layer.dataProvider()
+        data_type = provider.dataType(1)
+        if data_type in ARGB_TYPES:
+            self.argb = True
+            self.dtype = 'uint8'
+        elif data_type in QGIS_DTYPES:
+            self.argb = False
+            self.dtype = QGIS_DTYPES[data_type]
+        else:
+            raise ValueError(f"Неподдерживаемый тип данных растра: {data_type}")
+
+        self.bands = [1, 2, 3] if provider.bandCount() >= 3 else [1]
+        self.units_per_pixel_x = self.extent.width() / self.width
+        self.units_per_pixel_y = self.extent.height() / self.height
+
+        self.temp_dir = None
+        self.data_path = None
+        self.index_path = None
+        self.blocks_total = 0
+        self.blocks_done = 0
+        self.error = None
+
+        self._array = None
+        self._executor = None
+        self._providers = queue.Queue()
+        self._lock = threading.Lock()
+        self._cancelled = False
+
+    @staticmethod
+    def estimate_size(layer, extent, fallback_units_per_pixel, target_gsd=None):
+        """Размер экспорта в пикселях для экстента
+
+        Для провайдеров без собственного разрешения (WMS, XYZ) используется
+        разрешение карты. target_gsd огрубляет разрешение: блоки
+        запрашиваются у провайдера уже уменьшенными.
+        """
+        provider = layer.dataProvider()
+        if provider.capabilities() & QgsRasterDataProvider.Size:
+            units_x = layer.rasterUnitsPerPixelX()
+            units_y = layer.rasterUnitsPerPixelY()
+        else:
+            units_x = units_y = fallback_units_per_pixel
+        if target_gsd:
+            units_x = max(units_x, target_gsd)
+            units_y = max(units_y, target_gsd)
+
+        width = max(1, int(round(extent.width() / units_x)))
+        height = max(1, int(round(extent.height() / units_y)))
+        return width, height
+
+    def input_source(self):
+        """Описание потокового источника для параметров инференса"""
+        return {
+            'type': 'stream',
+            'path': self.data_path,
+            'index': self.index_path,
+            'width': self.width,
+            'height': self.height,
+            'bands': 3 if self.argb else len(self.bands),
+            'dtype': self.dtype,
+            'block_size': self.block_size,
+        }
+
+    def start(self):
+        """Создает файлы потока и запускает загрузку блоков"""
+        self.temp_dir = tempfile.mkdtemp(prefix='segmentation_stream_')
+        self.data_path = os.path.join(self.temp_dir, 'input.raw')
+        self.index_path = os.path.join(self.temp_dir, 'input.idx')
+
+        channels = 3 if self.argb else len(self.bands)
+        self._array = np.memmap(
+            self.data_path, mode='w+', dtype=self.dtype,
+            shape=(self.height, self.width, channels)
+        )
+        open(self.index_path, 'w').close()
+
+        # Клоны провайдера создаются в основном потоке
+        provider = self.layer.dataProvider()
+        for _ in range(self.max_workers):
+            self._providers.put(provider.clone())
+
+        # Блоки ставятся в очередь построчно, в порядке обхода тайлов
+        blocks = [
+            (x, y)
+            for y in range(0, self.height, self.block_size)
+            for x in range(0, self.width, self.block_size)
+        ]
+        self.blocks_total = len(blocks)
+
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        for x, y in blocks:
+            self._executor.submit(self._fetch_block, x, y)
+        self._executor.shutdown(wait=False)
+
+    def cancel(self):
+        """Останавливает загрузку оставшихся блоков"""
+        self._cancelled = True
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def cleanup(self):
+        """Удаляет временные файлы потока"""
+        self.cancel()
+        self._array = None
+        if self.temp_dir and os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def _fetch_block(self, x, y):
+        if self._cancelled or self.error:
+            return
+
+        width = min(self.block_size, self.width - x)
+        height = min(self.block_size, self.height - y)
+        xmin = self.extent.xMinimum() + x * self.units_per_pixel_x
+        ymax = self.extent.yMaximum() - y * self.units_per_pixel_y
+        block_extent = QgsRectangle(
+            xmin,
+            ymax - height * self.units_per_pixel_y,
+            xmin + width * self.units_per_pixel_x,
+            ymax
+        )
+
+        provider = self._providers.get()
+        try:
+            data = self._read_block(provider, block_extent, width, height)
+            self._array[y:y + height, x:x + width] = data
+            self._array.flush()
+            self._append_index({'x': x, 'y': y, 'width': width, 'height': height})
+        except Exception as e:
+            self.error = str(e)
+            self._append_index({'error': self.error})
+        finally:
+            self._providers.put(provider)
+
+    def _read_block(self, provider, block_extent, width, height):
+        """Читает блок в массив (H, W, C)"""
+        if self.argb:
+            block = provider.block(1, block_extent, width, height)
+            bgra = np.frombuffer(bytes(block.data()), dtype=np.uint8).reshape(height, width, 4)
+            return bgra[:, :, [2, 1, 0]]
+
+        channels = []
+        for band in self.bands:
+            block = provider.block(band, block_extent, width, height)
+            channels.append(
+                np.frombuffer(bytes(block.data()), dtype=self.dtype).reshape(height, width)
+            )
+        return np.stack(channels, axis=2)
+
+    def _append_index(self, record):
+        with self._lock:
+            if 'error' not in record:
+                self.blocks_done += 1
+            with open(self.index_path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+                if self.blocks_done == self.blocks_total:
+                    f.write(json.dumps({'done': True}) + '\n')
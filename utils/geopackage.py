@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Запись полигонов в GeoPackage без GDAL/OGR
+
+В окружении subprocess нет OGR и fiona, поэтому файл собирается через
+sqlite3 по спецификации OGC GeoPackage 1.2: служебные таблицы, таблица
+объектов с геометрией MULTIPOLYGON (заголовок GP + WKB) и пространственный
+индекс R-tree. Объекты вставляются пачками в одной транзакции на пачку.
+Триггеры индекса создаются при закрытии: при массовой записи индекс
+заполняется напрямую, а функции ST_* в триггерах регистрирует GDAL при
+последующем редактировании слоя.
+"""
+import os
+import sqlite3
+import struct
+
+import numpy as np
+
+
+# 'GPKG' и версия 1.2.0
+APPLICATION_ID = 0x47504B47
+USER_VERSION = 10200
+
+# srs_id для CRS без кода EPSG (коды пользователя начинаются с 100000)
+CUSTOM_SRS_ID = 100000
+
+# Обязательная по спецификации запись WGS 84 в gpkg_spatial_ref_sys
+WGS84_SRS = (
+    'WGS 84 geodetic', 4326, 'EPSG', 4326,
+    'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,'
+    'AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],'
+    'PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],'
+    'UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],'
+    'AXIS["Latitude",NORTH],AXIS["Longitude",EAST],AUTHORITY["EPSG","4326"]]',
+    'longitude/latitude coordinates in decimal degrees on the WGS 84 spheroid',
+)
+
+_RTREE_VALUES = 'VALUES (NEW.fid, ST_MinX(NEW.geom), ST_MaxX(NEW.geom), ST_MinY(NEW.geom), ST_MaxY(NEW.geom))'
+
+_RTREE_TRIGGERS = [
+    ('insert', 'AFTER INSERT ON "{t}" WHEN (NEW.geom NOT NULL AND NOT ST_IsEmpty(NEW.geom))',
+     'INSERT OR REPLACE INTO "{r}" ' + _RTREE_VALUES + ';'),
+    ('update1', 'AFTER UPDATE OF geom ON "{t}" WHEN OLD.fid = NEW.fid AND '
+                '(NEW.geom NOTNULL AND NOT ST_IsEmpty(NEW.geom))',
+     'INSERT OR REPLACE INTO "{r}" ' + _RTREE_VALUES + ';'),
+    ('update2', 'AFTER UPDATE OF geom ON "{t}" WHEN OLD.fid = NEW.fid AND '
+                '(NEW.geom ISNULL OR ST_IsEmpty(NEW.geom))',
+     'DELETE FROM "{r}" WHERE id = OLD.fid;'),
+    ('update3', 'AFTER UPDATE ON "{t}" WHEN OLD.fid != NEW.fid AND '
+                '(NEW.geom NOTNULL AND NOT ST_IsEmpty(NEW.geom))',
+     'DELETE FROM "{r}" WHERE id = OLD.fid; INSERT OR REPLACE INTO "{r}" ' + _RTREE_VALUES + ';'),
+    ('update4', 'AFTER UPDATE ON "{t}" WHEN OLD.fid != NEW.fid AND '
+                '(NEW.geom ISNULL OR ST_IsEmpty(NEW.geom))',
+     'DELETE FROM "{r}" WHERE id IN (OLD.fid, NEW.fid);'),
+    ('delete', 'AFTER DELETE ON "{t}" WHEN OLD.geom NOT NULL',
+     'DELETE FROM "{r}" WHERE id = OLD.fid;'),
+]
+
+
+class GeoPackageWriter:
+    """Слой полигонов с атрибутами class, name, area"""
+
+    # Объектов в одной транзакции
+    BATCH_SIZE = 1000
+
+    def __init__(self, path, table='segments', crs=None):
+        """
+        Args:
+            path: путь к .gpkg (существующий файл перезаписывается)
+            table: имя слоя
+            crs: CRS в WKT или любом виде, понятном rasterio
+        """
+        self.path = path
+        self.table = table
+        self.rtree = f'rtree_{table}_geom'
+        self.rows = []
+        self.index_rows = []
+        self.count = 0
+        self.bounds = None
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(f'PRAGMA application_id = {APPLICATION_ID}')
+        self.connection.execute(f'PRAGMA user_version = {USER_VERSION}')
+        self.srs_id = self._create_tables(crs)
+
+    def add(self, polygons, value, name, area):
+        """Добавляет объект MultiPolygon
+
+        Args:
+            polygons: список полигонов, полигон - список колец (n, 2) в координатах карты,
+                первое кольцо внешнее
+            value: номер класса
+            name: имя класса
+            area: площадь в единицах карты
+        """
+        exteriors = np.concatenate([rings[0] for rings in polygons])
+        minx, miny = exteriors.min(axis=0)
+        maxx, maxy = exteriors.max(axis=0)
+        envelope = (float(minx), float(maxx), float(miny), float(maxy))
+
+        self.count += 1
+        self.rows.append((self.count, self._geometry(polygons, envelope), int(value), name, float(area)))
+        self.index_rows.append((self.count,) + envelope)
+        if self.bounds is None:
+            self.bounds = list(envelope)
+        else:
+            self.bounds = [min(self.bounds[0], envelope[0]), max(self.bounds[1], envelope[1]),
+                           min(self.bounds[2], envelope[2]), max(self.bounds[3], envelope[3])]
+        if len(self.rows) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Записывает накопленные объекты одной транзакцией"""
+        if not self.rows:
+            return
+        with self.connection:
+            self.connection.executemany(
+                f'INSERT INTO "{self.table}" (fid, geom, class, name, area) VALUES (?, ?, ?, ?, ?)',
+                self.rows
+            )
+            self.connection.executemany(f'INSERT INTO "{self.rtree}" VALUES (?, ?, ?, ?, ?)', self.index_rows)
+        self.rows = []
+        self.index_rows = []
+
+    def close(self):
+        """Дописывает объекты, экстент слоя и триггеры индекса"""
+        if self.connection is None:
+            return
+        self.flush()
+        with self.connection:
+            if self.bounds is not None:
+                minx, maxx, miny, maxy = self.bounds
+                self.connection.execute(
+                    "UPDATE gpkg_contents SET min_x = ?, min_y = ?, max_x = ?, max_y = ?, "
+                    "last_change = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') WHERE table_name = ?",
+                    (minx, miny, maxx, maxy, self.table)
+                )
+            for suffix, when, body in _RTREE_TRIGGERS:
+                self.connection.execute(
+                    f'CREATE TRIGGER "{self.rtree}_{suffix}" {when.format(t=self.table)} '
+                    f'BEGIN {body.format(r=self.rtree)} END'
+                )
+        self.connection.close()
+        self.connection = None
+
+    def abort(self):
+        """Закрывает и удаляет файл"""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _geometry(self, polygons, envelope):
+        """Геометрия GeoPackage: заголовок GP с конвертом XY и WKB MultiPolygon"""
+        # Версия 0, флаги: little endian, конверт [minx, maxx, miny, maxy]
+        parts = [struct.pack('<2sBBi4d', b'GP', 0, 0b011, self.srs_id, *envelope),
+                 struct.pack('<BII', 1, 6, len(polygons))]
+        for rings in polygons:
+            parts.append(struct.pack('<BII', 1, 3, len(rings)))
+            for ring in rings:
+                parts.append(struct.pack('<I', len(ring)))
+                parts.append(np.ascontiguousarray(ring, dtype='<f8').tobytes())
+        return b''.join(parts)
+
+    def _create_tables(self, crs):
+        """Служебные таблицы, таблица объектов и индекс; возвращает srs_id слоя"""
+        srs_id, organization, code, definition = _srs(crs)
+        with self.connection:
+            self.connection.executescript(f"""
+                CREATE TABLE gpkg_spatial_ref_sys (
+                    srs_name TEXT NOT NULL,
+                    srs_id INTEGER NOT NULL PRIMARY KEY,
+                    organization TEXT NOT NULL,
+                    organization_coordsys_id INTEGER NOT NULL,
+                    definition TEXT NOT NULL,
+                    description TEXT
+                );
+                CREATE TABLE gpkg_contents (
+                    table_name TEXT NOT NULL PRIMARY KEY,
+                    data_type TEXT NOT NULL,
+                    identifier TEXT UNIQUE,
+                    description TEXT DEFAULT '',
+                    last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+                    min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE,
+                    srs_id INTEGER,
+                    CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id)
+                );
+                CREATE TABLE gpkg_geometry_columns (
+                    table_name TEXT NOT NULL,
+                    column_name TEXT NOT NULL,
+                    geometry_type_name TEXT NOT NULL,
+                    srs_id INTEGER NOT NULL,
+                    z TINYINT NOT NULL,
+                    m TINYINT NOT NULL,
+                    CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name),
+                    CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name),
+                    CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id)
+                );
+                CREATE TABLE gpkg_extensions (
+                    table_name TEXT,
+                    column_name TEXT,
+                    extension_name TEXT NOT NULL,
+                    definition TEXT NOT NULL,
+                    scope TEXT NOT NULL,
+                    CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name)
+                );
+                CREATE TABLE "{self.table}" (
+                    fid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                    geom MULTIPOLYGON,
+                    class INTEGER,
+                    name TEXT,
+                    area REAL
+                );
+                CREATE VIRTUAL TABLE "{self.rtree}" USING rtree(id, minx, maxx, miny, maxy);
+            """)
+            self.connection.executemany('INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)', [
+                ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', None),
+                ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', None),
+                WGS84_SRS,
+            ])
+            if srs_id not in (-1, 0, WGS84_SRS[1]):
+                self.connection.execute(
+                    'INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)',
+                    (definition.split('"')[1] if '"' in definition else 'Unknown', srs_id,
+                     organization, code, definition, None)
+                )
+            self.connection.execute(
+                "INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) "
+                "VALUES (?, 'features', ?, ?)",
+                (self.table, self.table, srs_id)
+            )
+            self.connection.execute(
+                "INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', 'MULTIPOLYGON', ?, 0, 0)",
+                (self.table, srs_id)
+            )
+            self.connection.execute(
+                "INSERT INTO gpkg_extensions VALUES (?, 'geom', 'gpkg_rtree_index', "
+                "'http://www.geopackage.org/spec120/#extension_rtree', 'write-only')",
+                (self.table,)
+            )
+        return srs_id
+
+
+def _srs(crs):
+    """srs_id, организация, код и WKT определения CRS"""
+    if not crs:
+        return -1, 'NONE', -1, 'undefined'
+
+    from rasterio.crs import CRS
+
+    crs = CRS.from_user_input(crs)
+    definition = crs.to_wkt()
+    epsg = crs.to_epsg()
+    if epsg:
+        return epsg, 'EPSG', epsg, definition
+    return CUSTOM_SRS_ID, 'NONE', CUSTOM_SRS_ID, definition
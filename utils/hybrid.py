@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Гибридный инференс: локальная модель и API над одной очередью патчей
+
+Сетка патчей та же, что и в predict_img_tiled. Локальная модель берет
+патчи батчами из начала очереди, запросы к API - по одному с конца, каждая
+сторона забирает работу в своем темпе. Патч, не обработанный API после всех
+повторов, возвращается в очередь только для локальной модели. Когда очередь
+пуста, а локальная модель простаивает, она перехватывает патчи, которые API
+обрабатывает дольше локального батча: побеждает первый результат, второй
+отбрасывается. Все результаты смешиваются в одном холсте голосами one-hot:
+API возвращает только маски классов, поэтому и вероятности локальной
+модели сводятся к классу, иначе в перекрытиях результат зависел бы от того,
+какая сторона обработала патч.
+
+Чтение патчей идет только из управляющего потока, поэтому источником может
+быть и растр с чтением по окнам.
+"""
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+from utils.api_client import one_hot
+from utils.prediction import compute_tile_coords, BlendCanvas, predict_img_tiled
+
+
+class HybridExecutor:
+    """Распределение патчей между локальной моделью и API"""
+
+    # Ожидание, пока нечего запускать: проверка медленных патчей API
+    POLL_INTERVAL = 0.1
+    # После стольких подряд неудачных патчей API отключается до конца обработки
+    MAX_API_FAILURES = 3
+
+    def __init__(self, pred_func, client, batch_size=16):
+        """
+        Args:
+            pred_func: локальная функция предсказания, как в predict_img_tiled
+            client: TiledApiClient для отправки патчей
+            batch_size: патчей в одном вызове pred_func
+        """
+        self.pred_func = pred_func
+        self.client = client
+        self.batch_size = max(1, int(batch_size))
+        self.counts = {'local': 0, 'api': 0, 'stolen': 0, 'api_failed': 0}
+
+    def predict(self, input_img, window_size, subdivisions, nb_classes,
+                progress_callback=None, cancel_check=None, tile_filter=None):
+        """Предсказание по патчам двумя сторонами
+
+        Returns:
+            numpy array с предсказаниями (H, W, nb_classes)
+        """
+        h, w = input_img.shape[:2]
+        if h <= window_size and w <= window_size:
+            self.counts['local'] += 1
+            return predict_img_tiled(input_img, window_size, subdivisions, nb_classes,
+                                     self.pred_func, progress_callback=progress_callback,
+                                     cancel_check=cancel_check)
+
+        coords, overlap = compute_tile_coords(h, w, window_size, subdivisions, tile_filter)
+        canvas = BlendCanvas(h, w, nb_classes, window_size, overlap)
+        total = len(coords)
+        done = bytearray(total)
+        done_count = 0
+
+        queue = deque(range(total))
+        # Патчи, которые API не обработал: только локально
+        local_only = deque()
+        remote = {}
+        remote_started = {}
+        local = None
+        local_indices = []
+        local_seconds = None
+        api_enabled = True
+        api_failures = 0
+        max_in_flight = self.client.concurrency * 2
+
+        local_executor = ThreadPoolExecutor(max_workers=1)
+        remote_executor = ThreadPoolExecutor(max_workers=self.client.concurrency)
+
+        def read(index):
+            y, x = coords[index]
+            return np.ascontiguousarray(input_img[y:y+window_size, x:x+window_size])
+
+        def accept(index, prediction):
+            nonlocal done_count
+            if done[index]:
+                return False
+            y, x = coords[index]
+            canvas.add(y, x, prediction)
+            done[index] = 1
+            done_count += 1
+            return True
+
+        try:
+            while done_count < total:
+                if cancel_check:
+                    cancel_check(done_count, total)
+
+                while api_enabled and queue and len(remote) < max_in_flight:
+                    index = queue.pop()
+                    if done[index]:
+                        continue
+                    remote[remote_executor.submit(self.client.predict_tile, read(index))] = index
+                    remote_started[index] = time.perf_counter()
+
+                if local is None:
+                    local_indices = self._take_local(local_only, queue, done)
+                    if not local_indices and local_seconds is not None:
+                        local_indices = self._steal(remote_started, done, local_seconds)
+                        self.counts['stolen'] += len(local_indices)
+                    if local_indices:
+                        patches = np.array([read(index) for index in local_indices])
+                        local = local_executor.submit(self._timed, patches)
+
+                pending = list(remote) + ([local] if local is not None else [])
+                finished, _ = wait(pending, timeout=self.POLL_INTERVAL, return_when=FIRST_COMPLETED)
+
+                for future in finished:
+                    if future is local:
+                        predictions, seconds = future.result()
+                        local_seconds = seconds
+                        votes = one_hot(np.argmax(predictions, axis=-1), nb_classes)
+                        for index, prediction in zip(local_indices, votes):
+                            if accept(index, prediction):
+                                self.counts['local'] += 1
+                        local = None
+                        continue
+
+                    index = remote.pop(future)
+                    remote_started.pop(index, None)
+                    try:
+                        mask = future.result()
+                    except Exception:
+                        self.counts['api_failed'] += 1
+                        api_failures += 1
+                        if api_failures >= self.MAX_API_FAILURES:
+                            api_enabled = False
+                        if not done[index]:
+                            local_only.append(index)
+                        continue
+
+                    api_failures = 0
+                    if accept(index, one_hot(mask, nb_classes)):
+                        self.counts['api'] += 1
+
+                if progress_callback:
+                    progress_callback(done_count, total)
+        finally:
+            # Ответы API, которые уже не нужны (отмена, сбой или патчи,
+            # перехваченные локально), не дожидаемся
+            if remote:
+                self.client.abort()
+            remote_executor.shutdown(wait=False, cancel_futures=True)
+            local_executor.shutdown(wait=True)
+
+        return canvas.result()
+
+    def _timed(self, patches):
+        started = time.perf_counter()
+        predictions = self.pred_func(patches)
+        return predictions, time.perf_counter() - started
+
+    def _take_local(self, local_only, queue, done):
+        """Батч для локальной модели: сначала возвращенные API патчи"""
+        indices = []
+        for source in (local_only, queue):
+            while source and len(indices) < self.batch_size:
+                index = source.popleft()
+                if not done[index]:
+                    indices.append(index)
+        return indices
+
+    def _steal(self, remote_started, done, local_seconds):
+        """Патчи API, ждущие ответа дольше локального батча"""
+        now = time.perf_counter()
+        slow = sorted(
+            (started, index) for index, started in remote_started.items()
+            if not done[index] and now - started > local_seconds
+        )
+        stolen = [index for _, index in slow[:self.batch_size]]
+        for index in stolen:
+            # Повторно патч не перехватывается
+            remote_started.pop(index)
+        return stolen
@@ -6,80 +6,238 @@ from PIL import Image
 from qgis.core import (
     QgsRasterLayer, QgsRasterFileWriter, QgsRasterPipe,
     QgsRectangle, QgsCoordinateReferenceSystem,
-    QgsCoordinateTransform, QgsProject
+    QgsCoordinateTransform, QgsCoordinateTransformContext, QgsProject,
+    QgsPalettedRasterRenderer, QgsCategorizedSymbolRenderer, QgsRendererCategory, QgsSymbol
 )
+from qgis.PyQt.QtGui import QColor
+import math
 import os
 
+from .palette import colorize, rgb_to_mask
+
 
 class ImageProcessor:
     """Класс для всех операций с изображениями"""
     
+    # Строк в одной полосе при копировании растра через GDAL
+    EXPORT_BLOCK_ROWS = 1024
+    
     def __init__(self, segmentation_colors):
         self.colors = np.array(segmentation_colors, dtype=np.uint8)
     
     def label_to_rgb(self, mask):
         """Преобразует маску классов в RGB"""
-        return self.colors[mask]
+        return colorize(mask, self.colors)
     
     def rgb_to_label(self, rgb_image):
-        """Преобразует RGB в маску классов"""
-        rgb_array = np.array(rgb_image)
-        mask = np.zeros(rgb_array.shape[:2], dtype=np.uint8)
+        """Преобразует RGB в маску классов (цвета вне палитры - класс 0)"""
+        return rgb_to_mask(np.asarray(rgb_image), self.colors, unknown=0)
+    
+    @staticmethod
+    def apply_class_palette(layer, colors=None):
+        """Применяет палитровый рендерер классов к одноканальному слою результата"""
+        if layer.bandCount() != 1:
+            return
+        
+        from ..config import SEGMENTATION_COLORS, CLASS_NAMES
+        
+        # Если нет цветов в метаданных, используем из конфига
+        if not colors:
+            colors = SEGMENTATION_COLORS
+        
+        classes = []
+        for i, color in enumerate(colors):
+            class_name = CLASS_NAMES[i] if i < len(CLASS_NAMES) else f"Class {i}"
+            classes.append(QgsPalettedRasterRenderer.Class(
+                i,
+                QColor(color[0], color[1], color[2]),
+                class_name
+            ))
+        
+        renderer = QgsPalettedRasterRenderer(layer.dataProvider(), 1, classes)
+        layer.setRenderer(renderer)
+    
+    @staticmethod
+    def apply_class_categories(layer, colors=None):
+        """Категоризованный рендерер по полю class для слоя полигонов результата"""
+        from ..config import SEGMENTATION_COLORS, CLASS_NAMES
         
-        for i, color in enumerate(self.colors):
-            color_mask = np.all(rgb_array == color, axis=2)
-            mask[color_mask] = i
+        if not colors:
+            colors = SEGMENTATION_COLORS
         
-        return mask
+        categories = []
+        for i, color in enumerate(colors):
+            symbol = QgsSymbol.defaultSymbol(layer.geometryType())
+            symbol.setColor(QColor(color[0], color[1], color[2]))
+            class_name = CLASS_NAMES[i] if i < len(CLASS_NAMES) else f"Class {i}"
+            categories.append(QgsRendererCategory(i, symbol, class_name))
+        
+        layer.setRenderer(QgsCategorizedSymbolRenderer('class', categories))
     
     @staticmethod
-    def export_qgis_layer(layer, output_path, extent=None):
+    def describe_layer_source(layer, extent=None):
+        """Описывает окно исходного файла слоя для чтения без экспорта
+        
+        Возвращает словарь с путем, окном в пикселях и фактическим экстентом окна
+        или None, если источник нельзя читать напрямую через GDAL.
+        """
+        try:
+            from osgeo import gdal
+            from qgis.core import QgsProviderRegistry, QgsRectangle
+            
+            if layer.providerType() != 'gdal':
+                return None
+            
+            path = QgsProviderRegistry.instance().decodeUri('gdal', layer.source()).get('path')
+            if not path or not os.path.isfile(path):
+                return None
+            
+            source_ds = gdal.Open(path)
+            if source_ds is None:
+                return None
+            
+            # Повернутые растры читаем через экспорт
+            geotransform = source_ds.GetGeoTransform()
+            if geotransform[2] != 0 or geotransform[4] != 0:
+                return None
+            
+            if extent is not None:
+                window = ImageProcessor.extent_window(source_ds, extent)
+                if window is None:
+                    return None
+                x_off, y_off, x_size, y_size = window
+            else:
+                x_off = 0
+                y_off = 0
+                x_size = source_ds.RasterXSize
+                y_size = source_ds.RasterYSize
+            
+            # Экстент, точно соответствующий окну в пикселях
+            xmin = geotransform[0] + x_off * geotransform[1]
+            ymax = geotransform[3] + y_off * geotransform[5]
+            window_extent = QgsRectangle(
+                xmin,
+                ymax + y_size * geotransform[5],
+                xmin + x_size * geotransform[1],
+                ymax
+            )
+            source_ds = None
+            
+            return {
+                'path': path,
+                'window': [x_off, y_off, x_size, y_size],
+                'extent': window_extent
+            }
+            
+        except Exception as e:
+            print(f"Error in describe_layer_source: {str(e)}")
+            return None
+    
+    @staticmethod
+    def export_qgis_layer(layer, output_path, extent=None, feedback=None, target_gsd=None):
         """Экспортирует QGIS слой в файл"""
         if not isinstance(layer, QgsRasterLayer):
             raise ValueError("Layer must be a QgsRasterLayer")
         
-        provider = layer.dataProvider()
+        provider, x_size, y_size, extent, crs = ImageProcessor.export_arguments(layer, extent, target_gsd)
+        return ImageProcessor.write_provider(provider, output_path, x_size, y_size, extent, crs, feedback)
+    
+    @staticmethod
+    def export_arguments(layer, extent=None, target_gsd=None):
+        """Копия провайдера и размеры для экспорта слоя
         
-        # Создаем pipe
-        pipe = QgsRasterPipe()
-        if not pipe.set(provider.clone()):
-            return False
+        Вызывается в потоке интерфейса: дальше провайдер используется
+        без обращений к слою, поэтому запись можно выполнять в другом потоке.
+        С target_gsd грубее разрешения слоя размеры уменьшаются, и провайдер
+        отдает данные из обзоров.
         
-        # Настройки файла
-        file_writer = QgsRasterFileWriter(output_path)
-        file_writer.setOutputFormat("GTiff")
+        Returns:
+            (provider, x_size, y_size, extent, crs)
+        """
+        provider = layer.dataProvider()
         
         # Определяем размеры и экстент
-        if extent is None:
+        if extent is None and not target_gsd:
             extent = provider.extent()
             x_size = provider.xSize()
             y_size = provider.ySize()
         else:
+            if extent is None:
+                extent = provider.extent()
             # Вычисляем размеры для заданного экстента
-            pixel_size_x = layer.rasterUnitsPerPixelX()
-            pixel_size_y = layer.rasterUnitsPerPixelY()
-            x_size = int((extent.xMaximum() - extent.xMinimum()) / pixel_size_x)
-            y_size = int((extent.yMaximum() - extent.yMinimum()) / pixel_size_y)
+            pixel_size_x = max(layer.rasterUnitsPerPixelX(), target_gsd or 0)
+            pixel_size_y = max(layer.rasterUnitsPerPixelY(), target_gsd or 0)
+            x_size = max(1, int((extent.xMaximum() - extent.xMinimum()) / pixel_size_x))
+            y_size = max(1, int((extent.yMaximum() - extent.yMinimum()) / pixel_size_y))
+        
+        return (provider.clone(), x_size, y_size, QgsRectangle(extent),
+                QgsCoordinateReferenceSystem(layer.crs()))
+    
+    @staticmethod
+    def write_provider(provider, output_path, x_size, y_size, extent, crs, feedback=None):
+        """Запись провайдера в GeoTIFF; feedback (QgsRasterBlockFeedback) - прогресс и отмена"""
+        # Создаем pipe
+        pipe = QgsRasterPipe()
+        if not pipe.set(provider):
+            return False
+        
+        # Настройки файла
+        file_writer = QgsRasterFileWriter(output_path)
+        file_writer.setOutputFormat("GTiff")
         
-        # Используем writeRaster без feedback параметра
         error = file_writer.writeRaster(
             pipe,
             x_size,
             y_size,
             extent,
-            layer.crs()
+            crs,
+            QgsCoordinateTransformContext(),
+            feedback
         )
         
         return error == QgsRasterFileWriter.NoError
     
     @staticmethod
-    def export_qgis_layer_simple(layer, output_path, extent=None):
-        """Альтернативный метод экспорта через GDAL"""
+    def extent_window(source_ds, extent):
+        """Окно растра GDAL в пикселях (x_off, y_off, x_size, y_size) внутри extent
+        
+        Окно ограничено и растром, и экстентом; None, если они не пересекаются.
+        """
+        from osgeo import gdal
+        
+        inv_geotransform = gdal.InvGeoTransform(source_ds.GetGeoTransform())
+        x1, y1 = gdal.ApplyGeoTransform(inv_geotransform, extent.xMinimum(), extent.yMaximum())
+        x2, y2 = gdal.ApplyGeoTransform(inv_geotransform, extent.xMaximum(), extent.yMinimum())
+        if x2 <= 0 or y2 <= 0:
+            return None
+        
+        x_off = int(max(0, x1))
+        y_off = int(max(0, y1))
+        x_size = int(min(source_ds.RasterXSize, math.ceil(x2)) - x_off)
+        y_size = int(min(source_ds.RasterYSize, math.ceil(y2)) - y_off)
+        if x_size <= 0 or y_size <= 0:
+            return None
+        return x_off, y_off, x_size, y_size
+    
+    @staticmethod
+    def export_qgis_layer_simple(layer, output_path, extent=None, progress_callback=None,
+                                 cancel_check=None, target_gsd=None):
+        """Альтернативный метод экспорта через GDAL
+        
+        Данные копируются полосами строк, поэтому экспорт не держит растр
+        в памяти целиком, сообщает прогресс (progress_callback(доля)) и
+        прерывается, когда cancel_check() возвращает True.
+        
+        Args:
+            layer: слой или путь к источнику
+            target_gsd: разрешение результата, если оно грубее исходного
+        """
         try:
             from osgeo import gdal, osr
             
             # Открываем исходный растр
-            source_ds = gdal.Open(layer.source())
+            source = layer if isinstance(layer, str) else layer.source()
+            source_ds = gdal.Open(source)
             if source_ds is None:
                 return False
             
@@ -89,16 +247,12 @@ class ImageProcessor:
             
             # Если задан extent, вычисляем окно
             if extent is not None:
-                # Вычисляем пиксельные координаты extent
-                inv_geotransform = gdal.InvGeoTransform(geotransform)
-                x1, y1 = gdal.ApplyGeoTransform(inv_geotransform, extent.xMinimum(), extent.yMaximum())
-                x2, y2 = gdal.ApplyGeoTransform(inv_geotransform, extent.xMaximum(), extent.yMinimum())
-                
-                # Округляем и ограничиваем координатами изображения
-                x_off = int(max(0, x1))
-                y_off = int(max(0, y1))
-                x_size = int(min(source_ds.RasterXSize - x_off, x2 - x1))
-                y_size = int(min(source_ds.RasterYSize - y_off, y2 - y1))
+                # Окно extent в пикселях, ограниченное изображением
+                window = ImageProcessor.extent_window(source_ds, extent)
+                if window is None:
+                    source_ds = None
+                    return False
+                x_off, y_off, x_size, y_size = window
                 
                 # Создаем новую геотрансформацию для вырезанной области
                 new_geotransform = list(geotransform)
@@ -111,22 +265,52 @@ class ImageProcessor:
                 y_size = source_ds.RasterYSize
                 new_geotransform = geotransform
             
+            # Огрубление разрешения: чтение с уменьшением берет данные из обзоров
+            out_x_size, out_y_size = x_size, y_size
+            native_gsd = max(abs(geotransform[1]), abs(geotransform[5]))
+            if target_gsd and target_gsd > native_gsd:
+                scale = target_gsd / native_gsd
+                out_x_size = max(1, int(round(x_size / scale)))
+                out_y_size = max(1, int(round(y_size / scale)))
+                new_geotransform = list(new_geotransform)
+                new_geotransform[1] *= x_size / out_x_size
+                new_geotransform[5] *= y_size / out_y_size
+            step_y = y_size / out_y_size
+            
             # Создаем выходной файл
             driver = gdal.GetDriverByName('GTiff')
-            out_ds = driver.Create(output_path, x_size, y_size, source_ds.RasterCount, source_ds.GetRasterBand(1).DataType)
+            out_ds = driver.Create(output_path, out_x_size, out_y_size, source_ds.RasterCount, source_ds.GetRasterBand(1).DataType)
             
             # Устанавливаем геотрансформацию и проекцию
             out_ds.SetGeoTransform(new_geotransform)
             out_ds.SetProjection(projection)
             
-            # Копируем данные по бандам
-            for i in range(1, source_ds.RasterCount + 1):
+            # Копируем данные по бандам полосами строк
+            band_count = source_ds.RasterCount
+            rows = ImageProcessor.EXPORT_BLOCK_ROWS
+            for i in range(1, band_count + 1):
                 in_band = source_ds.GetRasterBand(i)
                 out_band = out_ds.GetRasterBand(i)
                 
-                # Читаем и записываем данные
-                data = in_band.ReadAsArray(x_off, y_off, x_size, y_size)
-                out_band.WriteArray(data)
+                for row in range(0, out_y_size, rows):
+                    if cancel_check is not None and cancel_check():
+                        out_ds = None
+                        source_ds = None
+                        return False
+                    
+                    # Читаем и записываем данные
+                    row_end = min(row + rows, out_y_size)
+                    src_row = int(round(row * step_y))
+                    src_rows = int(round(row_end * step_y)) - src_row
+                    data = in_band.ReadAsArray(
+                        x_off, y_off + src_row, x_size, src_rows,
+                        buf_xsize=out_x_size, buf_ysize=row_end - row,
+                        resample_alg=gdal.GRIORA_Average
+                    )
+                    out_band.WriteArray(data, 0, row)
+                    
+                    if progress_callback is not None:
+                        progress_callback((i - 1 + row_end / out_y_size) / band_count)
                 
                 # Копируем статистику и цветовую таблицу если есть
                 if in_band.GetColorTable():
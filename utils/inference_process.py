@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Постоянный процесс инференса
+
+Процесс запускается один раз в окружении плагина (.venv или portable_python)
+и выполняет задания по очереди, поэтому модель загружается только при первом
+задании и переиспользуется диалогом, Processing и пакетной обработкой.
+"""
+import os
+import queue
+import subprocess
+import threading
+import uuid
+
+from .ipc import decode_message, encode_message, StreamDrainer
+
+
+TERMINAL_MESSAGES = ('result', 'error', 'cancelled')
+
+
+def find_python(plugin_dir):
+    """Поиск Python интерпретатора"""
+    # Сначала ищем в venv
+    venv_path = os.path.join(plugin_dir, '.venv')
+    if os.name == 'nt':
+        python_exe = os.path.join(venv_path, 'Scripts', 'python.exe')
+    else:
+        python_exe = os.path.join(venv_path, 'bin', 'python')
+
+    if os.path.exists(python_exe):
+        return python_exe
+
+    # Потом в portable_python
+    portable_path = os.path.join(plugin_dir, 'portable_python', 'python.exe')
+    if os.path.exists(portable_path):
+        return portable_path
+
+    raise Exception("Python интерпретатор не найден")
+
+
+def create_clean_env(plugin_dir):
+    """Создает чистое окружение для subprocess"""
+    env = {}
+
+    # Минимальные системные переменные
+    for var in ['SYSTEMROOT', 'SYSTEMDRIVE', 'TEMP', 'TMP', 'USERPROFILE', 'HOME']:
+        if var in os.environ:
+            env[var] = os.environ[var]
+
+    # Определяем пути в зависимости от типа Python
+    python_exe = find_python(plugin_dir)
+    if '.venv' in python_exe:
+        # Для venv
+        venv_path = os.path.join(plugin_dir, '.venv')
+        if os.name == 'nt':
+            paths = [
+                os.path.join(venv_path, 'Scripts'),
+                os.path.join(os.environ.get('SYSTEMROOT', 'C:\\Windows'), 'System32')
+            ]
+        else:
+            paths = [
+                os.path.join(venv_path, 'bin'),
+                '/usr/bin',
+                '/bin'
+            ]
+        env['PYTHONHOME'] = venv_path
+    else:
+        # Для portable Python
+        portable_dir = os.path.join(plugin_dir, 'portable_python')
+        paths = [
+            portable_dir,
+            os.path.join(portable_dir, 'Scripts'),
+            os.path.join(os.environ.get('SYSTEMROOT', 'C:\\Windows'), 'System32')
+        ]
+
+    env['PATH'] = os.pathsep.join(paths)
+    env['PLUGIN_DIR'] = plugin_dir
+    env['PYTHONIOENCODING'] = 'utf-8'
+
+    return env
+
+
+class InferenceJob:
+    """Задание, отправленное в процесс инференса"""
+
+    def __init__(self, process, job_id):
+        self.process = process
+        self.id = job_id
+        self.queue = queue.Queue()
+
+    def messages(self):
+        """Сообщения задания до завершающего (result, error или cancelled)"""
+        while True:
+            message = self.queue.get()
+            yield message
+            if message.get('type') in TERMINAL_MESSAGES:
+                return
+
+    def cancel(self):
+        """Запрашивает остановку задания"""
+        self.process.cancel(self.id)
+
+
+class InferenceProcess:
+    """Процесс инференса, выполняющий задания по очереди
+
+    Процесс сообщает 'started', когда берет задание из очереди. Отмененное
+    задание из очереди процесс подтверждает сразу, а для выполняемого
+    запускается таймер: если оно не остановилось за CANCEL_GRACE_PERIOD,
+    процесс завершается. Таймер взводится только для выполняемого задания,
+    чтобы отмена ожидающего не прерывала чужое.
+    """
+
+    # Сколько ждать остановки задания после запроса отмены, секунд
+    CANCEL_GRACE_PERIOD = 10
+
+    def __init__(self, plugin_dir):
+        self.plugin_dir = plugin_dir
+        self.process = None
+        self.jobs = {}
+        # Задание, которое выполняет процесс, и задания с запрошенной отменой
+        self.running = None
+        self.cancel_requested = set()
+        self.stderr_drainer = None
+        self._lock = threading.RLock()
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        """Запускает процесс, если он еще не запущен"""
+        with self._lock:
+            if self.is_running():
+                return
+
+            self.running = None
+            self.cancel_requested.clear()
+            inference_script = os.path.join(self.plugin_dir, 'utils', 'inference_runner.py')
+            cmd = [find_python(self.plugin_dir), '-u', inference_script, '--serve']
+            self.process = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=create_clean_env(self.plugin_dir),
+                universal_newlines=True,
+                encoding='utf-8'
+            )
+
+            # stderr читаем параллельно, чтобы логи не переполнили pipe
+            self.stderr_drainer = StreamDrainer(self.process.stderr)
+            self.stderr_drainer.start()
+
+            reader = threading.Thread(
+                target=self._read_messages, args=(self.process,), daemon=True
+            )
+            reader.start()
+
+    def submit(self, params):
+        """Отправляет задание, возвращает InferenceJob"""
+        with self._lock:
+            self.start()
+            job = InferenceJob(self, uuid.uuid4().hex)
+            self.jobs[job.id] = job
+            self._send('job', id=job.id, params=params)
+            return job
+
+    def preload(self, model_path):
+        """Загрузка модели заранее, пока готовятся входные данные задания"""
+        with self._lock:
+            self.start()
+            self._send('preload', model_path=model_path)
+
+    def cancel(self, job_id):
+        """Отмена задания; зависшее выполняемое задание завершается вместе с процессом"""
+        with self._lock:
+            process = self.process
+            if job_id not in self.jobs or process is None:
+                return
+            self._send('cancel', job=job_id)
+            self.cancel_requested.add(job_id)
+            running = self.running == job_id
+
+        if running:
+            self._arm_termination(job_id, process)
+
+    def close(self):
+        """Останавливает процесс"""
+        with self._lock:
+            process = self.process
+            if process is None:
+                return
+            if process.poll() is None:
+                self._send('shutdown')
+                try:
+                    process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    process.terminate()
+            self.process = None
+
+    def _send(self, msg_type, **fields):
+        try:
+            self.process.stdin.write(encode_message(msg_type, **fields))
+            self.process.stdin.flush()
+        except (OSError, ValueError):
+            pass
+
+    def _arm_termination(self, job_id, process):
+        """Завершает процесс, если задание не остановится за CANCEL_GRACE_PERIOD"""
+        timer = threading.Timer(
+            self.CANCEL_GRACE_PERIOD, self._terminate_if_busy, args=(job_id, process)
+        )
+        timer.daemon = True
+        timer.start()
+
+    def _terminate_if_busy(self, job_id, process):
+        with self._lock:
+            busy = self.running == job_id and job_id in self.jobs
+        if busy and process.poll() is None:
+            process.terminate()
+
+    def _read_messages(self, process):
+        """Раздает сообщения процесса по заданиям"""
+        for line in iter(process.stdout.readline, ''):
+            message = decode_message(line)
+            if message is None:
+                continue
+
+            job = self.jobs.get(message.get('job'))
+            if job is None:
+                continue
+            if message['type'] == 'started':
+                with self._lock:
+                    self.running = job.id
+                    cancelled = job.id in self.cancel_requested
+                # Отмена пришла, пока задание ждало в очереди
+                if cancelled:
+                    self._arm_termination(job.id, process)
+                continue
+            job.queue.put(message)
+            if message['type'] in TERMINAL_MESSAGES:
+                with self._lock:
+                    self.jobs.pop(job.id, None)
+                    self.cancel_requested.discard(job.id)
+                    if self.running == job.id:
+                        self.running = None
+
+        # Процесс завершился: оставшиеся задания получают ошибку
+        returncode = process.wait()
+        self.stderr_drainer.join(timeout=5)
+        details = self.stderr_drainer.tail()
+
+        with self._lock:
+            for job in list(self.jobs.values()):
+                job.queue.put({
+                    'type': 'error',
+                    'job': job.id,
+                    'message': f"Процесс инференса завершился (код {returncode}): {details}"
+                })
+            self.jobs.clear()
+            self.cancel_requested.clear()
+            self.running = None
+            for stream in (process.stdin, process.stdout, process.stderr):
+                try:
+                    stream.close()
+                except (OSError, ValueError):
+                    pass
+
+
+_shared_processes = {}
+
+
+def shared_process(plugin_dir):
+    """Общий процесс инференса для плагина"""
+    process = _shared_processes.get(plugin_dir)
+    if process is None:
+        process = InferenceProcess(plugin_dir)
+        _shared_processes[plugin_dir] = process
+    return process
+
+
+def close_shared_processes():
+    """Останавливает все общие процессы (при выгрузке плагина)"""
+    for process in _shared_processes.values():
+        process.close()
+    _shared_processes.clear()
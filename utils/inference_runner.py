@@ -4,18 +4,40 @@
 import sys
 import json
 import os
+import gc
+import time
+import traceback
+import uuid
 import numpy as np
-from PIL import Image
 import requests
-import io
+
+PLUGIN_DIR = os.environ.get('PLUGIN_DIR', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if PLUGIN_DIR not in sys.path:
+    sys.path.insert(0, PLUGIN_DIR)
+
+from utils.ipc import open_channel, Telemetry, CancelToken, CommandReader, InferenceCancelled
+from utils.raster_source import RasterSource
 
 
 class InferenceRunner:
-    def __init__(self, params):
+    def __init__(self, params, telemetry=None, cancel_token=None):
         self.params = params
-        self.plugin_dir = os.environ.get('PLUGIN_DIR', os.path.dirname(os.path.dirname(__file__)))
+        self.plugin_dir = PLUGIN_DIR
+        self.telemetry = telemetry or Telemetry()
+        self.cancel_token = cancel_token or CancelToken()
+        self.started = time.perf_counter()
+        # Статистика передачи API инференса для метаданных
+        self.transfer = None
+        # Патчи, обработанные каждой стороной в гибридном режиме
+        self.hybrid = None
+        # Диапазон растяжения не-uint8 входа
+        self.stretch = None
+        # Область интереса на сетке растра (utils/aoi.py)
+        self.aoi = None
         
     def run(self):
+        if self.params.get('use_hybrid'):
+            return self.run_hybrid()
         if self.params.get('use_api'):
             return self.run_api()
         else:
@@ -23,183 +45,616 @@ class InferenceRunner:
     
     def run_api(self):
         """API инференс"""
-        print("PROGRESS:20", flush=True)
-        
-        # Читаем изображение
-        img = Image.open(self.params['input_path'])
-        img_bytes_io = io.BytesIO()
-        img.save(img_bytes_io, format='PNG')
-        img_bytes = img_bytes_io.getvalue()
+        from config import API_TILED
+        if self._use_api_job():
+            return self.run_api_job()
+        if self.params.get('api_tiled', API_TILED):
+            return self.run_api_tiled()
         
-        print("PROGRESS:40", flush=True)
+        from config import (SEGMENTATION_COLORS, API_CODEC_PREFERENCE, API_MASK_CODEC_PREFERENCE,
+                            API_CACHE_PRECHECK, API_STREAM)
+        from utils.api_client import decode_mask, fetch_cached
+        from utils.result_cache import content_hash
+        from utils.wire_codecs import (encode_chunks, multipart_body, server_info, negotiate_codecs,
+                                       codec_for_content_type, TransferStats)
         
-        # API запрос
-        files = {"file": ("image.png", img_bytes, "image/png")}
+        session = requests.Session()
+        info = server_info(session, self.params['api_url'])
+        codec, mask_codec = negotiate_codecs(info, API_CODEC_PREFERENCE, API_MASK_CODEC_PREFERENCE)
+        stats = TransferStats(codec)
         api_params = {
             "patch_size": self.params['patch_size'],
-            "subdivisions": self.params['subdivisions']
+            "subdivisions": self.params['subdivisions'],
+            "response_format": "mask",
+            "response_codec": mask_codec
         }
         
-        response = requests.post(
-            f"{self.params['api_url']}/predict/",
-            files=files,
-            params=api_params,
-            timeout=300
+        # Читаем изображение
+        with self.telemetry.stage('read_input'):
+            source = RasterSource.from_params(self.params)
+            img_array = self._as_uint8(source).read()
+            source.close()
+        
+        # Проверяем кэш сервера до загрузки изображения
+        response = None
+        if API_CACHE_PRECHECK and info.get('cache'):
+            response = fetch_cached(session, self.params['api_url'], content_hash(img_array), api_params)
+            if response is not None:
+                stats.add(0, len(response.content), 0.0, cached=True)
+        
+        if response is None:
+            started = time.perf_counter()
+            chunks = encode_chunks(img_array, codec)
+            encode_seconds = time.perf_counter() - started
+        del img_array
+        
+        self.cancel_token.check()
+        
+        if response is None and info.get('stream') and self.params.get('api_stream', API_STREAM):
+            try:
+                return self._run_api_stream(session, chunks, codec, api_params, stats, encode_seconds)
+            finally:
+                session.close()
+        
+        # API запрос
+        with self.telemetry.stage('inference'):
+            try:
+                if response is None:
+                    body = multipart_body(chunks, codec)
+                    response = session.post(
+                        f"{self.params['api_url']}/predict/",
+                        data=body,
+                        headers={'Content-Type': body.content_type},
+                        params=api_params,
+                        timeout=300
+                    )
+                    response.raise_for_status()
+                    stats.add(len(body), len(response.content), encode_seconds)
+            finally:
+                session.close()
+            
+            # Обработка результата
+            response_codec = codec_for_content_type(response.headers.get('Content-Type')) or 'png'
+            mask = decode_mask(response.content, response_codec, SEGMENTATION_COLORS)
+        
+        self.transfer = stats.as_dict()
+        self.cancel_token.check(1, 1)
+        return self._save_results(mask)
+    
+    def _run_api_stream(self, session, chunks, codec, api_params, stats, encode_seconds):
+        """Потоковый ответ API: патчи смешиваются и записываются по мере поступления
+        
+        Изображение отправляется одним запросом, поэтому читается и кодируется
+        целиком; ограничена только сторона результата: в памяти полоса высотой
+        в окно, готовые строки сразу уходят в файл результата.
+        """
+        from config import DEFAULT_NUM_CLASSES
+        from utils.api_client import blend_tile_stream
+        from utils.wire_codecs import multipart_body
+        
+        # Размер результата известен только из первого кадра ответа
+        writers = []
+        
+        def open_sink(height, width):
+            writers.append(self._open_writer(height, width, preview=True))
+            return writers[0].write_scores
+        
+        try:
+            with self.telemetry.stage('inference'):
+                body = multipart_body(chunks, codec)
+                response = session.post(
+                    f"{self.params['api_url']}/predict/",
+                    data=body,
+                    headers={'Content-Type': body.content_type},
+                    params=dict(api_params, response_format='stream'),
+                    timeout=300,
+                    stream=True
+                )
+                with response:
+                    response.raise_for_status()
+                    done, received = blend_tile_stream(response, DEFAULT_NUM_CLASSES, open_sink,
+                                                       progress_callback=self.telemetry.tiles,
+                                                       cancel_check=self.cancel_token.check)
+            
+            stats.add(len(body), received, encode_seconds)
+            self.transfer = dict(stats.as_dict(), streamed_tiles=done)
+            
+            writer = writers[0]
+            with self.telemetry.stage('save'):
+                writer.close()
+                metadata_path = self._write_metadata(writer)
+        except BaseException:
+            for writer in writers:
+                writer.abort()
+            raise
+        
+        self.telemetry.send('result', metadata_path=metadata_path, timings=self.telemetry.timings)
+        return metadata_path
+    
+    def run_api_tiled(self):
+        """API инференс с параллельной отправкой патчей
+        
+        Ответы смешиваются по порядку строк, готовые полосы сразу пишутся
+        в файл результата, как при локальном инференсе.
+        """
+        from config import (DEFAULT_NUM_CLASSES, SEGMENTATION_COLORS, API_TILE_CONCURRENCY,
+                            API_TILE_RETRIES, API_TILE_TIMEOUT, API_CODEC_PREFERENCE,
+                            API_MASK_CODEC_PREFERENCE, API_CACHE_PRECHECK)
+        from utils.api_client import TiledApiClient
+        
+        with self.telemetry.stage('read_input'):
+            source = RasterSource.from_params(self.params)
+            img_array = self._as_uint8(source)
+            tile_filter = self._load_aoi(img_array.shape)
+        
+        client = TiledApiClient(
+            self.params['api_url'],
+            SEGMENTATION_COLORS,
+            concurrency=self.params.get('api_concurrency', API_TILE_CONCURRENCY),
+            retries=self.params.get('api_retries', API_TILE_RETRIES),
+            timeout=API_TILE_TIMEOUT,
+            codec_preference=API_CODEC_PREFERENCE,
+            mask_codec_preference=API_MASK_CODEC_PREFERENCE,
+            cache_precheck=API_CACHE_PRECHECK
         )
-        response.raise_for_status()
         
-        print("PROGRESS:70", flush=True)
+        def predict(sink):
+            client.predict_tiled(
+                img_array,
+                window_size=self.params['patch_size'],
+                subdivisions=self.params['subdivisions'],
+                nb_classes=DEFAULT_NUM_CLASSES,
+                progress_callback=self.telemetry.tiles,
+                cancel_check=self.cancel_token.check,
+                tile_filter=tile_filter,
+                sink=sink
+            )
+            self.transfer = client.stats.as_dict()
         
-        # Обработка результата
-        result_image = Image.open(io.BytesIO(response.content))
-        return self._save_results(result_image)
+        try:
+            return self._predict_to_writer(img_array.shape[0], img_array.shape[1], predict)
+        finally:
+            client.close()
+            source.close()
     
-    def run_local(self):
-        """Локальный инференс"""
-        print("PROGRESS:20", flush=True)
+    def run_api_job(self):
+        """API инференс асинхронным заданием с возобновлением после перезапуска"""
+        from config import (DEFAULT_NUM_CLASSES, SEGMENTATION_COLORS, API_TILE_CONCURRENCY,
+                            API_TILE_RETRIES, API_TILE_TIMEOUT, API_CODEC_PREFERENCE,
+                            API_MASK_CODEC_PREFERENCE)
+        from utils.job_client import JobApiClient, job_signature, job_state_dir, prune_job_states
         
-        # Добавляем путь к плагину
-        if self.plugin_dir not in sys.path:
-            sys.path.insert(0, self.plugin_dir)
+        with self.telemetry.stage('read_input'):
+            source = RasterSource.from_params(self.params)
+            img_array = self._as_uint8(source)
+            tile_filter = self._load_aoi(img_array.shape)
+        
+        window_size = self.params['patch_size']
+        subdivisions = self.params['subdivisions']
+        signature = job_signature(self.params, img_array.shape, window_size, subdivisions)
+        # Нефайловый источник не возобновляется: состояние только на время задания
+        state_dir = job_state_dir(signature or uuid.uuid4().hex)
+        prune_job_states(keep=state_dir)
+        
+        client = JobApiClient(
+            self.params['api_url'],
+            SEGMENTATION_COLORS,
+            concurrency=self.params.get('api_concurrency', API_TILE_CONCURRENCY),
+            retries=self.params.get('api_retries', API_TILE_RETRIES),
+            timeout=API_TILE_TIMEOUT,
+            codec_preference=API_CODEC_PREFERENCE,
+            mask_codec_preference=API_MASK_CODEC_PREFERENCE
+        )
         
+        def predict(sink):
+            client.predict_job(
+                img_array,
+                window_size=window_size,
+                subdivisions=subdivisions,
+                nb_classes=DEFAULT_NUM_CLASSES,
+                state_dir=state_dir,
+                progress_callback=self.telemetry.tiles,
+                cancel_check=self.cancel_token.check,
+                tile_filter=tile_filter,
+                sink=sink
+            )
+            self.transfer = client.stats.as_dict()
+            self.transfer['job'] = client.job_id
+            self.transfer['resumed_tiles'] = client.resumed_tiles
+        
+        try:
+            # Маски патчей смешиваются из состояния на диске после задания
+            metadata_path = self._predict_to_writer(img_array.shape[0], img_array.shape[1], predict,
+                                                    preview=False)
+            # Состояние удаляется только после сохранения результата
+            client.finish()
+            return metadata_path
+        except BaseException:
+            # Состояние нефайлового источника не возобновить: задание и каталог удаляются
+            if signature is None:
+                client.finish()
+            raise
+        finally:
+            client.close()
+            source.close()
+    
+    def _use_api_job(self):
+        """Задание API для растров больше порога, если сервер их поддерживает"""
+        from config import API_JOB_MIN_PIXELS
+        from utils.wire_codecs import server_info
+        
+        threshold = self.params.get('api_job_min_pixels', API_JOB_MIN_PIXELS)
+        source = RasterSource.from_params(self.params)
+        height, width = source.shape[:2]
+        source.close()
+        if threshold is None or height * width < threshold:
+            return False
+        
+        with requests.Session() as session:
+            return bool(server_info(session, self.params['api_url']).get('jobs'))
+    
+    def run_local(self):
+        """Локальный инференс
+        
+        Готовые полосы предсказаний сразу пишутся в файл результата, так что
+        с предпросмотром слой в QGIS заполняется по ходу задания.
+        """
         # Импорты
-        from config import DEFAULT_NUM_CLASSES, SEGMENTATION_COLORS
+        from config import DEFAULT_NUM_CLASSES, DEFAULT_BATCH_SIZE
         from utils.model_loader import load_model
-        from utils.prediction import predict_img_tiled
+        from utils.prediction import predict_img_streamed
         
         # Загружаем модель
         model_path = self.params.get('model_path')
         if not model_path:
             model_path = os.path.join(self.plugin_dir, 'models', 'best_model.h5')
         
-        _, predictor = load_model(model_path)
+        with self.telemetry.stage('load_model'):
+            _, predictor = load_model(model_path)
         
-        print("PROGRESS:40", flush=True)
+        self.cancel_token.check()
         
         # Читаем и подготавливаем изображение
-        img = Image.open(self.params['input_path'])
-        img_array = np.array(img)
-        
-        # Нормализация каналов
-        if len(img_array.shape) == 2:
-            img_array = np.stack([img_array] * 3, axis=2)
-        elif img_array.shape[2] == 4:
-            img_array = img_array[:, :, :3]
-        elif img_array.shape[2] == 1:
-            img_array = np.repeat(img_array, 3, axis=2)
-        
-        # Приведение к uint8
-        if img_array.dtype != np.uint8:
-            img_array = ((img_array - img_array.min()) / 
-                        (img_array.max() - img_array.min() + 1e-8) * 255).astype(np.uint8)
-        
-        print("PROGRESS:60", flush=True)
-        
-        # Предсказание
-        predictions = predict_img_tiled(
-            img_array,
-            window_size=self.params['patch_size'],
-            subdivisions=self.params['subdivisions'],
-            nb_classes=DEFAULT_NUM_CLASSES,
-            pred_func=predictor
+        with self.telemetry.stage('read_input'):
+            source = RasterSource.from_params(self.params)
+            img_array = self._as_uint8(source)
+            tile_filter = self._load_aoi(img_array.shape)
+        
+        # Предсказание с записью готовых полос
+        def predict(sink):
+            predict_img_streamed(
+                img_array,
+                window_size=self.params['patch_size'],
+                subdivisions=self.params['subdivisions'],
+                nb_classes=DEFAULT_NUM_CLASSES,
+                pred_func=predictor,
+                sink=sink,
+                batch_size=self.params.get('batch_size', DEFAULT_BATCH_SIZE),
+                progress_callback=self.telemetry.tiles,
+                cancel_check=self.cancel_token.check,
+                tile_filter=tile_filter
+            )
+        
+        try:
+            return self._predict_to_writer(img_array.shape[0], img_array.shape[1], predict)
+        finally:
+            source.close()
+    
+    def run_hybrid(self):
+        """Гибридный инференс: локальная модель и API над одной очередью патчей"""
+        from config import (DEFAULT_NUM_CLASSES, DEFAULT_BATCH_SIZE, SEGMENTATION_COLORS,
+                            API_TILE_CONCURRENCY, API_TILE_RETRIES, API_TILE_TIMEOUT,
+                            API_CODEC_PREFERENCE, API_MASK_CODEC_PREFERENCE, API_CACHE_PRECHECK)
+        from utils.model_loader import load_model
+        from utils.api_client import TiledApiClient
+        from utils.hybrid import HybridExecutor
+        
+        model_path = self.params.get('model_path')
+        if not model_path:
+            model_path = os.path.join(self.plugin_dir, 'models', 'best_model.h5')
+        
+        with self.telemetry.stage('load_model'):
+            _, predictor = load_model(model_path)
+        
+        self.cancel_token.check()
+        
+        with self.telemetry.stage('read_input'):
+            source = RasterSource.from_params(self.params)
+            img_array = self._as_uint8(source)
+            tile_filter = self._load_aoi(img_array.shape)
+        
+        client = TiledApiClient(
+            self.params['api_url'],
+            SEGMENTATION_COLORS,
+            concurrency=self.params.get('api_concurrency', API_TILE_CONCURRENCY),
+            retries=self.params.get('api_retries', API_TILE_RETRIES),
+            timeout=API_TILE_TIMEOUT,
+            codec_preference=API_CODEC_PREFERENCE,
+            mask_codec_preference=API_MASK_CODEC_PREFERENCE,
+            cache_precheck=API_CACHE_PRECHECK
+        )
+        executor = HybridExecutor(
+            predictor,
+            client,
+            batch_size=self.params.get('batch_size', DEFAULT_BATCH_SIZE)
         )
         
-        print("PROGRESS:80", flush=True)
+        with self.telemetry.stage('inference'):
+            try:
+                predictions = executor.predict(
+                    img_array,
+                    window_size=self.params['patch_size'],
+                    subdivisions=self.params['subdivisions'],
+                    nb_classes=DEFAULT_NUM_CLASSES,
+                    progress_callback=self.telemetry.tiles,
+                    cancel_check=self.cancel_token.check,
+                    tile_filter=tile_filter
+                )
+            finally:
+                client.close()
+                source.close()
         
-        # Создаем RGB изображение
-        mask = np.argmax(predictions, axis=2).astype(np.uint8)
-        height, width = mask.shape
-        rgb_result = np.zeros((height, width, 3), dtype=np.uint8)
+        self.transfer = client.stats.as_dict()
+        self.hybrid = dict(executor.counts)
+        return self._save_prediction(predictions)
+    
+    def _as_uint8(self, source):
+        """uint8-растр читается по тайлам прямо из источника, остальные растягиваются к uint8 при чтении тайлов"""
+        if source.dtype == np.uint8:
+            return source
         
-        for class_idx, color in enumerate(SEGMENTATION_COLORS):
-            rgb_result[mask == class_idx] = color
+        from config import (INPUT_STRETCH, INPUT_STRETCH_PERCENTILES, INPUT_STRETCH_PER_BAND,
+                            INPUT_STRETCH_SAMPLE)
+        from utils.normalization import estimate_stretch, NormalizedSource
         
-        result_image = Image.fromarray(rgb_result)
-        return self._save_results(result_image, mask)
+        stretch = estimate_stretch(
+            source,
+            mode=self.params.get('input_stretch', INPUT_STRETCH),
+            percentiles=self.params.get('input_stretch_percentiles', INPUT_STRETCH_PERCENTILES),
+            per_band=self.params.get('input_stretch_per_band', INPUT_STRETCH_PER_BAND),
+            sample_size=INPUT_STRETCH_SAMPLE
+        )
+        self.stretch = stretch.as_dict()
+        return NormalizedSource(source, stretch)
     
-    def _save_results(self, rgb_image, mask=None):
-        """Сохранение результатов с геореференцированием"""
-        # Если маски нет, извлекаем из RGB
-        if mask is None:
-            sys.path.insert(0, self.plugin_dir)
-            from config import SEGMENTATION_COLORS
-            
-            result_array = np.array(rgb_image)
-            mask = np.zeros((result_array.shape[0], result_array.shape[1]), dtype=np.uint8)
-            
-            for i, color in enumerate(SEGMENTATION_COLORS):
-                color_mask = np.all(result_array == color, axis=2)
-                mask[color_mask] = i
+    def _load_aoi(self, shape):
+        """AOI задания на сетке входного растра, возвращает отбор патчей"""
+        from utils.aoi import AoiMask
         
-        # Если есть геоданные, создаем геореференцированный файл
-        if 'georeference_data' in self.params:
-            geo_data = self.params['georeference_data']
-            
-            # Импортируем rasterio только здесь, в subprocess
-            import rasterio
-            from rasterio.transform import from_bounds
-            
-            height, width = mask.shape
-            transform = from_bounds(
-                geo_data['extent_xmin'],
-                geo_data['extent_ymin'],
-                geo_data['extent_xmax'],
-                geo_data['extent_ymax'],
-                width,
-                height
-            )
-            
-            # Сохраняем геореференцированный результат
-            profile = {
-                'driver': 'GTiff',
-                'height': height,
-                'width': width,
-                'count': 1,
-                'dtype': mask.dtype,
-                'crs': geo_data.get('crs'),
-                'transform': transform
-            }
-            
-            with rasterio.open(self.params['output_path'], 'w', **profile) as dst:
-                dst.write(mask, 1)
-        else:
-            # Без геореференцирования сохраняем как простые файлы
-            mask_path = self.params['output_path'].replace('.tif', '_mask.png')
-            Image.fromarray(mask).save(mask_path)
+        self.aoi = AoiMask.from_params(self.params, shape[0], shape[1])
+        if self.aoi is None:
+            return None
+        return self.aoi.tile_filter(self.params['patch_size'])
+    
+    def _predict_to_writer(self, height, width, predict, preview=True):
+        """Инференс с записью готовых полос в файлы результата
+        
+        predict(sink) выдает голоса классов полосами, как predict_img_streamed;
+        в памяти результата - только полоса высотой в окно.
+        """
+        writer = self._open_writer(height, width, preview=preview)
+        try:
+            with self.telemetry.stage('inference'):
+                predict(writer.write_scores)
             
-            rgb_path = self.params['output_path'].replace('.tif', '_rgb.png')
-            rgb_image.save(rgb_path)
+            with self.telemetry.stage('save'):
+                writer.close()
+                metadata_path = self._write_metadata(writer)
+        except BaseException:
+            writer.abort()
+            raise
+        
+        self.telemetry.send('result', metadata_path=metadata_path, timings=self.telemetry.timings)
+        return metadata_path
+    
+    def _save_prediction(self, predictions):
+        """Сохранение маски классов (и растров уверенности) из предсказаний"""
+        return self._save_results(predictions, scores=True)
+    
+    def discard(self, cancelled):
+        """Освобождает модель и удаляет частичные результаты после отмены"""
+        if not self.params.get('use_api') and self.params.get('release_model_on_cancel', True):
+            from utils.model_loader import release_model
+            release_model()
+        gc.collect()
+        
+        output_path = self.params.get('output_path')
+        if output_path:
+            for path in (
+                output_path,
+                output_path + '.aux.xml',
+                output_path.replace('.tif', '.part.tif'),
+                output_path.replace('.tif', '_mask.png'),
+                output_path.replace('.tif', '_rgb.png'),
+                output_path.replace('.tif', '_metadata.json'),
+                output_path.replace('.tif', '_class_stats.csv'),
+                output_path.replace('.tif', '_confidence.tif'),
+                output_path.replace('.tif', '_confidence.part.tif'),
+                output_path.replace('.tif', '_probs.tif'),
+                output_path.replace('.tif', '_probs.part.tif'),
+                output_path.replace('.tif', '_polygons.gpkg'),
+                output_path.replace('.tif', '_polygons.gpkg-journal'),
+            ):
+                if os.path.exists(path):
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+        
+        self.telemetry.send(
+            'cancelled',
+            tiles_done=cancelled.tiles_done,
+            tiles_total=cancelled.tiles_total,
+            seconds_discarded=round(time.perf_counter() - self.started, 1)
+        )
+    
+    def _save_results(self, data, scores=False):
+        """Сохранение результатов с геореференцированием"""
+        with self.telemetry.stage('save'):
+            metadata_path = self._write_results(data, scores)
+        
+        self.telemetry.send('result', metadata_path=metadata_path, timings=self.telemetry.timings)
+        return metadata_path
+    
+    def _write_results(self, data, scores=False):
+        """Запись маски (или голосов классов полосами) и метаданных на диск"""
+        writer = self._open_writer(*data.shape[:2])
+        try:
+            if scores:
+                for row in range(0, data.shape[0], writer.block_size):
+                    writer.write_scores(row, data[row:row + writer.block_size])
+            else:
+                writer.write(0, data)
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+        return self._write_metadata(writer)
+    
+    def _open_writer(self, height, width, preview=False):
+        """Запись маски в файлы результата полосами
+        
+        preview - полосы пишутся по ходу инференса; если задание просит
+        предпросмотр (output_preview), путь заполняемого файла сразу
+        отправляется сообщением 'preview'.
+        """
+        from config import (SEGMENTATION_COLORS, CLASS_NAMES, OUTPUT_RGB, OUTPUT_COG,
+                            OUTPUT_COMPRESS, OUTPUT_BLOCK_SIZE, OUTPUT_NODATA,
+                            OUTPUT_CONFIDENCE, OUTPUT_PROBABILITIES, OUTPUT_VECTOR,
+                            VECTOR_SIMPLIFY, VECTOR_MIN_AREA, OUTPUT_PREVIEW_INTERVAL)
+        from utils.result_writer import MaskWriter
+        
+        # Без отбора патчей (запрос целиком, поток сервера) AOI только маскирует результат
+        if self.aoi is None:
+            self._load_aoi((height, width))
+        preview_interval = None
+        if preview and self.params.get('output_preview'):
+            preview_interval = OUTPUT_PREVIEW_INTERVAL
+        writer = MaskWriter(self.params, height, width, SEGMENTATION_COLORS, CLASS_NAMES,
+                          aoi=self.aoi,
+                          output_rgb=self.params.get('output_rgb', OUTPUT_RGB),
+                          cog=self.params.get('output_cog', OUTPUT_COG),
+                          compress=OUTPUT_COMPRESS,
+                          block_size=OUTPUT_BLOCK_SIZE,
+                          nodata=OUTPUT_NODATA,
+                          confidence=self.params.get('output_confidence', OUTPUT_CONFIDENCE),
+                          probabilities=self.params.get('output_probabilities', OUTPUT_PROBABILITIES),
+                          vector=self.params.get('output_vector', OUTPUT_VECTOR),
+                          vector_simplify=self.params.get('vector_simplify', VECTOR_SIMPLIFY),
+                          vector_min_area=self.params.get('vector_min_area', VECTOR_MIN_AREA),
+                          preview_interval=preview_interval)
+        if writer.preview_path:
+            self.telemetry.send('preview', path=writer.preview_path)
+        return writer
+    
+    def _write_metadata(self, writer=None):
+        """Метаданные результата рядом с выходным файлом
+        
+        С writer добавляются площади классов, накопленные при записи маски,
+        и они же сохраняются в <результат>_class_stats.csv.
+        """
+        from config import SEGMENTATION_COLORS, CLASS_NAMES
+        from utils.result_writer import write_class_csv
         
         # Метаданные
         metadata_path = self.params['output_path'].replace('.tif', '_metadata.json')
         metadata = {
             'output_path': self.params['output_path'],
-            'classes': SEGMENTATION_COLORS if 'SEGMENTATION_COLORS' in locals() else [],
-            'num_classes': len(SEGMENTATION_COLORS) if 'SEGMENTATION_COLORS' in locals() else 6,
-            'has_georef': 'georeference_data' in self.params
+            'classes': SEGMENTATION_COLORS,
+            'class_names': CLASS_NAMES[:len(SEGMENTATION_COLORS)],
+            'num_classes': len(SEGMENTATION_COLORS),
+            'has_georef': 'georeference_data' in self.params,
+            'timings': {name: round(seconds, 3) for name, seconds in self.telemetry.timings.items()}
         }
+        if self.transfer:
+            metadata['transfer'] = self.transfer
+        if self.hybrid:
+            metadata['hybrid_tiles'] = self.hybrid
+        if self.stretch:
+            metadata['input_stretch'] = self.stretch
+        if self.aoi is not None:
+            metadata['aoi'] = self.aoi.as_dict()
+        if writer is not None:
+            metadata['class_stats'] = writer.statistics()
+            metadata['class_stats_csv'] = self.params['output_path'].replace('.tif', '_class_stats.csv')
+            write_class_csv(metadata['class_stats_csv'], metadata['class_stats'])
+            for kind, path in writer.output_paths().items():
+                metadata[f'{kind}_path'] = path
+            if writer.polygonizer is not None:
+                metadata['vector'] = {
+                    'features': writer.polygonizer.features,
+                    'skipped_small': writer.polygonizer.skipped,
+                }
         
         with open(metadata_path, 'w') as f:
             json.dump(metadata, f)
         
-        print("PROGRESS:100", flush=True)
-        print(f"RESULT:{metadata_path}", flush=True)
-        
         return metadata_path
 
 
-def main():
-    params_file = sys.argv[1]
-    with open(params_file, 'r') as f:
-        params = json.load(f)
+def preload_model(model_path):
+    """Загружает модель в кэш до задания; ошибку покажет само задание"""
+    from utils.model_loader import load_model
+    
+    if not model_path:
+        model_path = os.path.join(PLUGIN_DIR, 'models', 'best_model.h5')
+    try:
+        load_model(model_path)
+    except Exception:
+        traceback.print_exc(file=sys.stderr)
+
+
+def serve():
+    """Постоянный режим: задания читаются из stdin, модель остается загруженной"""
+    channel = open_channel()
+    reader = CommandReader(sys.stdin, channel)
+    reader.start()
     
-    runner = InferenceRunner(params)
-    runner.run()
+    while True:
+        command = reader.next_job()
+        if command is None:
+            break
+        if command['type'] == 'preload':
+            preload_model(command.get('model_path'))
+            continue
+        
+        telemetry = Telemetry(channel, job=command['id'])
+        # По этому сообщению родительский процесс отличает выполняемое задание от ожидающих
+        telemetry.send('started')
+        runner = InferenceRunner(command['params'], telemetry, reader.cancel_token)
+        try:
+            runner.run()
+        except InferenceCancelled as cancelled:
+            runner.discard(cancelled)
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            telemetry.send('error', message=str(e))
 
 
-if __name__ == "__main__":
+def main():
+    if sys.argv[1] == '--serve':
+        return serve()
+    
+    channel = open_channel()
+    telemetry = Telemetry(channel)
+    cancel_token = CancelToken()
+    cancel_token.listen(sys.stdin)
+    
     try:
-        main()
+        params_file = sys.argv[1]
+        with open(params_file, 'r') as f:
+            params = json.load(f)
+        
+        runner = InferenceRunner(params, telemetry, cancel_token)
+        try:
+            runner.run()
+        except InferenceCancelled as cancelled:
+            runner.discard(cancelled)
     except Exception as e:
-        print(f"ERROR: {str(e)}", file=sys.stderr, flush=True)
+        traceback.print_exc(file=sys.stderr)
+        telemetry.send('error', message=str(e))
         sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
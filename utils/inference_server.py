@@ -0,0 +1,631 @@
+# -*- coding: utf-8 -*-
+"""
+Локальный сервер инференса с динамическим объединением запросов в батчи
+
+Запуск из окружения плагина:
+    python utils/inference_server.py --model models/best_model.h5 --port 8080
+
+Эндпоинты:
+    POST /predict/      - изображение целиком (тот же контракт, что у внешнего API);
+                          с response_format=stream готовые патчи отдаются
+                          кадрами по мере предсказания (utils/wire_codecs.py)
+    POST /predict/tile  - один патч размером с окно модели
+    /jobs               - асинхронные задания (utils/server_jobs.py)
+    GET  /result/<хэш>  - готовый результат из кэша (404 при промахе)
+    GET  /codecs        - поддерживаемые кодеки передачи
+    GET  /stats         - очередь, заполнение батчей и кэш
+
+Патчи всех одновременных запросов попадают в общую очередь. Поток модели
+собирает из очереди батч до max_batch патчей, ожидая новых не дольше
+max_wait_ms после первого, поэтому параллельные запросы нескольких
+пользователей выполняются общими вызовами модели.
+
+Результаты кэшируются по хэшу пикселей (utils/result_cache.py), повторные
+запросы тех же экстентов не запускают модель.
+"""
+import argparse
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+PLUGIN_DIR = os.environ.get('PLUGIN_DIR', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if PLUGIN_DIR not in sys.path:
+    sys.path.insert(0, PLUGIN_DIR)
+
+from config import (DEFAULT_NUM_CLASSES, DEFAULT_PATCH_SIZE, DEFAULT_SUBDIVISIONS,
+                    SEGMENTATION_COLORS, SERVER_MAX_BATCH, SERVER_MAX_WAIT_MS,
+                    SERVER_CACHE_MEMORY_MB, SERVER_CACHE_DISK_MB)
+from utils.palette import colorize
+from utils.prediction import predict_img_tiled, compute_tile_coords
+from utils.result_cache import ResultCache, content_hash
+from utils.server_jobs import JobManager
+from utils.wire_codecs import (available_codecs, codec_for_content_type, decode, encode,
+                               frame_bytes, CONTENT_TYPES, FRAME_CONTENT_TYPE)
+
+
+class DynamicBatcher(threading.Thread):
+    """Объединяет патчи одновременных запросов в общие батчи модели
+
+    Модель вызывается только из этого потока, поэтому предиктор
+    не обязан быть потокобезопасным.
+    """
+
+    def __init__(self, predict_fn, max_batch=32, max_wait_ms=10):
+        super().__init__(daemon=True)
+        self.predict_fn = predict_fn
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        # Патчи другого размера ждут следующего батча
+        self._deferred = []
+        self._lock = threading.Lock()
+
+        self.batches = 0
+        self.patches = 0
+        self.max_queue_depth = 0
+        self.wait_seconds = 0.0
+        self.predict_seconds = 0.0
+
+    def predict(self, patches):
+        """Предсказание для патчей (B, H, W, C), вызывается из потоков запросов"""
+        return np.stack([future.result() for future in self.submit(patches)])
+
+    def submit(self, patches):
+        """Ставит патчи в очередь без ожидания, возвращает Future на каждый"""
+        futures = []
+        for patch in patches:
+            future = Future()
+            self.queue.put((patch, future, time.perf_counter()))
+            futures.append(future)
+
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return futures
+
+    def run(self):
+        while True:
+            batch = self._collect()
+            patches = np.stack([patch for patch, _, _ in batch])
+
+            started = time.perf_counter()
+            try:
+                predictions = self.predict_fn(patches)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            finished = time.perf_counter()
+
+            with self._lock:
+                self.batches += 1
+                self.patches += len(batch)
+                self.predict_seconds += finished - started
+                self.wait_seconds += sum(started - queued for _, _, queued in batch)
+
+            for idx, (_, future, _) in enumerate(batch):
+                future.set_result(predictions[idx])
+
+    def _collect(self):
+        """Батч патчей одного размера: до max_batch или до истечения max_wait"""
+        if self._deferred:
+            first = self._deferred.pop(0)
+        else:
+            first = self.queue.get()
+
+        batch = [first]
+        shape = first[0].shape
+        deadline = time.perf_counter() + self.max_wait
+
+        # Сначала отложенные патчи того же размера
+        for item in list(self._deferred):
+            if len(batch) >= self.max_batch:
+                break
+            if item[0].shape == shape:
+                self._deferred.remove(item)
+                batch.append(item)
+
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item[0].shape == shape:
+                batch.append(item)
+            else:
+                self._deferred.append(item)
+
+        return batch
+
+    def stats(self):
+        with self._lock:
+            batches = self.batches or 1
+            patches = self.patches or 1
+            return {
+                'queue_depth': self.queue.qsize() + len(self._deferred),
+                'max_queue_depth': self.max_queue_depth,
+                'batches': self.batches,
+                'patches': self.patches,
+                'max_batch': self.max_batch,
+                'max_wait_ms': round(self.max_wait * 1000, 1),
+                'avg_batch_size': round(self.patches / batches, 2),
+                'avg_batch_fill': round(self.patches / batches / self.max_batch, 3),
+                'avg_wait_ms': round(self.wait_seconds / patches * 1000, 2),
+                'avg_batch_ms': round(self.predict_seconds / batches * 1000, 2),
+            }
+
+
+# Предел ожидания при опросе задания, чтобы не держать поток сервера
+MAX_LONG_POLL_SECONDS = 30
+
+
+class BadRequest(Exception):
+    """Ошибка в запросе клиента (HTTP 400)"""
+
+
+class NotFound(Exception):
+    """Ресурс не найден (HTTP 404)"""
+
+
+def parse_multipart(body, content_type):
+    """Части multipart/form-data: список (заголовки, данные)"""
+    if 'boundary=' not in content_type:
+        raise BadRequest("Нет boundary в Content-Type")
+    boundary = content_type.split('boundary=', 1)[1].split(';')[0].strip().strip('"')
+    delimiter = b'--' + boundary.encode('latin-1')
+
+    parts = []
+    for chunk in body.split(delimiter)[1:]:
+        if chunk.startswith(b'--'):
+            break
+        head, _, data = chunk.partition(b'\r\n\r\n')
+        headers = {}
+        for line in head.decode('utf-8', 'replace').split('\r\n'):
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        if data.endswith(b'\r\n'):
+            data = data[:-2]
+        parts.append((headers, data))
+    return parts
+
+
+def read_image(body, content_type):
+    """Изображение (H, W, 3) uint8 из тела запроса (multipart или одно изображение)"""
+    if content_type.startswith('multipart/'):
+        parts = parse_multipart(body, content_type)
+        files = [part for part in parts if 'filename=' in part[0].get('content-disposition', '')]
+        if not files:
+            raise BadRequest("В запросе нет файла")
+        headers, data = files[0]
+        content_type = headers.get('content-type', '')
+    else:
+        data = body
+
+    codec = codec_for_content_type(content_type) or 'png'
+    try:
+        image = decode(data, codec)
+    except Exception as e:
+        raise BadRequest(f"Не удалось декодировать изображение: {e}")
+
+    if image.ndim == 2:
+        image = np.repeat(image[..., np.newaxis], 3, axis=2)
+    return np.ascontiguousarray(image[..., :3], dtype=np.uint8)
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    """HTTP-обработчик; сервер хранит батчер, кэш и задания"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self._handle(self._get)
+
+    def do_POST(self):
+        self._handle(self._post)
+
+    def do_PUT(self):
+        self._handle(self._put)
+
+    def do_DELETE(self):
+        self._handle(self._delete)
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        path = url.path.rstrip('/')
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        try:
+            method(path, query)
+        except NotFound as e:
+            self._send_json({'detail': str(e) or 'Not Found'}, status=404)
+        except (BadRequest, ValueError) as e:
+            self._send_json({'detail': str(e)}, status=400)
+        except Exception as e:
+            traceback.print_exc()
+            self._send_json({'detail': str(e)}, status=500)
+
+    def _get(self, path, query):
+        if path == '/codecs':
+            self._send_json({
+                'codecs': available_codecs(),
+                'cache': self.server.cache is not None,
+                'jobs': True,
+                'stream': True,
+            })
+        elif path.startswith('/result/'):
+            self._send_cached(path[len('/result/'):], query)
+        elif path == '/stats':
+            self._send_json(self.server.stats())
+        elif path.startswith('/jobs/'):
+            job, tile = self._job_path(path)
+            if tile is None:
+                since = int(query.get('since', 0))
+                wait = min(float(query.get('wait', 0)), MAX_LONG_POLL_SECONDS)
+                if wait > 0:
+                    job.wait(since, wait)
+                self._send_json(job.status(since, missing=query.get('missing') == '1'))
+            else:
+                data = job.results.get(tile)
+                if data is None:
+                    raise NotFound("Патч еще не готов")
+                self._send_job_tile(data, query)
+        else:
+            raise NotFound()
+
+    def _post(self, path, query):
+        if path == '/jobs':
+            request = json.loads(self._read_body() or b'{}')
+            job = self.server.jobs.create(int(request.get('tiles', 0)), int(request.get('tile_size', 0)))
+            self._send_json(job.status(), status=201)
+            return
+        if path not in ('/predict', '/predict/tile'):
+            raise NotFound()
+
+        image = read_image(self._read_body(), self.headers.get('Content-Type', ''))
+        self.server.count_request()
+
+        if path == '/predict/tile':
+            image_hash, mask = self.server.predict_tile_cached(image)
+        elif query.get('response_format') == 'stream':
+            self._send_stream(
+                image,
+                int(query.get('patch_size', DEFAULT_PATCH_SIZE)),
+                int(query.get('subdivisions', DEFAULT_SUBDIVISIONS)),
+                query
+            )
+            return
+        else:
+            patch_size = int(query.get('patch_size', DEFAULT_PATCH_SIZE))
+            subdivisions = int(query.get('subdivisions', DEFAULT_SUBDIVISIONS))
+            image_hash = content_hash(image)
+            mask = self.server.cached(image_hash, patch_size, subdivisions)
+            if mask is None:
+                mask = self.server.predict_image(image, patch_size, subdivisions)
+                self.server.store(image_hash, patch_size, subdivisions, mask)
+        self._send_mask(mask, query, image_hash)
+
+    def _put(self, path, query):
+        job, tile = self._job_path(path)
+        if tile is None:
+            raise NotFound()
+        patch = read_image(self._read_body(), self.headers.get('Content-Type', ''))
+        accepted = self.server.jobs.submit_tile(job, tile, patch)
+        self._send_json({'tile': tile, 'accepted': accepted}, status=202 if accepted else 200)
+
+    def _delete(self, path, query):
+        if not path.startswith('/jobs/') or not self.server.jobs.delete(path[len('/jobs/'):]):
+            raise NotFound()
+        self._send_json({'deleted': True})
+
+    def _job_path(self, path):
+        """Задание и номер патча из пути /jobs/<id>[/tiles/<n>]"""
+        parts = path.split('/')[2:]
+        job = self.server.jobs.get(parts[0]) if parts else None
+        if job is None:
+            raise NotFound("Задание не найдено")
+        if len(parts) == 1:
+            return job, None
+        if len(parts) == 3 and parts[1] == 'tiles':
+            return job, int(parts[2])
+        raise NotFound()
+
+    def _read_body(self):
+        length = self.headers.get('Content-Length')
+        if length is None:
+            raise BadRequest("Content-Length required")
+        return self.rfile.read(int(length))
+
+    def _send_cached(self, image_hash, query):
+        """Результат из кэша без загрузки изображения"""
+        try:
+            patch_size = int(query.get('patch_size', DEFAULT_PATCH_SIZE))
+            subdivisions = int(query.get('subdivisions', DEFAULT_SUBDIVISIONS))
+        except ValueError as e:
+            self._send_json({'detail': str(e)}, status=400)
+            return
+
+        mask = self.server.cached(image_hash, patch_size, subdivisions)
+        if mask is None:
+            self._send_json({'detail': 'Not Cached'}, status=404)
+        else:
+            self._send_mask(mask, query, image_hash)
+
+    def _send_mask(self, mask, query, image_hash=None):
+        """Маска классов в запрошенном кодеке или RGB PNG для старых клиентов"""
+        if query.get('response_format') == 'mask':
+            codec = query.get('response_codec', 'png')
+            if codec not in available_codecs() or codec == 'webp':
+                codec = 'png'
+            data = encode(mask, codec, SEGMENTATION_COLORS)
+        else:
+            codec = 'png'
+            data = encode(colorize(mask, SEGMENTATION_COLORS), codec)
+        headers = {'ETag': f'"{image_hash}"'} if image_hash else {}
+        self._send_bytes(data, CONTENT_TYPES[codec], headers=headers)
+
+    def _send_stream(self, image, patch_size, subdivisions, query):
+        """Потоковый ответ: кадр сетки, кадры готовых патчей по неубыванию строки, кадр конца
+
+        Патч - маска классов (stream_content=mask) или вероятности,
+        квантованные в uint8 (stream_content=probs, только кодеки raw).
+        Следующая группа патчей ставится в батчер до отправки текущей.
+        """
+        if patch_size <= 0 or subdivisions <= 0:
+            raise BadRequest("patch_size и subdivisions должны быть положительными")
+        content = 'probs' if query.get('stream_content') == 'probs' else 'mask'
+        codec = query.get('response_codec', 'png')
+        if codec not in available_codecs() or codec == 'webp':
+            codec = 'png'
+        if content == 'probs' and not codec.startswith('raw'):
+            codec = 'raw'
+
+        h, w = image.shape[:2]
+        if h <= patch_size and w <= patch_size:
+            source = np.zeros((patch_size, patch_size, 3), dtype=np.uint8)
+            source[:h, :w] = image
+            coords, overlap = [(0, 0)], 0
+        else:
+            source = image
+            coords, overlap = compute_tile_coords(h, w, patch_size, subdivisions)
+        coords.sort()
+
+        self.send_response(200)
+        self.send_header('Content-Type', FRAME_CONTENT_TYPE)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self._write_chunk(frame_bytes({
+            'type': 'start',
+            'height': h,
+            'width': w,
+            'tiles': len(coords),
+            'window': patch_size,
+            'overlap': overlap,
+            'content': content,
+        }))
+
+        step = self.server.batcher.max_batch
+        groups = [coords[start:start + step] for start in range(0, len(coords), step)]
+
+        def submit(group):
+            return self.server.batcher.submit(
+                [source[y:y+patch_size, x:x+patch_size] for y, x in group]
+            )
+
+        with self.server.count_active():
+            try:
+                pending = submit(groups[0])
+                for index, group in enumerate(groups):
+                    futures = pending
+                    if index + 1 < len(groups):
+                        pending = submit(groups[index + 1])
+                    for (y, x), future in zip(group, futures):
+                        prediction = future.result()
+                        if content == 'probs':
+                            array = np.clip(prediction * 255 + 0.5, 0, 255).astype(np.uint8)
+                            data = encode(array, codec)
+                        else:
+                            array = np.argmax(prediction, axis=2).astype(np.uint8)
+                            data = encode(array, codec, SEGMENTATION_COLORS)
+                        self._write_chunk(frame_bytes(
+                            {'type': 'tile', 'y': y, 'x': x, 'codec': codec, 'content': content},
+                            data
+                        ))
+                self._write_chunk(frame_bytes({'type': 'end'}))
+            except (BrokenPipeError, ConnectionResetError):
+                # Клиент отключился (например, отмена)
+                self.close_connection = True
+                return
+            except Exception as e:
+                traceback.print_exc()
+                self._write_chunk(frame_bytes({'type': 'error', 'detail': str(e)}))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _write_chunk(self, data):
+        """Фрагмент ответа с Transfer-Encoding: chunked"""
+        self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+
+    def _send_job_tile(self, data, query):
+        """Готовый патч задания; хранится как PNG с палитрой"""
+        codec = query.get('response_codec', 'png')
+        if codec == 'png' or codec not in available_codecs() or codec == 'webp':
+            self._send_bytes(data, CONTENT_TYPES['png'])
+        else:
+            self._send_bytes(encode(decode(data, 'png'), codec), CONTENT_TYPES[codec])
+
+    def _send_json(self, payload, status=200):
+        self._send_bytes(json.dumps(payload).encode('utf-8'), 'application/json', status)
+
+    def _send_bytes(self, data, content_type, status=200, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class InferenceServer(ThreadingHTTPServer):
+    """HTTP-сервер с общей моделью и динамическим батчингом"""
+
+    daemon_threads = True
+
+    def __init__(self, address, predict_fn, model_name, max_batch=SERVER_MAX_BATCH,
+                 max_wait_ms=SERVER_MAX_WAIT_MS, cache=None, verbose=False):
+        super().__init__(address, InferenceHandler)
+        self.model_name = model_name
+        self.cache = cache
+        self.verbose = verbose
+        self.batcher = DynamicBatcher(predict_fn, max_batch, max_wait_ms)
+        self.batcher.start()
+        # Потоков заданий не меньше батча, иначе батчи не заполняются
+        self.jobs = JobManager(self._predict_job_tile, workers=max(4, max_batch))
+        self.started = time.time()
+        self.requests = 0
+        self.active_requests = 0
+        self._lock = threading.Lock()
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    @contextmanager
+    def count_active(self):
+        """Учет выполняющихся запросов изображения целиком"""
+        with self._lock:
+            self.active_requests += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active_requests -= 1
+
+    def cached(self, image_hash, patch_size, subdivisions):
+        """Маска из кэша или None"""
+        if self.cache is None:
+            return None
+        return self.cache.get(ResultCache.key(image_hash, self.model_name, patch_size, subdivisions))
+
+    def store(self, image_hash, patch_size, subdivisions, mask):
+        if self.cache is not None:
+            self.cache.put(ResultCache.key(image_hash, self.model_name, patch_size, subdivisions), mask)
+
+    def predict_image(self, image, patch_size, subdivisions):
+        """Маска классов для изображения целиком"""
+        if patch_size <= 0 or subdivisions <= 0:
+            raise BadRequest("patch_size и subdivisions должны быть положительными")
+
+        with self.count_active():
+            predictions = predict_img_tiled(
+                image,
+                window_size=patch_size,
+                subdivisions=subdivisions,
+                nb_classes=DEFAULT_NUM_CLASSES,
+                pred_func=self.batcher.predict,
+                batch_size=self.batcher.max_batch
+            )
+        return np.argmax(predictions, axis=2).astype(np.uint8)
+
+    def predict_tile(self, patch):
+        """Маска классов для одного патча"""
+        prediction = self.batcher.predict(patch[np.newaxis, ...])[0]
+        return np.argmax(prediction, axis=2).astype(np.uint8)
+
+    def predict_tile_cached(self, patch):
+        """(хэш, маска) патча с использованием кэша"""
+        image_hash = content_hash(patch)
+        mask = self.cached(image_hash, patch.shape[0], 1)
+        if mask is None:
+            mask = self.predict_tile(patch)
+            self.store(image_hash, patch.shape[0], 1, mask)
+        return image_hash, mask
+
+    def _predict_job_tile(self, patch):
+        return self.predict_tile_cached(patch)[1]
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'model': self.model_name,
+                'uptime_sec': round(time.time() - self.started, 1),
+                'requests': self.requests,
+                'active_requests': self.active_requests,
+            }
+        stats.update(self.batcher.stats())
+        stats.update(self.jobs.stats())
+        if self.cache is not None:
+            stats.update(self.cache.stats())
+        return stats
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Локальный сервер инференса сегментации")
+    parser.add_argument('--model', default=os.path.join(PLUGIN_DIR, 'models', 'best_model.h5'),
+                        help="Файл модели")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch', type=int, default=SERVER_MAX_BATCH,
+                        help="Максимум патчей в одном вызове модели")
+    parser.add_argument('--max-wait-ms', type=float, default=SERVER_MAX_WAIT_MS,
+                        help="Сколько ждать патчи других запросов для заполнения батча")
+    parser.add_argument('--cache-dir', default=os.path.join(tempfile.gettempdir(), 'segmentation_cache'),
+                        help="Каталог кэша результатов")
+    parser.add_argument('--cache-memory-mb', type=float, default=SERVER_CACHE_MEMORY_MB,
+                        help="Размер кэша в памяти, МБ (0 - кэш отключен)")
+    parser.add_argument('--cache-disk-mb', type=float, default=SERVER_CACHE_DISK_MB,
+                        help="Размер кэша на диске, МБ (0 - только память)")
+    parser.add_argument('--verbose', action='store_true', help="Логировать каждый запрос")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    from utils.model_loader import load_model
+    from utils.result_cache import model_id
+    _, predictor = load_model(args.model)
+
+    cache = None
+    if args.cache_memory_mb > 0:
+        cache = ResultCache(
+            args.cache_dir if args.cache_disk_mb > 0 else None,
+            memory_bytes=int(args.cache_memory_mb * 1024 ** 2),
+            disk_bytes=int(args.cache_disk_mb * 1024 ** 2)
+        )
+
+    server = InferenceServer(
+        (args.host, args.port),
+        predictor,
+        model_id(args.model),
+        max_batch=args.max_batch,
+        max_wait_ms=args.max_wait_ms,
+        cache=cache,
+        verbose=args.verbose
+    )
+    print(f"Сервер инференса: http://{args.host}:{args.port} "
+          f"(батч до {args.max_batch}, ожидание {args.max_wait_ms} мс)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Протокол обмена сообщениями между worker'ом и процессом инференса
+
+Каждое сообщение - один JSON-объект на строку (JSON lines) с обязательным
+полем "type". Канал сообщений - исходный stdout процесса инференса;
+print() и логи библиотек перенаправляются в stderr, чтобы не смешиваться
+с протоколом.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+PROTOCOL_VERSION = 1
+
+# Доли общего прогресса для этапов обработки
+STAGE_PROGRESS = {
+    'load_model': (0, 20),
+    'read_input': (20, 25),
+    'inference': (25, 90),
+    'save': (90, 100),
+}
+
+
+def open_channel():
+    """Отделяет канал протокола от stdout процесса
+
+    Дублирует дескриптор stdout для сообщений протокола, а сам stdout
+    (включая вывод C-библиотек) перенаправляет в stderr.
+    """
+    sys.stdout.flush()
+    channel_fd = os.dup(sys.stdout.fileno())
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+    return os.fdopen(channel_fd, 'w', encoding='utf-8', buffering=1)
+
+
+def encode_message(msg_type, **fields):
+    """Кодирует сообщение протокола в одну строку"""
+    message = {'type': msg_type, 'v': PROTOCOL_VERSION, 'ts': time.time()}
+    message.update(fields)
+    return json.dumps(message, ensure_ascii=False) + '\n'
+
+
+def decode_message(line):
+    """Декодирует строку протокола, для посторонних строк возвращает None"""
+    line = line.strip()
+    if not line.startswith('{'):
+        return None
+    try:
+        message = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(message, dict) or 'type' not in message:
+        return None
+    return message
+
+
+class InferenceCancelled(Exception):
+    """Обработка остановлена по запросу пользователя"""
+
+    def __init__(self, tiles_done=0, tiles_total=0):
+        super().__init__("Обработка остановлена пользователем")
+        self.tiles_done = tiles_done
+        self.tiles_total = tiles_total
+
+
+class CancelToken:
+    """Флаг отмены, который проверяется между батчами"""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self, tiles_done=0, tiles_total=0):
+        """Прерывает обработку, если запрошена отмена"""
+        if self._event.is_set():
+            raise InferenceCancelled(tiles_done, tiles_total)
+
+    def listen(self, stream):
+        """Слушает команды отмены во входном потоке процесса"""
+        def read_commands():
+            try:
+                for line in iter(stream.readline, ''):
+                    message = decode_message(line)
+                    if message is not None and message['type'] == 'cancel':
+                        self.cancel()
+            except (OSError, ValueError):
+                pass
+            # Входной поток закрыт - родительский процесс больше не ждет результат
+            self.cancel()
+
+        thread = threading.Thread(target=read_commands, daemon=True)
+        thread.start()
+        return thread
+
+
+class CommandReader(threading.Thread):
+    """Чтение заданий и команд отмены из stdin постоянного процесса
+
+    Отмена текущего задания взводит его флаг отмены. Задание, которое еще
+    ждет в очереди, убирается из нее, и отмена сразу подтверждается
+    сообщением 'cancelled' в канал.
+    """
+
+    def __init__(self, stream, channel=None):
+        super().__init__(daemon=True)
+        self.stream = stream
+        self.channel = channel
+        self.pending = deque()
+        self.cancel_token = CancelToken()
+        self.current_job = None
+        self._condition = threading.Condition()
+
+    def run(self):
+        try:
+            for line in iter(self.stream.readline, ''):
+                message = decode_message(line)
+                if message is None:
+                    continue
+                if message['type'] == 'shutdown':
+                    break
+                if message['type'] == 'cancel':
+                    self._cancel(message.get('job'))
+                else:
+                    self._put(message)
+        except (OSError, ValueError):
+            pass
+
+        # Входной поток закрыт - родительский процесс больше не ждет результатов
+        self.cancel_token.cancel()
+        self._put(None)
+
+    def _put(self, message):
+        with self._condition:
+            self.pending.append(message)
+            self._condition.notify()
+
+    def _cancel(self, job_id):
+        with self._condition:
+            if job_id is None or job_id == self.current_job:
+                self.cancel_token.cancel()
+                return
+            queued = [message for message in self.pending
+                      if message is not None and message.get('id') == job_id]
+            for message in queued:
+                self.pending.remove(message)
+
+        if queued:
+            Telemetry(self.channel, job=job_id).send(
+                'cancelled', tiles_done=0, tiles_total=0, seconds_discarded=0
+            )
+
+    def next_job(self):
+        """Следующее задание со своим флагом отмены, None при завершении"""
+        with self._condition:
+            while not self.pending:
+                self._condition.wait()
+            message = self.pending.popleft()
+            if message is None:
+                self.current_job = None
+                return None
+            self.current_job = message.get('id')
+            self.cancel_token = CancelToken()
+            return message
+
+
+class Telemetry:
+    """Отправка прогресса и таймингов этапов в канал протокола"""
+
+    # Канал общий для заданий и потока чтения команд
+    _channel_lock = threading.Lock()
+
+    def __init__(self, channel=None, min_interval=0.25, job=None):
+        self.channel = channel
+        self.min_interval = min_interval
+        self.job = job
+        self.timings = {}
+        self.tiles_done = 0
+        self.tiles_total = 0
+        self._stage = None
+        self._tiles_started = None
+        self._last_emit = 0.0
+
+    def send(self, msg_type, **fields):
+        """Отправляет сообщение в канал"""
+        if self.channel is None:
+            return
+        if self.job is not None:
+            fields['job'] = self.job
+        with self._channel_lock:
+            self.channel.write(encode_message(msg_type, **fields))
+            self.channel.flush()
+
+    def percent(self, stage, fraction=0.0):
+        """Переводит долю выполнения этапа в общий процент"""
+        start, end = STAGE_PROGRESS.get(stage, (0, 100))
+        fraction = min(max(fraction, 0.0), 1.0)
+        return int(start + (end - start) * fraction)
+
+    @contextmanager
+    def stage(self, name):
+        """Замеряет длительность этапа и сообщает о его начале и конце"""
+        self._stage = name
+        started = time.perf_counter()
+        self._tiles_started = started
+        self.send('stage', name=name, status='started', percent=self.percent(name))
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+            self.send('stage', name=name, status='finished', seconds=round(seconds, 3),
+                      percent=self.percent(name, 1.0))
+
+    def tiles(self, done, total):
+        """Прогресс по тайлам: скорость и оценка оставшегося времени"""
+        self.tiles_done = done
+        self.tiles_total = total
+        now = time.perf_counter()
+        if self._tiles_started is None:
+            self._tiles_started = now
+        if done < total and now - self._last_emit < self.min_interval:
+            return
+        self._last_emit = now
+
+        elapsed = now - self._tiles_started
+        tiles_per_sec = done / elapsed if elapsed > 0 else 0.0
+        eta = (total - done) / tiles_per_sec if tiles_per_sec > 0 else None
+        fraction = done / total if total else 1.0
+        self.send(
+            'progress',
+            stage=self._stage,
+            tiles_done=done,
+            tiles_total=total,
+            tiles_per_sec=round(tiles_per_sec, 3),
+            eta_sec=round(eta, 1) if eta is not None else None,
+            percent=self.percent(self._stage or 'inference', fraction)
+        )
+
+
+class StreamDrainer(threading.Thread):
+    """Фоновое чтение потока процесса с хранением последних строк"""
+
+    def __init__(self, stream, max_lines=200):
+        super().__init__(daemon=True)
+        self.stream = stream
+        self.lines = deque(maxlen=max_lines)
+
+    def run(self):
+        try:
+            for line in iter(self.stream.readline, ''):
+                line = line.rstrip()
+                if line:
+                    self.lines.append(line)
+        except (OSError, ValueError):
+            pass
+
+    def tail(self, count=20):
+        """Последние строки потока"""
+        return '\n'.join(list(self.lines)[-count:])
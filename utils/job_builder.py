@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Подготовка входных данных и параметров задания инференса
+
+Используется диалогом плагина и алгоритмом Processing.
+"""
+import json
+import os
+import tempfile
+
+from qgis.core import (
+    QgsCoordinateTransform, QgsGeometry, QgsProject, QgsRasterBlockFeedback, QgsRectangle
+)
+
+from .image_utils import ImageProcessor
+from .block_exporter import BlockStreamExporter
+
+
+def default_model_path(plugin_dir):
+    """Путь к модели по умолчанию"""
+    return os.path.join(plugin_dir, 'models', 'best_model.h5')
+
+
+def resolve_target_gsd(target_gsd):
+    """Разрешение обработки: число, 'model' (MODEL_GSD из config) или None - исходное
+
+    Raises:
+        ValueError: выбран режим 'model', а MODEL_GSD не задан
+    """
+    if target_gsd == 'model':
+        from ..config import MODEL_GSD
+        if MODEL_GSD is None:
+            raise ValueError("Разрешение обучения модели не задано (MODEL_GSD в config.py)")
+        return MODEL_GSD
+    return float(target_gsd) if target_gsd else None
+
+
+def prepare_input(layer, extent=None, fallback_units_per_pixel=None, defer_export=False,
+                  target_gsd=None):
+    """Готовит входной растр для процесса инференса
+
+    Файловые растры читаются в subprocess напрямую, для WMS/XYZ/WCS
+    запускается потоковая загрузка блоков, остальные слои экспортируются
+    во временный GeoTIFF. С defer_export экспорт не выполняется сразу:
+    в ключе export возвращается LayerExport для запуска вне потока интерфейса.
+    target_gsd (единиц CRS на пиксель, см. resolve_target_gsd) огрубляет
+    разрешение: экспорт и загрузка блоков выполняются сразу в уменьшенном
+    размере, файловые растры читаются с уменьшением в subprocess.
+
+    Returns:
+        словарь с ключами input_source, input_path, extent, exporter и export
+    """
+    prepared = {
+        'input_source': ImageProcessor.describe_layer_source(layer, extent),
+        'input_path': None,
+        'extent': extent if extent is not None else layer.extent(),
+        'exporter': None,
+        'export': None,
+    }
+
+    if prepared['input_source'] is not None:
+        prepared['extent'] = prepared['input_source'].pop('extent')
+        return prepared
+
+    if layer.providerType() != 'gdal':
+        exporter = start_block_export(layer, prepared['extent'], fallback_units_per_pixel, target_gsd)
+        if exporter is not None:
+            prepared['input_source'] = exporter.input_source()
+            prepared['exporter'] = exporter
+            return prepared
+
+    if defer_export:
+        # Экспорт выполнит поток обработки, параллельно с загрузкой модели
+        prepared['export'] = LayerExport(layer, extent, target_gsd)
+        prepared['input_path'] = prepared['export'].output_path
+    else:
+        prepared['input_path'] = export_layer(layer, extent, target_gsd)
+    return prepared
+
+
+def start_block_export(layer, extent, fallback_units_per_pixel=None, target_gsd=None):
+    """Запуск потоковой загрузки блоков слоя, None если она недоступна"""
+    try:
+        if fallback_units_per_pixel is None:
+            fallback_units_per_pixel = layer.rasterUnitsPerPixelX()
+        width, height = BlockStreamExporter.estimate_size(layer, extent, fallback_units_per_pixel,
+                                                          target_gsd)
+        exporter = BlockStreamExporter(layer, extent, width, height)
+        exporter.start()
+        return exporter
+    except Exception as e:
+        print(f"Потоковый экспорт недоступен: {str(e)}")
+        return None
+
+
+class LayerExport:
+    """Экспорт слоя во временный GeoTIFF вне потока интерфейса
+
+    Обращения к слою (клон провайдера, размеры, CRS) выполняются при создании
+    в потоке интерфейса, сама запись - в run() из потока обработки, с
+    прогрессом и отменой.
+    """
+
+    def __init__(self, layer, extent=None, target_gsd=None):
+        temp_input = tempfile.NamedTemporaryFile(suffix='.tif', delete=False)
+        temp_input.close()
+        self.output_path = temp_input.name
+        self.source = layer.source()
+        self.extent = QgsRectangle(extent) if extent is not None else None
+        self.target_gsd = target_gsd
+        self.arguments = ImageProcessor.export_arguments(layer, extent, target_gsd)
+        self.feedback = QgsRasterBlockFeedback()
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        self.feedback.cancel()
+
+    def run(self, progress_callback=None):
+        """Выполняет экспорт, возвращает путь к файлу
+
+        Args:
+            progress_callback: функция(доля 0..1)
+
+        Returns:
+            путь к GeoTIFF или None, если экспорт отменен
+        """
+        # Пробуем сначала альтернативный метод через GDAL
+        success = ImageProcessor.export_qgis_layer_simple(
+            self.source, self.output_path, self.extent,
+            progress_callback=progress_callback, cancel_check=lambda: self.cancelled,
+            target_gsd=self.target_gsd
+        )
+
+        # Если не получилось, используем основной метод
+        if not success and not self.cancelled:
+            if progress_callback is not None:
+                self.feedback.progressChanged.connect(lambda value: progress_callback(value / 100.0))
+            provider, x_size, y_size, extent, crs = self.arguments
+            success = ImageProcessor.write_provider(
+                provider, self.output_path, x_size, y_size, extent, crs, self.feedback
+            )
+
+        if self.cancelled or not success or not os.path.exists(self.output_path):
+            self.cleanup()
+            if self.cancelled:
+                return None
+
+            raise Exception(
+                "Не удалось экспортировать растровый слой. "
+                "Убедитесь, что слой корректный и доступен для чтения."
+            )
+
+        return self.output_path
+
+    def cleanup(self):
+        """Удаляет временный файл"""
+        try:
+            os.unlink(self.output_path)
+        except OSError:
+            pass
+
+
+def export_layer(layer, extent=None, target_gsd=None):
+    """Экспорт слоя во временный GeoTIFF для источников, недоступных GDAL"""
+    return LayerExport(layer, extent, target_gsd).run()
+
+
+def prepare_aoi(features, source_crs, target_crs):
+    """Полигоны области интереса в CRS растра для параметров задания
+
+    Returns:
+        ({'geometries': GeoJSON-геометрии, 'ids': номера объектов}, охватывающий
+        QgsRectangle) или (None, None), если непустых геометрий нет
+    """
+    transform = QgsCoordinateTransform(source_crs, target_crs, QgsProject.instance())
+    geometries = []
+    ids = []
+    bounds = QgsRectangle()
+    bounds.setMinimal()
+    for feature in features:
+        geometry = QgsGeometry(feature.geometry())
+        if geometry.isNull() or geometry.isEmpty():
+            continue
+        geometry.transform(transform)
+        geometries.append(json.loads(geometry.asJson()))
+        ids.append(feature.id())
+        bounds.combineExtentWith(geometry.boundingBox())
+
+    if not geometries:
+        return None, None
+    return {'geometries': geometries, 'ids': ids}, bounds
+
+
+def aoi_extent(extent, layer, bounds):
+    """Экстент обработки, ограниченный охватом AOI
+
+    Raises:
+        ValueError: AOI не пересекает экстент
+    """
+    extent = QgsRectangle(extent if extent is not None else layer.extent())
+    extent = extent.intersect(bounds)
+    if extent.isEmpty():
+        raise ValueError("Область интереса не пересекает обрабатываемый экстент")
+    return extent
+
+
+def build_params(layer, prepared, output_path, model_path, patch_size, subdivisions,
+                 use_api=False, api_url='', use_hybrid=False, target_gsd=None, aoi=None,
+                 output_confidence=False, output_probabilities=False, output_vector=False,
+                 vector_simplify=None, vector_min_area=None, output_preview=False):
+    """Словарь JSON-сериализуемых параметров задания
+
+    vector_simplify и vector_min_area по умолчанию берутся из config.
+    output_preview - сообщать путь заполняемого результата для слоя предпросмотра.
+    """
+    from ..config import VECTOR_SIMPLIFY, VECTOR_MIN_AREA
+
+    extent = prepared['extent']
+    return {
+        'input_path': prepared['input_path'],
+        'input_source': prepared['input_source'],
+        'output_path': output_path,
+        'use_api': use_api,
+        'use_hybrid': use_hybrid,
+        'api_url': api_url,
+        'model_path': model_path,
+        'patch_size': patch_size,
+        'subdivisions': subdivisions,
+        'target_gsd': target_gsd,
+        # Полигоны AOI (GeoJSON в CRS растра): патчи вне них пропускаются
+        'aoi': aoi,
+        'output_confidence': output_confidence,
+        'output_probabilities': output_probabilities,
+        # Полигоны классов в GeoPackage
+        'output_vector': output_vector,
+        'vector_simplify': VECTOR_SIMPLIFY if vector_simplify is None else vector_simplify,
+        'vector_min_area': VECTOR_MIN_AREA if vector_min_area is None else vector_min_area,
+        'output_preview': output_preview,
+        'crs': layer.crs().toWkt(),
+        # Передаем геоданные для использования в subprocess
+        'georeference_data': {
+            'extent_xmin': extent.xMinimum(),
+            'extent_xmax': extent.xMaximum(),
+            'extent_ymin': extent.yMinimum(),
+            'extent_ymax': extent.yMaximum(),
+            'crs': layer.crs().toWkt()
+        }
+    }
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+Клиент асинхронных заданий API (utils/server_jobs.py)
+
+Изображение режется той же сеткой, что и в predict_img_tiled. Патчи
+загружаются в задание параллельно, готовые результаты забираются по мере
+выполнения через опрос с ожиданием. Скачанные маски патчей и номер задания
+хранятся в каталоге состояния на диске, поэтому после перезапуска клиента
+обработка того же растра продолжается: готовые патчи не запрашиваются
+заново, а загружаются только те, которых нет на сервере.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import requests
+
+from utils.api_client import TiledApiClient, TileRequestError, one_hot
+from utils.prediction import compute_tile_coords, BlendCanvas, RollingCanvas
+from utils.server_jobs import JOB_TTL_SECONDS
+from utils.wire_codecs import encode, CONTENT_TYPES
+
+
+class JobLost(Exception):
+    """Задание не найдено на сервере (перезапуск или истечение срока)"""
+
+
+def job_signature(params, shape, window_size, subdivisions):
+    """Подпись задания для возобновления, None если источник не файловый
+
+    Учитывает файл растра (путь, размер, время изменения), окно чтения,
+    сетку патчей, AOI и адрес сервера.
+    """
+    source = params.get('input_source') or {}
+    path = source.get('path') if source.get('type') != 'stream' else None
+    path = path or params.get('input_path')
+    if not path or not os.path.exists(path):
+        return None
+
+    stat = os.stat(path)
+    raw = json.dumps([
+        os.path.abspath(path), stat.st_size, int(stat.st_mtime), source.get('window'),
+        list(shape[:2]), window_size, subdivisions, params.get('aoi'),
+        params.get('api_url', '').rstrip('/')
+    ])
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def job_state_dir(signature):
+    return os.path.join(job_states_root(), signature)
+
+
+def job_states_root():
+    return os.path.join(tempfile.gettempdir(), 'segmentation_jobs')
+
+
+def prune_job_states(root=None, ttl=JOB_TTL_SECONDS, keep=None):
+    """Удаляет брошенные каталоги состояния, не изменявшиеся дольше ttl
+
+    Задание на сервере к этому времени тоже истекло, так что возобновить
+    такой растр (другой экстент, измененный файл) уже нельзя.
+    """
+    root = root or job_states_root()
+    if not os.path.isdir(root):
+        return
+    deadline = time.time() - ttl
+    keep = keep and os.path.normcase(os.path.abspath(keep))
+    for name in os.listdir(root):
+        directory = os.path.join(root, name)
+        if not os.path.isdir(directory) or os.path.normcase(os.path.abspath(directory)) == keep:
+            continue
+        try:
+            changed = max([os.path.getmtime(directory)] + [
+                os.path.getmtime(os.path.join(directory, entry)) for entry in os.listdir(directory)
+            ])
+        except OSError:
+            continue
+        if changed < deadline:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+class JobState:
+    """Состояние задания на диске: номер задания и скачанные маски патчей"""
+
+    def __init__(self, directory, tiles_total, tile_size):
+        self.directory = directory
+        self.tiles_total = tiles_total
+        self.tile_size = tile_size
+        self.job_id = None
+
+        os.makedirs(directory, exist_ok=True)
+        info_path = os.path.join(directory, 'job.json')
+        info = {}
+        if os.path.exists(info_path):
+            with open(info_path, 'r') as f:
+                info = json.load(f)
+
+        resume = (info.get('tiles_total') == tiles_total and info.get('tile_size') == tile_size)
+        mode = 'r+' if resume else 'w+'
+        self.masks = np.memmap(os.path.join(directory, 'masks.u8'), dtype=np.uint8, mode=mode,
+                               shape=(tiles_total, tile_size, tile_size))
+        self.done = np.memmap(os.path.join(directory, 'done.u8'), dtype=np.uint8, mode=mode,
+                              shape=(tiles_total,))
+        if resume:
+            self.job_id = info.get('job')
+        self.done_count = int(np.count_nonzero(self.done))
+        self._save()
+
+    @property
+    def resumed_tiles(self):
+        return self.done_count
+
+    def set_job(self, job_id):
+        self.job_id = job_id
+        self._save()
+
+    def mark_done(self, index, mask):
+        if self.done[index]:
+            return
+        self.masks[index] = mask
+        self.done[index] = 1
+        self.done_count += 1
+
+    def flush(self):
+        self.masks.flush()
+        self.done.flush()
+
+    def remove(self):
+        del self.masks, self.done
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _save(self):
+        with open(os.path.join(self.directory, 'job.json'), 'w') as f:
+            json.dump({
+                'job': self.job_id,
+                'tiles_total': self.tiles_total,
+                'tile_size': self.tile_size,
+            }, f)
+
+
+class JobApiClient(TiledApiClient):
+    """Выполнение растра асинхронным заданием с возобновлением"""
+
+    # Пока есть свои запросы, клиент ждет их и опрашивает задание
+    # не чаще POLL_INTERVAL; после загрузки - опрос с ожиданием на сервере
+    POLL_INTERVAL = 0.25
+    POLL_WAIT_IDLE = 5.0
+    # Сбрасывать состояние на диск каждые N скачанных патчей
+    FLUSH_EVERY = 256
+
+    def __init__(self, api_url, colors, **kwargs):
+        super().__init__(api_url, colors, **kwargs)
+        self.state = None
+        self.job_id = None
+        self.resumed_tiles = 0
+        self._last_poll = 0.0
+
+    def predict_job(self, input_img, window_size, subdivisions, nb_classes, state_dir,
+                    progress_callback=None, cancel_check=None, tile_filter=None, sink=None):
+        """Предсказание через задание API
+
+        Args:
+            input_img: изображение (H, W, 3) uint8 или источник со срезами
+            window_size, subdivisions: параметры сетки, как в predict_img_tiled
+            nb_classes: количество классов
+            state_dir: каталог состояния для возобновления
+            progress_callback, cancel_check, tile_filter: как в predict_img_tiled
+            sink: как в predict_tiled; маски патчей смешиваются из состояния
+                на диске по порядку строк
+
+        Returns:
+            numpy array с голосами классов (H, W, nb_classes), с sink - None
+        """
+        h, w = input_img.shape[:2]
+        if h <= window_size and w <= window_size:
+            return self.predict_tiled(input_img, window_size, subdivisions, nb_classes,
+                                      progress_callback, cancel_check, sink=sink)
+
+        coords, overlap = compute_tile_coords(h, w, window_size, subdivisions, tile_filter)
+        total = len(coords)
+        self.state = JobState(state_dir, total, window_size)
+        self.resumed_tiles = self.state.resumed_tiles
+
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            self._drain(input_img, coords, window_size, executor, progress_callback, cancel_check)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.state.flush()
+
+        if sink is None:
+            canvas = BlendCanvas(h, w, nb_classes, window_size, overlap)
+            for index, (y, x) in enumerate(coords):
+                canvas.add(y, x, one_hot(self.state.masks[index], nb_classes))
+            return canvas.result()
+
+        canvas = RollingCanvas(h, w, nb_classes, window_size, overlap, sink)
+        for index in sorted(range(total), key=coords.__getitem__):
+            canvas.add(*coords[index], one_hot(self.state.masks[index], nb_classes))
+        canvas.close()
+        return None
+
+    def finish(self):
+        """Удаляет задание на сервере и состояние после сохранения результата"""
+        if self.job_id:
+            try:
+                self.session.delete(f"{self.api_url}/jobs/{self.job_id}", timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                pass
+        if self.state is not None:
+            self.state.remove()
+            self.state = None
+
+    def _drain(self, input_img, coords, window_size, executor, progress_callback, cancel_check):
+        """Загрузка патчей и скачивание результатов до готовности всех патчей"""
+        state = self.state
+        total = len(coords)
+        max_in_flight = self.concurrency * 2
+
+        to_upload = self._open_job(total, window_size)
+        uploads = {}
+        downloads = {}
+        attempts = {}
+        seq = 0
+        flushed = state.done_count
+
+        while state.done_count < total:
+            if cancel_check:
+                cancel_check(state.done_count, total)
+
+            while to_upload and len(uploads) + len(downloads) < max_in_flight:
+                index = to_upload.popleft()
+                y, x = coords[index]
+                patch = np.ascontiguousarray(input_img[y:y+window_size, x:x+window_size])
+                uploads[executor.submit(self._upload, index, patch)] = index
+
+            try:
+                seq = self._collect(seq, state, to_upload, uploads, downloads, attempts, executor)
+            except JobLost:
+                # Сервер потерял задание: новое задание, недостающие патчи заново
+                for future in list(uploads) + list(downloads):
+                    future.cancel()
+                wait(list(uploads) + list(downloads))
+                uploads.clear()
+                downloads.clear()
+                to_upload = self._open_job(total, window_size, recreate=True)
+                seq = 0
+                continue
+
+            if state.done_count - flushed >= self.FLUSH_EVERY:
+                state.flush()
+                flushed = state.done_count
+            if progress_callback:
+                progress_callback(state.done_count, total)
+
+    def _collect(self, seq, state, to_upload, uploads, downloads, attempts, executor):
+        """Опрос задания: скачивание готовых патчей и повтор необработанных"""
+        if uploads or to_upload or downloads:
+            wait(list(uploads) + list(downloads), timeout=self.POLL_INTERVAL,
+                 return_when=FIRST_COMPLETED)
+            now = time.perf_counter()
+            if now - self._last_poll >= self.POLL_INTERVAL:
+                self._last_poll = now
+                status = self._status(since=seq)
+            else:
+                status = {'seq': seq, 'completed': []}
+        else:
+            status = self._status(since=seq, wait=self.POLL_WAIT_IDLE)
+
+        in_progress = set(downloads.values())
+        for index in status['completed']:
+            if not state.done[index] and index not in in_progress:
+                downloads[executor.submit(self._download, index)] = index
+
+        # Патчи, не обработанные сервером, загружаются повторно
+        queued = set(to_upload) | set(uploads.values())
+        for key, message in status.get('errors', {}).items():
+            index = int(key)
+            if state.done[index] or index in queued or index in in_progress:
+                continue
+            attempts[index] = attempts.get(index, 0) + 1
+            if attempts[index] > self.retries:
+                raise TileRequestError(f"Патч {index} не обработан сервером: {message}")
+            to_upload.append(index)
+
+        for future in [future for future in uploads if future.done()]:
+            uploads.pop(future)
+            future.result()
+        for future in [future for future in downloads if future.done()]:
+            index = downloads.pop(future)
+            state.mark_done(index, future.result())
+
+        return status['seq']
+
+    def _open_job(self, total, window_size, recreate=False):
+        """Создает или возобновляет задание, возвращает очередь патчей к загрузке"""
+        state = self.state
+        missing = None
+        if state.job_id and not recreate:
+            try:
+                self.job_id = state.job_id
+                missing = set(self._status(since=0, missing=True)['missing'])
+            except JobLost:
+                missing = None
+
+        if missing is None:
+            response = self._request('POST', '/jobs', json={'tiles': total, 'tile_size': window_size})
+            self.job_id = response.json()['job']
+            state.set_job(self.job_id)
+            missing = set(range(total))
+
+        return deque(index for index in range(total) if not state.done[index] and index in missing)
+
+    def _status(self, since=0, wait=0.0, missing=False):
+        params = {'since': since, 'wait': wait}
+        if missing:
+            params['missing'] = 1
+        response = self._request('GET', f'/jobs/{self.job_id}', params=params,
+                                 timeout=self.timeout + wait)
+        return response.json()
+
+    def _upload(self, index, patch):
+        started = time.perf_counter()
+        data = encode(patch, self.codec)
+        encode_seconds = time.perf_counter() - started
+        self._request('PUT', f'/jobs/{self.job_id}/tiles/{index}', data=data,
+                      headers={'Content-Type': CONTENT_TYPES[self.codec]})
+        self.stats.add(len(data), 0, encode_seconds)
+
+    def _download(self, index):
+        response = self._request('GET', f'/jobs/{self.job_id}/tiles/{index}',
+                                 params={'response_codec': self.mask_codec})
+        self.stats.add(0, len(response.content), 0.0)
+        return self._decode_mask(response, (self.state.tile_size, self.state.tile_size))
+
+    def _request(self, method, path, **kwargs):
+        """HTTP-запрос с повторами при сбоях сети и ошибках 5xx"""
+        kwargs.setdefault('timeout', self.timeout)
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = self.session.request(method, f"{self.api_url}{path}", **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                last_error = str(e)
+                continue
+            if response.status_code == 404 and path.startswith('/jobs/'):
+                raise JobLost(self.job_id)
+            if response.status_code >= 500:
+                last_error = f"HTTP {response.status_code}"
+                continue
+            response.raise_for_status()
+            return response
+
+        raise TileRequestError(f"{method} {path}: нет ответа после {self.retries + 1} попыток: {last_error}")
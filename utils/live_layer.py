@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+"""
+Живой слой: сегментация видимых на карте тайлов по запросу
+
+Тайлы строятся на пиксельной сетке исходного файла по уровням: на уровне
+factor (степень 2) пиксель тайла покрывает factor x factor пикселей файла,
+уровень выбирается по масштабу карты. Каждый тайл - обычное задание
+постоянного процесса инференса: окно файла с контекстом LIVE_TILE_MARGIN
+читается с target_gsd уровня, модель остается загруженной между
+заданиями. Поток отправляет в процесс по одному тайлу, начиная с центра
+экрана, так что задания диалога и Processing не ждут за очередью тайлов.
+Тайлы, ушедшие из вида, убираются из очереди; отправленный тайл не
+отменяется, а дорабатывается.
+
+Готовые тайлы хранятся во временном каталоге (до LIVE_CACHE_TILES) и
+показываются через VRT-мозаику без контекста: грубые уровни ниже, детальные
+поверх, поэтому при приближении сначала виден грубый результат. Слой
+перезагружается не чаще LIVE_REPAINT_MS.
+"""
+import math
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from qgis.PyQt.QtCore import QObject, QThread, QTimer, pyqtSignal
+from qgis.core import QgsCoordinateTransform, QgsProject, QgsRasterLayer, QgsRectangle
+
+from .image_utils import ImageProcessor
+from .inference_process import shared_process
+from .job_builder import build_params
+from .vrt import build_vrt_mosaic
+
+
+# Остановленные планировщики, чей поток еще дорабатывает тайл
+_stopping = set()
+
+
+class LiveTileGrid:
+    """Пирамида тайлов на пиксельной сетке исходного файла"""
+
+    def __init__(self, width, height, geotransform, tile_size=512, margin=32):
+        self.width = width
+        self.height = height
+        self.geotransform = geotransform
+        self.tile_size = tile_size
+        self.margin = margin
+        self.native_gsd = max(abs(geotransform[1]), abs(geotransform[5]))
+
+    def factor_for(self, units_per_pixel):
+        """Уровень, на котором пиксель тайла не крупнее пикселя экрана"""
+        ratio = units_per_pixel / self.native_gsd
+        factor = 2 ** int(math.floor(math.log2(ratio))) if ratio >= 2 else 1
+        # Грубее уровня, на котором весь растр - один тайл, смысла нет
+        top = 2 ** max(0, int(math.ceil(math.log2(max(self.width, self.height) / self.tile_size))))
+        return min(factor, top)
+
+    def visible(self, extent, factor):
+        """Ключи (factor, ix, iy) тайлов экстента, от центра к краям"""
+        gt = self.geotransform
+        span = self.tile_size * factor
+        x1 = (extent.xMinimum() - gt[0]) / gt[1]
+        x2 = (extent.xMaximum() - gt[0]) / gt[1]
+        y1 = (extent.yMaximum() - gt[3]) / gt[5]
+        y2 = (extent.yMinimum() - gt[3]) / gt[5]
+        ix0 = max(0, int(math.floor(min(x1, x2) / span)))
+        ix1 = min(-(-self.width // span), int(math.ceil(max(x1, x2) / span)))
+        iy0 = max(0, int(math.floor(min(y1, y2) / span)))
+        iy1 = min(-(-self.height // span), int(math.ceil(max(y1, y2) / span)))
+
+        center_x = (x1 + x2) / 2 / span
+        center_y = (y1 + y2) / 2 / span
+        keys = [(factor, ix, iy) for iy in range(iy0, iy1) for ix in range(ix0, ix1)]
+        keys.sort(key=lambda key: (key[1] + 0.5 - center_x) ** 2 + (key[2] + 0.5 - center_y) ** 2)
+        return keys
+
+    def tile(self, key):
+        """Окно чтения с контекстом и часть результата без него
+
+        Returns:
+            словарь: window - окно файла с контекстом, bounds - его границы,
+            crop - (x, y, ширина, высота) тайла без контекста в пикселях
+            результата, crop_bounds - границы тайла
+        """
+        factor, ix, iy = key
+        span = self.tile_size * factor
+        margin = self.margin * factor
+        x_off, y_off = ix * span, iy * span
+        x_end, y_end = min(self.width, x_off + span), min(self.height, y_off + span)
+        px0, py0 = max(0, x_off - margin), max(0, y_off - margin)
+        px1, py1 = min(self.width, x_end + margin), min(self.height, y_end + margin)
+
+        # Размер результата так же, как в RasterSource с target_gsd
+        out_width = max(1, int(round((px1 - px0) / factor)))
+        out_height = max(1, int(round((py1 - py0) / factor)))
+        left, top = (x_off - px0) // factor, (y_off - py0) // factor
+        right, bottom = (px1 - x_end) // factor, (py1 - y_end) // factor
+        return {
+            'window': [px0, py0, px1 - px0, py1 - py0],
+            'bounds': self._bounds(px0, py0, px1, py1),
+            'size': (out_width, out_height),
+            'crop': (left, top, out_width - left - right, out_height - top - bottom),
+            'crop_bounds': self._bounds(x_off, y_off, x_end, y_end),
+        }
+
+    def _bounds(self, x0, y0, x1, y1):
+        """(xmin, ymin, xmax, ymax) окна пикселей"""
+        gt = self.geotransform
+        xs = (gt[0] + x0 * gt[1], gt[0] + x1 * gt[1])
+        ys = (gt[3] + y0 * gt[5], gt[3] + y1 * gt[5])
+        return min(xs), min(ys), max(xs), max(ys)
+
+
+class LiveTileScheduler(QObject):
+    """Очередь видимых тайлов и поток, отправляющий их в процесс инференса по одному"""
+    tile_ready = pyqtSignal(object, str)
+    tile_failed = pyqtSignal(object, str)
+
+    def __init__(self, plugin_dir):
+        super().__init__()
+        self.process = shared_process(plugin_dir)
+        # (key, params) в порядке приоритета
+        self.pending = []
+        # key тайла, отправленного в процесс
+        self.running = None
+        self.stopped = False
+        self.on_finished = None
+        self.condition = threading.Condition()
+        self.worker = LiveTileWorker(self)
+        self.worker.finished.connect(self._worker_finished)
+
+    def start(self):
+        self.worker.start()
+
+    def update(self, tasks):
+        """Новый список нужных тайлов: прочие убираются из очереди
+
+        Отправленный тайл дорабатывается, даже если ушел из вида.
+        """
+        with self.condition:
+            self.pending = [(key, params) for key, params in tasks if key != self.running]
+            self.condition.notify_all()
+
+    def stop(self, on_finished=None):
+        """Останавливает очередь, не дожидаясь потока
+
+        Поток дорабатывает отправленный тайл без передачи результата, затем
+        вызывается on_finished (в потоке GUI).
+        """
+        if not self.worker.isRunning():
+            if on_finished is not None:
+                on_finished()
+            return
+        self.on_finished = on_finished
+        # Ссылка держит поток до его завершения
+        _stopping.add(self)
+        with self.condition:
+            self.stopped = True
+            self.pending = []
+            self.condition.notify_all()
+
+    def take(self):
+        """Следующий тайл и его задание, None при остановке"""
+        with self.condition:
+            while not self.stopped and not self.pending:
+                self.condition.wait()
+            if self.stopped:
+                return None
+            key, params = self.pending.pop(0)
+            self.running = key
+            return key, params, self.process.submit(params)
+
+    def finish(self):
+        with self.condition:
+            self.running = None
+
+    def _worker_finished(self):
+        _stopping.discard(self)
+        if self.on_finished is not None:
+            self.on_finished()
+            self.on_finished = None
+
+
+class LiveTileWorker(QThread):
+    """Поток, отправляющий тайлы и ожидающий их результаты"""
+
+    def __init__(self, scheduler):
+        super().__init__()
+        self.scheduler = scheduler
+
+    def run(self):
+        while True:
+            task = self.scheduler.take()
+            if task is None:
+                return
+            key, params, job = task
+
+            error = None
+            done = False
+            for message in job.messages():
+                if message['type'] == 'result':
+                    done = True
+                elif message['type'] == 'error':
+                    error = message.get('message')
+            self.scheduler.finish()
+
+            if self.scheduler.stopped:
+                return
+            if done:
+                self.scheduler.tile_ready.emit(key, params['output_path'])
+            elif error:
+                self.scheduler.tile_failed.emit(key, error)
+
+
+class LiveSegmentationLayer(QObject):
+    """Слой результата, который сегментирует видимую часть растра по мере навигации"""
+    error = pyqtSignal(str)
+    stopped = pyqtSignal()
+
+    LAYER_NAME = "Segmentation Live"
+
+    def __init__(self, canvas, layer, plugin_dir, job_options):
+        """
+        Args:
+            canvas: QgsMapCanvas, за экстентом которой следует слой
+            layer: файловый растровый слой GDAL
+            plugin_dir: каталог плагина (процесс инференса)
+            job_options: аргументы build_params без входа, выхода и разрешения
+                (model_path, patch_size, subdivisions, use_api, ...)
+
+        Raises:
+            ValueError: слой нельзя читать напрямую из файла
+        """
+        super().__init__()
+        from osgeo import gdal
+        from ..config import (LIVE_TILE_SIZE, LIVE_TILE_MARGIN, LIVE_UPDATE_DELAY_MS, LIVE_REPAINT_MS,
+                              SEGMENTATION_COLORS, CLASS_NAMES)
+
+        source = ImageProcessor.describe_layer_source(layer)
+        if source is None:
+            raise ValueError("Живой слой доступен только для растров из файлов, читаемых GDAL")
+        dataset = gdal.Open(source['path'])
+        self.grid = LiveTileGrid(dataset.RasterXSize, dataset.RasterYSize, dataset.GetGeoTransform(),
+                                 LIVE_TILE_SIZE, LIVE_TILE_MARGIN)
+        dataset = None
+
+        self.canvas = canvas
+        self.layer = layer
+        self.path = source['path']
+        self.plugin_dir = plugin_dir
+        self.job_options = job_options
+        self.colors = SEGMENTATION_COLORS
+        self.class_names = CLASS_NAMES[:len(SEGMENTATION_COLORS)]
+        self.directory = tempfile.mkdtemp(prefix='segmentation_live_')
+        self.vrt_path = os.path.join(self.directory, 'live.vrt')
+        # key -> описание готового тайла, в порядке последнего использования
+        self.cache = OrderedDict()
+        self.output = None
+        self.dirty = False
+
+        self.scheduler = LiveTileScheduler(plugin_dir)
+        self.scheduler.tile_ready.connect(self.on_tile_ready)
+        self.scheduler.tile_failed.connect(self.on_tile_failed)
+
+        # Пересчет очереди после паузы в навигации
+        self.update_timer = QTimer(self)
+        self.update_timer.setSingleShot(True)
+        self.update_timer.setInterval(LIVE_UPDATE_DELAY_MS)
+        self.update_timer.timeout.connect(self.refresh)
+
+        self.repaint_timer = QTimer(self)
+        self.repaint_timer.setInterval(LIVE_REPAINT_MS)
+        self.repaint_timer.timeout.connect(self.repaint)
+
+    def start(self):
+        """Запускает потоки и обработку текущего экстента"""
+        options = self.job_options
+        if not options.get('use_api') or options.get('use_hybrid'):
+            self.scheduler.process.preload(options.get('model_path'))
+        self.scheduler.start()
+        self.canvas.extentsChanged.connect(self.update_timer.start)
+        QgsProject.instance().layersWillBeRemoved.connect(self.on_layers_removed)
+        self.repaint_timer.start()
+        self.refresh()
+
+    def stop(self):
+        """Останавливает обработку, убирает слой и временные файлы"""
+        if self.scheduler is None:
+            return
+        self.canvas.extentsChanged.disconnect(self.update_timer.start)
+        QgsProject.instance().layersWillBeRemoved.disconnect(self.on_layers_removed)
+        self.update_timer.stop()
+        self.repaint_timer.stop()
+        scheduler = self.scheduler
+        self.scheduler = None
+        scheduler.tile_ready.disconnect(self.on_tile_ready)
+        scheduler.tile_failed.disconnect(self.on_tile_failed)
+
+        if self.output is not None:
+            layer_id = self.output.id()
+            self.output = None
+            if QgsProject.instance().mapLayer(layer_id) is not None:
+                QgsProject.instance().removeMapLayer(layer_id)
+        # Отправленный тайл пишется в каталог слоя: каталог удаляется после потока
+        directory = self.directory
+        scheduler.stop(lambda: shutil.rmtree(directory, ignore_errors=True))
+        self.stopped.emit()
+
+    def refresh(self):
+        """Ставит в очередь видимые тайлы уровня текущего масштаба"""
+        if self.scheduler is None:
+            return
+        extent = self.canvas.extent()
+        canvas_crs = self.canvas.mapSettings().destinationCrs()
+        if canvas_crs != self.layer.crs():
+            transform = QgsCoordinateTransform(canvas_crs, self.layer.crs(), QgsProject.instance())
+            extent = transform.transformBoundingBox(extent)
+        if extent.isEmpty() or self.canvas.width() <= 0:
+            return
+
+        factor = self.grid.factor_for(extent.width() / self.canvas.width())
+        tasks = []
+        for key in self.grid.visible(extent, factor):
+            if key in self.cache:
+                self.cache.move_to_end(key)
+            else:
+                tasks.append((key, self._tile_params(key)))
+        self.scheduler.update(tasks)
+
+    def on_tile_ready(self, key, path):
+        from ..config import LIVE_CACHE_TILES
+
+        if self.scheduler is None:
+            return
+        tile = self.grid.tile(key)
+        self.cache[key] = {
+            'path': path,
+            'width': tile['size'][0],
+            'height': tile['size'][1],
+            'window': tile['crop'],
+            'bounds': tile['crop_bounds'],
+        }
+        while len(self.cache) > LIVE_CACHE_TILES:
+            self._remove_tile(*self.cache.popitem(last=False))
+
+        # Грубые уровни снизу, детальные поверх
+        sources = sorted(self.cache.items(), key=lambda item: -item[0][0])
+        build_vrt_mosaic(self.vrt_path, [tile for _, tile in sources], self.layer.crs().toWkt(),
+                         colors=self.colors, class_names=self.class_names)
+        if self.output is None:
+            self.output = QgsRasterLayer(self.vrt_path, self.LAYER_NAME)
+            ImageProcessor.apply_class_palette(self.output, self.colors)
+            QgsProject.instance().addMapLayer(self.output)
+        else:
+            self.dirty = True
+
+    def on_tile_failed(self, key, message):
+        """Ошибка задания (например, нет модели) - дальше не запускаем"""
+        if self.scheduler is None:
+            return
+        self.error.emit(message)
+        self.stop()
+
+    def on_layers_removed(self, layer_ids):
+        if self.output is not None and self.output.id() in layer_ids:
+            self.output = None
+            self.stop()
+        elif self.layer.id() in layer_ids:
+            self.stop()
+
+    def repaint(self):
+        """Перечитывает VRT с новыми тайлами"""
+        if not self.dirty or self.output is None:
+            return
+        self.dirty = False
+        self.output.reload()
+        self.output.setExtent(self.output.dataProvider().extent())
+        self.output.triggerRepaint()
+
+    def _tile_params(self, key):
+        tile = self.grid.tile(key)
+        factor, ix, iy = key
+        xmin, ymin, xmax, ymax = tile['bounds']
+        prepared = {
+            'input_source': {'path': self.path, 'window': tile['window']},
+            'input_path': None,
+            'extent': QgsRectangle(xmin, ymin, xmax, ymax),
+        }
+        output_path = os.path.join(self.directory, f'tile_{factor}_{ix}_{iy}.tif')
+        target_gsd = self.grid.native_gsd * factor if factor > 1 else None
+        params = build_params(self.layer, prepared, output_path, target_gsd=target_gsd,
+                              **self.job_options)
+        # Маленький тайл: без обзоров COG
+        params['output_cog'] = False
+        # Модель остается загруженной для следующих тайлов
+        params['release_model_on_cancel'] = False
+        return params
+
+    def _remove_tile(self, key, tile):
+        """Удаляет файлы тайла (результат, метаданные, статистику)"""
+        stem = os.path.splitext(tile['path'])[0]
+        for path in (stem + '.tif', stem + '.tif.aux.xml', stem + '_metadata.json',
+                     stem + '_class_stats.csv'):
+            if not os.path.exists(path):
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                # Файл еще открыт GDAL; каталог удалится при остановке
+                pass
@@ -25,6 +25,7 @@ _input_shape = None
 model = None
 model_type = None
 predictor_function = None
+model_path_loaded = None
 
 def load_model_generic(path):
     """
@@ -118,10 +119,29 @@ def create_predictor(model, model_type):
             return predict_fn
 
 def load_model(model_path=DEFAULT_MODEL_PATH):
-    """Загрузка модели из указанного пути"""
-    global model, model_type, predictor_function
-    if model is None:
+    """Загрузка модели из указанного пути
+    
+    Загруженная модель кэшируется и переиспользуется, пока не запрошена другая.
+    """
+    global model, model_type, predictor_function, model_path_loaded
+    if model is None or model_path_loaded != model_path:
         model, model_type, size_mb = load_model_generic(model_path)
+        model_path_loaded = model_path
         predictor_function = create_predictor(model, model_type)
         print(f"Загружена модель типа {model_type}, размер: {size_mb:.2f} МБ")
     return model, predictor_function
+
+
+def release_model():
+    """Освобождает загруженную модель и память TensorFlow"""
+    global model, model_type, predictor_function, model_path_loaded
+    global _interpreter, _input_det, _output_det, _input_shape
+    model = None
+    model_path_loaded = None
+    model_type = None
+    predictor_function = None
+    _interpreter = None
+    _input_det = None
+    _output_det = None
+    _input_shape = None
+    tf.keras.backend.clear_session()
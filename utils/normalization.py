@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Приведение не-uint8 растров к uint8 по тайлам
+
+Диапазон растяжения оценивается заранее, без чтения растра целиком:
+минимум и максимум берутся из статистики GDAL (метаданные STATISTICS_*),
+если она есть и описывает все окно, иначе из уменьшенной выборки -
+чтение с out_shape использует обзоры файла. Для растяжения по процентилям
+всегда используется выборка. Сами тайлы растягиваются при чтении
+в float32, поэтому 16-битный растр проходит через сетку патчей без полной
+копии в float.
+"""
+import numpy as np
+
+
+class Stretch:
+    """Линейное растяжение диапазона [low, high] каналов в 0..255"""
+
+    def __init__(self, low, high):
+        self.low = np.asarray(low, dtype=np.float32)
+        self.high = np.asarray(high, dtype=np.float32)
+        self.scale = 255.0 / (self.high - self.low + 1e-8)
+
+    def apply(self, tile):
+        out = (tile.astype(np.float32) - self.low) * self.scale
+        np.clip(out, 0, 255, out=out)
+        return out.astype(np.uint8)
+
+    def as_dict(self):
+        return {'low': self.low.tolist(), 'high': self.high.tolist()}
+
+
+class NormalizedSource:
+    """Источник со срезами, отдающий тайлы исходного источника в uint8"""
+
+    dtype = np.dtype(np.uint8)
+
+    def __init__(self, source, stretch):
+        self.source = source
+        self.stretch = stretch
+        self.shape = source.shape
+        self.height, self.width = source.shape[:2]
+
+    def read_window(self, x, y, width, height):
+        return self.stretch.apply(self.source.read_window(x, y, width, height))
+
+    def read(self):
+        return self.read_window(0, 0, self.width, self.height)
+
+    def __getitem__(self, key):
+        return self.stretch.apply(self.source[key])
+
+    def close(self):
+        self.source.close()
+
+
+def estimate_stretch(source, mode='minmax', percentiles=(2.0, 98.0), per_band=False,
+                     sample_size=1024):
+    """Диапазон растяжения источника
+
+    Args:
+        source: RasterSource или StreamedRasterSource
+        mode: 'minmax' или 'percentile'
+        percentiles: нижний и верхний процентили для mode='percentile'
+        per_band: свой диапазон для каждого канала, иначе общий
+        sample_size: наибольшая сторона выборки
+
+    Returns:
+        Stretch
+    """
+    if mode == 'minmax':
+        statistics = _gdal_statistics(source)
+        if statistics is not None:
+            low, high = statistics
+            if not per_band:
+                low, high = low.min(), high.max()
+            return Stretch(low, high)
+
+    sample = sample_source(source, sample_size).reshape(-1, 3)
+    if mode == 'percentile':
+        low_q, high_q = percentiles
+        if per_band:
+            low, high = np.percentile(sample, [low_q, high_q], axis=0)
+        else:
+            low, high = np.percentile(sample, [low_q, high_q])
+    elif mode == 'minmax':
+        axis = 0 if per_band else None
+        low, high = sample.min(axis=axis), sample.max(axis=axis)
+    else:
+        raise ValueError(f"Неизвестный режим нормализации: {mode}")
+    return Stretch(low, high)
+
+
+def sample_source(source, sample_size=1024):
+    """Уменьшенная копия источника (h, w, 3) со стороной не больше sample_size"""
+    step = max(1, -(-max(source.height, source.width) // sample_size))
+    out_height = -(-source.height // step)
+    out_width = -(-source.width // step)
+
+    dataset = getattr(source, 'dataset', None)
+    if dataset is not None:
+        from rasterio.windows import Window
+
+        # Чтение с уменьшением: GDAL берет данные из обзоров, если они есть
+        window = Window(source.x_off, source.y_off, source.window_width, source.window_height)
+        data = dataset.read(source.indexes, window=window, out_shape=(3, out_height, out_width))
+        return np.transpose(data, (1, 2, 0))
+
+    # Потоковый источник: строки с шагом, каждая ждет только свои блоки
+    return np.stack([
+        source.read_window(0, y, source.width, 1)[0, ::step]
+        for y in range(0, source.height, step)
+    ])
+
+
+def _gdal_statistics(source):
+    """Минимум и максимум каналов из метаданных GDAL, если они описывают все окно"""
+    dataset = getattr(source, 'dataset', None)
+    if dataset is None:
+        return None
+    window = (source.x_off, source.y_off, source.window_width, source.window_height)
+    if window != (0, 0, dataset.width, dataset.height):
+        return None
+
+    low, high = [], []
+    for index in source.indexes:
+        tags = dataset.tags(index)
+        if 'STATISTICS_MINIMUM' not in tags or 'STATISTICS_MAXIMUM' not in tags:
+            return None
+        low.append(float(tags['STATISTICS_MINIMUM']))
+        high.append(float(tags['STATISTICS_MAXIMUM']))
+    return np.array(low), np.array(high)
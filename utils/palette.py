@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Преобразования между маской классов и цветами палитры
+
+Все преобразования векторные: цвет упаковывается в 24-битное число
+(r << 16 | g << 8 | b), поиск класса идет по отсортированной таблице,
+без прохода по изображению для каждого класса. Результат хранится как
+маска с таблицей цветов, RGB строится только по запросу.
+"""
+import numpy as np
+
+
+def pack_rgb(rgb):
+    """Упаковывает цвета (..., 3) в 24-битные числа"""
+    rgb = np.asarray(rgb, dtype=np.uint32)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+
+def colorize(mask, colors):
+    """RGB изображение (H, W, 3) из маски классов"""
+    lut = np.zeros((256, 3), dtype=np.uint8)
+    lut[:len(colors)] = colors
+    return lut[mask]
+
+
+def rgb_to_mask(rgb, colors, unknown=None):
+    """Маска классов из RGB изображения, раскрашенного палитрой
+
+    Args:
+        rgb: изображение (H, W, 3+)
+        colors: палитра классов [[r, g, b], ...]
+        unknown: класс для цветов вне палитры (по умолчанию последний)
+
+    При совпадающих цветах в палитре выбирается класс с меньшим индексом.
+    """
+    if unknown is None:
+        unknown = len(colors) - 1
+
+    keys = pack_rgb(colors)
+    # Первый индекс каждого уникального цвета
+    unique_keys, first_index = np.unique(keys, return_index=True)
+    classes = first_index.astype(np.uint8)
+
+    packed = pack_rgb(rgb[..., :3])
+    positions = np.searchsorted(unique_keys, packed)
+    positions = np.minimum(positions, len(unique_keys) - 1)
+    found = unique_keys[positions] == packed
+
+    mask = np.where(found, classes[positions], unknown)
+    return mask.astype(np.uint8)
+
+
+def palette_bytes(colors):
+    """Палитра для PIL (768 байт, свободные индексы черные)"""
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    palette[:len(colors)] = colors
+    return palette.tobytes()
+
+
+def color_map(colors):
+    """Таблица цветов для одноканального растра {класс: (r, g, b, 255)}"""
+    return {index: (int(r), int(g), int(b), 255) for index, (r, g, b) in enumerate(colors)}
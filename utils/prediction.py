@@ -5,16 +5,23 @@
 import numpy as np
 
 
-def predict_img_tiled(input_img, window_size, subdivisions, nb_classes, pred_func):
+def predict_img_tiled(input_img, window_size, subdivisions, nb_classes, pred_func,
+                      batch_size=16, progress_callback=None, cancel_check=None, tile_filter=None):
     """
     Универсальная функция предсказания с тайлами
     
     Args:
-        input_img: входное изображение (H, W, C)
+        input_img: входное изображение (H, W, C) или источник со срезами по тайлам
         window_size: размер окна/патча
         subdivisions: количество подразделений (1 = без перекрытия, 2+ = с перекрытием)
         nb_classes: количество классов
         pred_func: функция предсказания
+        batch_size: количество патчей в одном вызове pred_func
+        progress_callback: функция (обработано, всего), вызывается после каждого батча
+        cancel_check: функция (обработано, всего), вызывается перед каждым батчем
+            и прерывает обработку исключением при отмене
+        tile_filter: функция (y, x) -> bool, отбор патчей сетки (например, по AOI);
+            пропущенные патчи не читаются и не предсказываются
     
     Returns:
         numpy array с предсказаниями (H, W, nb_classes)
@@ -24,10 +31,71 @@ def predict_img_tiled(input_img, window_size, subdivisions, nb_classes, pred_fun
     # Если изображение меньше окна
     if h <= window_size and w <= window_size:
         padded = np.zeros((window_size, window_size, input_img.shape[2]), dtype=input_img.dtype)
-        padded[:h, :w] = input_img
+        padded[:h, :w] = input_img[:h, :w]
         prediction = pred_func(padded[np.newaxis, ...])[0]
+        if progress_callback:
+            progress_callback(1, 1)
         return prediction[:h, :w]
     
+    coords, overlap = compute_tile_coords(h, w, window_size, subdivisions, tile_filter)
+    canvas = BlendCanvas(h, w, nb_classes, window_size, overlap)
+    _predict_batches(input_img, coords, window_size, pred_func, canvas, batch_size,
+                     progress_callback, cancel_check)
+    return canvas.result()
+
+
+def predict_img_streamed(input_img, window_size, subdivisions, nb_classes, pred_func, sink,
+                         batch_size=16, progress_callback=None, cancel_check=None, tile_filter=None):
+    """Предсказание с тайлами, готовые полосы выдаются по ходу обработки
+    
+    Сетка и смешивание те же, что в predict_img_tiled, но патчи идут по
+    строкам через RollingCanvas: голоса классов готовых полос
+    (rows, W, nb_classes) передаются в sink(строка, голоса), пока
+    обрабатываются следующие. В памяти - только полоса высотой в окно.
+    """
+    h, w = input_img.shape[:2]
+    if h <= window_size and w <= window_size:
+        sink(0, predict_img_tiled(input_img, window_size, subdivisions, nb_classes, pred_func,
+                                  progress_callback=progress_callback))
+        return
+    
+    coords, overlap = compute_tile_coords(h, w, window_size, subdivisions, tile_filter)
+    # RollingCanvas принимает патчи по неубыванию строки
+    coords.sort()
+    canvas = RollingCanvas(h, w, nb_classes, window_size, overlap, sink)
+    _predict_batches(input_img, coords, window_size, pred_func, canvas, batch_size,
+                     progress_callback, cancel_check)
+    canvas.close()
+
+
+def _predict_batches(input_img, coords, window_size, pred_func, canvas, batch_size,
+                     progress_callback=None, cancel_check=None):
+    """Пакетное предсказание патчей coords с добавлением в холст"""
+    total = len(coords)
+    for start in range(0, total, batch_size):
+        if cancel_check:
+            cancel_check(start, total)
+        
+        batch_coords = coords[start:start + batch_size]
+        patches_array = np.array([
+            input_img[y:y+window_size, x:x+window_size] for y, x in batch_coords
+        ])
+        predictions = pred_func(patches_array)
+        
+        # Встраиваем предсказания
+        for idx, (y, x) in enumerate(batch_coords):
+            canvas.add(y, x, predictions[idx])
+        
+        if progress_callback:
+            progress_callback(min(start + batch_size, total), total)
+
+
+def compute_tile_coords(h, w, window_size, subdivisions, tile_filter=None):
+    """Координаты патчей (y, x) и перекрытие для изображения h x w
+    
+    Одна и та же сетка используется локальным и API инференсом.
+    tile_filter(y, x) оставляет только нужные патчи сетки.
+    """
     # Расчет шага и перекрытия
     if subdivisions == 1:
         overlap = 0
@@ -36,58 +104,98 @@ def predict_img_tiled(input_img, window_size, subdivisions, nb_classes, pred_fun
         overlap = window_size // subdivisions
         step = window_size - overlap
     
-    # Подготовка массивов
-    prediction = np.zeros((h, w, nb_classes), dtype=np.float32)
-    weights = np.zeros((h, w, 1), dtype=np.float32)
-    
-    # Создаем весовую матрицу для смешивания
-    weight_matrix = create_weight_matrix(window_size, overlap)
-    
-    # Собираем патчи
-    patches = []
     coords = []
     
     for y in range(0, h - window_size + 1, step):
         for x in range(0, w - window_size + 1, step):
-            patch = input_img[y:y+window_size, x:x+window_size]
-            patches.append(patch)
             coords.append((y, x))
     
     # Обрабатываем края, если нужно
     if h % step != 0:
         for x in range(0, w - window_size + 1, step):
-            y = h - window_size
-            patch = input_img[y:y+window_size, x:x+window_size]
-            patches.append(patch)
-            coords.append((y, x))
+            coords.append((h - window_size, x))
     
     if w % step != 0:
         for y in range(0, h - window_size + 1, step):
-            x = w - window_size
-            patch = input_img[y:y+window_size, x:x+window_size]
-            patches.append(patch)
-            coords.append((y, x))
+            coords.append((y, w - window_size))
     
     # Угловой патч
     if h % step != 0 and w % step != 0:
-        patch = input_img[h-window_size:h, w-window_size:w]
-        patches.append(patch)
         coords.append((h-window_size, w-window_size))
     
-    # Пакетное предсказание
-    if patches:
-        patches_array = np.array(patches)
-        predictions = pred_func(patches_array)
-        
-        # Встраиваем предсказания
-        for idx, (y, x) in enumerate(coords):
-            prediction[y:y+window_size, x:x+window_size] += predictions[idx] * weight_matrix
-            weights[y:y+window_size, x:x+window_size] += weight_matrix
+    if tile_filter is not None:
+        coords = [(y, x) for y, x in coords if tile_filter(y, x)]
     
-    # Нормализация
-    prediction = np.divide(prediction, weights + 1e-8, out=prediction, where=weights > 0)
+    return coords, overlap
+
+
+class BlendCanvas:
+    """Накопление предсказаний патчей с весами для плавного смешивания"""
+    
+    def __init__(self, h, w, nb_classes, window_size, overlap):
+        self.window_size = window_size
+        self.prediction = np.zeros((h, w, nb_classes), dtype=np.float32)
+        self.weights = np.zeros((h, w, 1), dtype=np.float32)
+        self.weight_matrix = create_weight_matrix(window_size, overlap)
+    
+    def add(self, y, x, patch_prediction):
+        """Добавляет предсказание патча (window, window, nb_classes) в позицию (y, x)"""
+        ws = self.window_size
+        self.prediction[y:y+ws, x:x+ws] += patch_prediction * self.weight_matrix
+        self.weights[y:y+ws, x:x+ws] += self.weight_matrix
+    
+    def result(self):
+        """Нормализованные предсказания (H, W, nb_classes)"""
+        return np.divide(self.prediction, self.weights + 1e-8, out=self.prediction,
+                         where=self.weights > 0)
+
+
+class RollingCanvas:
+    """Смешивание патчей, поступающих по неубыванию y, с выдачей готовых полос
+    
+    В памяти хранится только полоса высотой в окно. Когда приходит патч
+    со строки y, строки выше y больше не изменятся: их голоса классов
+    (rows, W, nb_classes) передаются в sink(строка, голоса) и полоса
+    сдвигается. Массив голосов действителен только во время вызова sink.
+    """
     
-    return prediction
+    def __init__(self, h, w, nb_classes, window_size, overlap, sink):
+        self.h = h
+        self.window_size = window_size
+        self.sink = sink
+        self.base = 0
+        rows = min(window_size, h)
+        # Веса положительны: argmax не требует нормализации на их сумму,
+        # вероятности получаются делением на сумму голосов по классам
+        self.prediction = np.zeros((rows, w, nb_classes), dtype=np.float32)
+        self.weight_matrix = create_weight_matrix(window_size, overlap)
+    
+    def add(self, y, x, patch_prediction):
+        """Добавляет предсказание патча (window, window, nb_classes) в позицию (y, x)"""
+        if y < self.base:
+            raise ValueError(f"Патч в строке {y} пришел после строки {self.base}")
+        self._finalize(y)
+        # Дополненный патч изображения меньше окна обрезается по его границам
+        top = y - self.base
+        rows = min(self.window_size, self.prediction.shape[0] - top)
+        cols = min(self.window_size, self.prediction.shape[1] - x)
+        self.prediction[top:top+rows, x:x+cols] += (
+            patch_prediction[:rows, :cols] * self.weight_matrix[:rows, :cols]
+        )
+    
+    def close(self):
+        """Выдает оставшиеся строки"""
+        self._finalize(self.h)
+    
+    def _finalize(self, row):
+        rows = self.prediction.shape[0]
+        while self.base < min(row, self.h):
+            ready = min(min(row, self.h) - self.base, rows)
+            self.sink(self.base, self.prediction[:ready])
+            
+            self.prediction[:rows - ready] = self.prediction[ready:]
+            self.prediction[rows - ready:] = 0
+            self.base += ready
 
 
 def create_weight_matrix(window_size, overlap):
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Чтение входного растра по окнам прямо из исходного файла
+"""
+import json
+import time
+
+import numpy as np
+
+
+class RasterSource:
+    """Окно исходного растра с доступом к тайлам через срезы [y0:y1, x0:x1]
+
+    Возвращает тайлы в формате (H, W, 3), как ожидает predict_img_tiled.
+    С target_gsd (единиц CRS на пиксель) грубее исходного разрешения окно
+    отдается уменьшенным: каждое чтение выполняется с out_shape, и GDAL
+    берет данные из ближайшего обзора файла.
+    """
+
+    def __init__(self, path, window=None, target_gsd=None):
+        import rasterio
+
+        self.path = path
+        self.dataset = rasterio.open(path)
+
+        if window is None:
+            window = [0, 0, self.dataset.width, self.dataset.height]
+        self.x_off, self.y_off, self.window_width, self.window_height = [int(v) for v in window]
+
+        # Размер в пикселях результата; шаг чтения в пикселях источника
+        self.width, self.height = self.window_width, self.window_height
+        native_gsd = max(abs(self.dataset.transform.a), abs(self.dataset.transform.e))
+        if target_gsd and target_gsd > native_gsd:
+            scale = target_gsd / native_gsd
+            self.width = max(1, int(round(self.window_width / scale)))
+            self.height = max(1, int(round(self.window_height / scale)))
+        self.step_x = self.window_width / self.width
+        self.step_y = self.window_height / self.height
+
+        # Первые три канала, одноканальные растры дублируются
+        if self.dataset.count >= 3:
+            self.indexes = [1, 2, 3]
+        else:
+            self.indexes = [1, 1, 1]
+
+        self.dtype = np.dtype(self.dataset.dtypes[0])
+        self.shape = (self.height, self.width, 3)
+
+    @classmethod
+    def from_params(cls, params):
+        """Создает источник по параметрам запуска"""
+        source = params.get('input_source')
+        if source and source.get('type') == 'stream':
+            return StreamedRasterSource(source)
+        target_gsd = params.get('target_gsd')
+        if source:
+            return cls(source['path'], source.get('window'), target_gsd)
+        return cls(params['input_path'], target_gsd=target_gsd)
+
+    @property
+    def resampled(self):
+        return (self.width, self.height) != (self.window_width, self.window_height)
+
+    def read_window(self, x, y, width, height):
+        """Читает окно в координатах пикселей относительно начала источника"""
+        from rasterio.windows import Window
+        from rasterio.enums import Resampling
+
+        if not self.resampled:
+            window = Window(self.x_off + x, self.y_off + y, width, height)
+            data = self.dataset.read(self.indexes, window=window, boundless=False)
+            return np.transpose(data, (1, 2, 0))
+
+        window = Window(self.x_off + x * self.step_x, self.y_off + y * self.step_y,
+                        width * self.step_x, height * self.step_y)
+        data = self.dataset.read(self.indexes, window=window, out_shape=(3, height, width),
+                                 resampling=Resampling.average, boundless=False)
+        return np.transpose(data, (1, 2, 0))
+
+    def read(self):
+        """Читает весь источник целиком"""
+        return self.read_window(0, 0, self.width, self.height)
+
+    def __getitem__(self, key):
+        rows, cols = key[0], key[1]
+        y0, y1, _ = rows.indices(self.height)
+        x0, x1, _ = cols.indices(self.width)
+        return self.read_window(x0, y0, x1 - x0, y1 - y0)
+
+    def close(self):
+        self.dataset.close()
+
+
+class StreamedRasterSource:
+    """Источник, который дописывается экспортером блоков во время инференса
+
+    Данные лежат в сыром файле (H, W, C), готовые блоки перечислены в
+    индексном файле. Чтение окна ждет, пока все его блоки будут загружены.
+    """
+
+    def __init__(self, source, poll_interval=0.05, timeout=600):
+        self.index_path = source['index']
+        self.width = int(source['width'])
+        self.height = int(source['height'])
+        self.dtype = np.dtype(source['dtype'])
+        self.bands = int(source['bands'])
+        self.block_size = int(source['block_size'])
+        self.shape = (self.height, self.width, 3)
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+        self.data = np.memmap(
+            source['path'], mode='r', dtype=self.dtype,
+            shape=(self.height, self.width, self.bands)
+        )
+        # Готовность блоков в сетке блоков экспортера
+        self.ready = np.zeros((
+            -(-self.height // self.block_size),
+            -(-self.width // self.block_size)
+        ), dtype=bool)
+        self.done = False
+        self._index_offset = 0
+
+    def _poll_index(self):
+        """Читает новые записи индексного файла"""
+        with open(self.index_path, 'rb') as f:
+            f.seek(self._index_offset)
+            chunk = f.read()
+
+        # Неполная последняя строка будет дочитана в следующий раз
+        complete = chunk[:chunk.rfind(b'\n') + 1]
+        self._index_offset += len(complete)
+
+        for line in complete.decode('utf-8').splitlines():
+            record = json.loads(line)
+            if 'error' in record:
+                raise RuntimeError(f"Ошибка загрузки блока: {record['error']}")
+            if record.get('done'):
+                self.done = True
+                continue
+            self.ready[record['y'] // self.block_size, record['x'] // self.block_size] = True
+
+    def _wait_for(self, x, y, width, height):
+        """Ожидает загрузки всех блоков окна"""
+        started = time.monotonic()
+        bs = self.block_size
+        blocks = self.ready[y // bs:-(-(y + height) // bs), x // bs:-(-(x + width) // bs)]
+        while not blocks.all():
+            if self.done:
+                raise RuntimeError("Загрузка завершена, но часть блоков отсутствует")
+            if time.monotonic() - started > self.timeout:
+                raise TimeoutError("Превышено время ожидания блоков растра")
+            time.sleep(self.poll_interval)
+            self._poll_index()
+
+    def read_window(self, x, y, width, height):
+        """Читает окно, дожидаясь его загрузки"""
+        self._poll_index()
+        self._wait_for(x, y, width, height)
+        data = np.array(self.data[y:y + height, x:x + width])
+        if self.bands < 3:
+            data = np.repeat(data[:, :, :1], 3, axis=2)
+        return data
+
+    def read(self):
+        """Читает весь источник целиком"""
+        return self.read_window(0, 0, self.width, self.height)
+
+    def __getitem__(self, key):
+        rows, cols = key[0], key[1]
+        y0, y1, _ = rows.indices(self.height)
+        x0, x1, _ = cols.indices(self.width)
+        return self.read_window(x0, y0, x1 - x0, y1 - y0)
+
+    def close(self):
+        self.data = None
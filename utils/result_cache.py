@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Кэш результатов сервера инференса
+
+Ключ - хэш пикселей изображения, идентификатор модели, размер патча и число
+подразделений. Хэш считается по декодированным пикселям, поэтому не зависит
+от кодека передачи: клиент вычисляет его до отправки и проверяет кэш
+запросом без тела (GET /result/<хэш>), а при попадании не загружает
+изображение вовсе.
+
+Маски хранятся сжатыми (PNG с палитрой) в памяти и на диске, оба уровня
+ограничены по размеру и вытесняют давно не использованные записи (LRU).
+
+Промах проверки кэша и последующая загрузка того же изображения - один
+промах: ключи недавних промахов запоминаются, и повторный промах по ним не
+учитывается.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.wire_codecs import encode, decode
+
+
+def content_hash(array):
+    """SHA-256 пикселей uint8-изображения вместе с его размерами"""
+    array = np.ascontiguousarray(array, dtype=np.uint8)
+    digest = hashlib.sha256(repr(array.shape).encode('ascii'))
+    digest.update(memoryview(array).cast('B'))
+    return digest.hexdigest()
+
+
+def model_id(model_path):
+    """Идентификатор модели: имя, размер и время изменения файла"""
+    try:
+        stat = os.stat(model_path)
+        return f"{os.path.basename(model_path)}:{stat.st_size}:{int(stat.st_mtime)}"
+    except OSError:
+        return os.path.basename(model_path)
+
+
+class ResultCache:
+    """LRU-кэш масок в памяти и на диске"""
+
+    # Сколько ключей недавних промахов помнить
+    MISSED_KEYS = 4096
+
+    def __init__(self, directory=None, memory_bytes=256 * 1024 ** 2, disk_bytes=2 * 1024 ** 3):
+        self.directory = directory
+        self.memory_limit = memory_bytes
+        self.disk_limit = disk_bytes if directory else 0
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk = OrderedDict()
+        self._disk_size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self._missed = OrderedDict()
+
+        if self.disk_limit:
+            os.makedirs(directory, exist_ok=True)
+            self._load_disk_index()
+
+    @staticmethod
+    def key(image_hash, model, patch_size, subdivisions):
+        raw = f"{image_hash}:{model}:{patch_size}:{subdivisions}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Маска классов по ключу или None"""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+            elif key in self._disk:
+                data = self._read_disk(key)
+
+            if data is None:
+                if self._missed.pop(key, False):
+                    return None
+                self.misses += 1
+                self._missed[key] = True
+                if len(self._missed) > self.MISSED_KEYS:
+                    self._missed.popitem(last=False)
+                return None
+            self._missed.pop(key, None)
+            self.hits += 1
+
+        return decode(data, 'png')
+
+    def put(self, key, mask):
+        """Сохраняет маску классов"""
+        data = encode(mask, 'png')
+        with self._lock:
+            self._missed.pop(key, None)
+            self._put_memory(key, data)
+            if self.disk_limit:
+                self._put_disk(key, data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'cache_hits': self.hits,
+                'cache_misses': self.misses,
+                'cache_hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'cache_memory_entries': len(self._memory),
+                'cache_memory_bytes': self._memory_size,
+                'cache_disk_entries': len(self._disk),
+                'cache_disk_bytes': self._disk_size,
+            }
+
+    def _put_memory(self, key, data):
+        if len(data) > self.memory_limit:
+            return
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key))
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_limit:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.png")
+
+    def _put_disk(self, key, data):
+        if len(data) > self.disk_limit or key in self._disk:
+            return
+        path = self._path(key)
+        temp_path = path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            return
+        self._disk[key] = len(data)
+        self._disk_size += len(data)
+        self._evict_disk()
+
+    def _read_disk(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+            # Время доступа хранится в mtime, чтобы порядок LRU пережил перезапуск
+            os.utime(self._path(key))
+        except OSError:
+            self._disk_size -= self._disk.pop(key)
+            return None
+        self._disk.move_to_end(key)
+        self._put_memory(key, data)
+        return data
+
+    def _load_disk_index(self):
+        """Индекс записей на диске в порядке последнего использования"""
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                continue
+            if not name.endswith('.png'):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name[:-4], stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_size += size
+
+        self._evict_disk()
+
+    def _evict_disk(self):
+        while self._disk_size > self.disk_limit and self._disk:
+            evicted, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            try:
+                os.unlink(self._path(evicted))
+            except OSError:
+                pass
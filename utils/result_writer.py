@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+"""
+Запись маски классов в файлы результата по полосам
+
+С геоданными маска пишется в одноканальный GeoTIFF с таблицей цветов
+окнами по мере готовности полос, без сборки всего растра в памяти. Имена
+классов и гистограмма сохраняются в <файл>.aux.xml, откуда их читают GDAL
+и QGIS, статистика - в метаданных канала.
+
+Результат по умолчанию - Cloud Optimized GeoTIFF: полосы пишутся в
+промежуточный тайловый сжатый файл, который затем копируется драйвером COG
+с внутренними обзорами (ресэмплинг MODE, чтобы в обзорах оставались
+только существующие классы). QGIS открывает такой слой без сканирования
+статистики и отрисовывает крупный масштаб по обзорам.
+Без геоданных маска собирается целиком и сохраняется как PNG с палитрой.
+RGB строится только по запросу (output_rgb).
+С AOI (utils/aoi.py) пиксели вне полигонов записываются как nodata.
+
+Из голосов классов (write_scores) в том же проходе по полосам можно
+записать растры для контроля качества: <результат>_confidence.tif
+(максимальная вероятность и отрыв от второго класса) и <результат>_probs.tif
+(вероятности всех классов). Значения квантуются в 0..254 с масштабом
+1/254 в метаданных канала, 255 - nodata. Эти растры пишутся только
+при наличии геопривязки.
+
+Попутно с записью полос накапливаются количества пикселей классов
+(np.bincount по полосе), с AOI - отдельно по каждому полигону. По ним
+считаются площади в единицах карты, которые попадают в метаданные и
+<результат>_class_stats.csv без повторного прохода по растру.
+
+С vector каждая полоса сразу векторизуется (utils/vectorize.py), полигоны
+со слиянием через швы полос пишутся в <результат>_polygons.gpkg.
+
+С preview_interval промежуточный файл (preview_path) можно открыть в QGIS,
+пока задание идет: он создается целиком сразу (незаписанные блоки читаются
+как nodata), а не чаще раза в preview_interval секунд закрывается и
+открывается снова на дозапись, чтобы записанные полосы попали в заголовок
+TIFF. Промежуточный файл может быть еще открыт в QGIS при переносе в
+результат, поэтому его удаление и перенос допускают отказ (Windows).
+"""
+import csv
+import os
+import shutil
+import time
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from utils.palette import colorize, color_map
+from utils.wire_codecs import encode
+
+
+# Вероятность 1.0 в квантованных растрах; 255 остается для nodata
+PROBABILITY_MAX = 254
+
+
+class MaskWriter:
+    """Запись маски классов (H, W) полосами строк"""
+
+    def __init__(self, params, height, width, colors, class_names=None, output_rgb=False,
+                 cog=True, compress='ZSTD', block_size=512, nodata=255, aoi=None,
+                 confidence=False, probabilities=False, vector=False, vector_simplify=0.0,
+                 vector_min_area=0.0, preview_interval=None):
+        self.params = params
+        self.height = height
+        self.width = width
+        self.colors = colors
+        self.class_names = class_names
+        self.output_rgb = output_rgb
+        self.output_path = params['output_path']
+        self.cog = cog
+        self.compress = compress
+        self.block_size = block_size
+        self.nodata = nodata
+        self.aoi = aoi
+        self.dataset = None
+        self.mask = None
+        # Дополнительные растры: вид -> {'path', 'part_path', 'dataset'}
+        self.extras = {}
+        # Векторизация полос и запись полигонов в GeoPackage
+        self.polygonizer = None
+        self.vector = None
+        # Гистограмма по всем значениям накапливается при записи полос
+        self.histogram = np.zeros(256, dtype=np.int64)
+        # Гистограммы по полигонам AOI, строка 0 - вне AOI
+        self.aoi_histogram = None
+        if aoi is not None:
+            self.aoi_histogram = np.zeros((len(aoi.geometries) + 1, 256), dtype=np.int64)
+        self.pixel_area = None
+        self.part_path = os.path.splitext(self.output_path)[0] + '.part.tif' if cog else self.output_path
+        # Файл, который показывается во время записи (None - без предпросмотра)
+        self.preview_path = None
+        self.preview_interval = preview_interval
+        self.checkpoint_time = None
+
+        geo_data = params.get('georeference_data')
+        if geo_data:
+            # Импортируем rasterio только здесь, в subprocess
+            import rasterio
+            from rasterio.transform import from_bounds
+
+            transform = from_bounds(
+                geo_data['extent_xmin'],
+                geo_data['extent_ymin'],
+                geo_data['extent_xmax'],
+                geo_data['extent_ymax'],
+                width,
+                height
+            )
+            self.pixel_area = abs(transform.a * transform.e)
+            profile = {
+                'driver': 'GTiff',
+                'height': height,
+                'width': width,
+                'count': 1,
+                'dtype': 'uint8',
+                'crs': geo_data.get('crs'),
+                'transform': transform,
+                'photometric': 'palette',
+                'nodata': nodata,
+                'tiled': True,
+                'blockxsize': block_size,
+                'blockysize': block_size,
+                'BIGTIFF': 'IF_SAFER'
+            }
+            if preview_interval is not None:
+                # Пустые блоки не пишутся и читаются как nodata
+                profile['SPARSE_OK'] = True
+            try:
+                self.dataset = rasterio.open(self.part_path, 'w', compress=compress, **profile)
+            except rasterio.errors.RasterioError:
+                # GDAL без ZSTD
+                self.compress = 'DEFLATE'
+                self.dataset = rasterio.open(self.part_path, 'w', compress=self.compress, **profile)
+            self.dataset.write_colormap(1, color_map(colors))
+            if preview_interval is not None:
+                del profile['SPARSE_OK']
+                self._checkpoint(force=True)
+                self.preview_path = self.part_path
+
+            del profile['photometric']
+            profile['nodata'] = 255
+            if confidence:
+                self._open_extra('confidence', profile, ['max_probability', 'margin'])
+            if probabilities:
+                names = [
+                    class_names[index] if class_names and index < len(class_names) else str(index)
+                    for index in range(len(colors))
+                ]
+                self._open_extra('probabilities', profile, names)
+            if vector:
+                self._open_vector(transform, geo_data.get('crs'), vector_simplify, vector_min_area)
+        else:
+            self.mask = np.zeros((height, width), dtype=np.uint8)
+
+    def write(self, row, band):
+        """Записывает полосу маски (rows, W), начиная со строки row"""
+        self._write_band(row, band)
+
+    def write_scores(self, row, scores):
+        """Записывает полосу по голосам классов (rows, W, nb_classes)
+
+        Голоса - смешанные вероятности или one-hot маски патчей с весами;
+        деление на сумму по классам дает вероятности.
+        """
+        band = np.argmax(scores, axis=2).astype(np.uint8)
+        if not self.extras:
+            return self._write_band(row, band)
+
+        probabilities = scores / np.maximum(scores.sum(axis=2, keepdims=True), 1e-8)
+        extras = {}
+        if 'confidence' in self.extras:
+            if probabilities.shape[2] > 1:
+                top = np.partition(probabilities, -2, axis=2)[..., -2:]
+                confidence = np.stack([top[..., 1], top[..., 1] - top[..., 0]], axis=2)
+            else:
+                confidence = np.stack([probabilities[..., 0], probabilities[..., 0]], axis=2)
+            extras['confidence'] = quantize_probabilities(confidence)
+        if 'probabilities' in self.extras:
+            extras['probabilities'] = quantize_probabilities(probabilities)
+        self._write_band(row, band, extras)
+
+    def _write_band(self, row, band, extras=None):
+        if self.aoi is not None:
+            labels = self.aoi.labels(row, band.shape[0])
+            band = np.where(labels > 0, band, np.uint8(self.nodata))
+            if extras:
+                extras = {
+                    kind: np.where(labels[..., np.newaxis] > 0, data, np.uint8(255))
+                    for kind, data in extras.items()
+                }
+            keys = labels.ravel().astype(np.int64) * 256 + band.ravel()
+            self.aoi_histogram += np.bincount(keys, minlength=self.aoi_histogram.size).reshape(
+                self.aoi_histogram.shape)
+        self.histogram += np.bincount(band.ravel(), minlength=256)
+        if self.polygonizer is not None:
+            self.polygonizer.add(row, band)
+
+        if self.dataset is not None:
+            from rasterio.windows import Window
+
+            window = Window(0, row, self.width, band.shape[0])
+            self.dataset.write(band, 1, window=window)
+            for kind, data in (extras or {}).items():
+                self.extras[kind]['dataset'].write(np.transpose(data, (2, 0, 1)), window=window)
+            if self.preview_path is not None:
+                self._checkpoint()
+        else:
+            self.mask[row:row + band.shape[0]] = band
+
+    def close(self):
+        if self.dataset is not None:
+            self.dataset.update_tags(1, **statistics_tags(self.histogram, self.nodata))
+            self.dataset.close()
+            self.dataset = None
+            if self.cog:
+                self._write_cog(self.part_path, self.output_path, 'MODE')
+            for extra in self.extras.values():
+                extra['dataset'].close()
+                extra['dataset'] = None
+                if self.cog:
+                    self._write_cog(extra['part_path'], extra['path'], 'AVERAGE')
+            if self.polygonizer is not None:
+                self.polygonizer.close()
+                self.vector.close()
+            names = self.class_names[:len(self.colors)] if self.class_names else None
+            write_pam(self.output_path, names, self.histogram)
+            return
+
+        if self.mask is not None:
+            # PNG с палитрой: индексы классов и цвета в одном файле
+            with open(self.output_path.replace('.tif', '_mask.png'), 'wb') as f:
+                f.write(encode(self.mask, 'png', self.colors))
+            if self.output_rgb:
+                with open(self.output_path.replace('.tif', '_rgb.png'), 'wb') as f:
+                    f.write(encode(colorize(self.mask, self.colors), 'png'))
+            self.mask = None
+
+    def statistics(self):
+        """Количество пикселей и площади классов (всего и по полигонам AOI)"""
+        report = {
+            'pixel_area': self.pixel_area,
+            'classes': class_statistics(self.histogram, len(self.colors), self.class_names,
+                                        self.pixel_area, self.nodata),
+        }
+        if self.aoi_histogram is not None:
+            report['features'] = [
+                {
+                    'id': feature_id,
+                    'classes': class_statistics(self.aoi_histogram[index + 1], len(self.colors),
+                                                self.class_names, self.pixel_area, self.nodata),
+                }
+                for index, feature_id in enumerate(self.aoi.ids)
+            ]
+        return report
+
+    def output_paths(self):
+        """Пути дополнительных файлов по видам (confidence, probabilities, vector)"""
+        paths = {kind: extra['path'] for kind, extra in self.extras.items()}
+        if self.vector is not None:
+            paths['vector'] = self.vector.path
+        return paths
+
+    def abort(self):
+        """Закрывает файл без сохранения маски без геопривязки"""
+        if self.dataset is not None:
+            self.dataset.close()
+            self.dataset = None
+            if self.cog and os.path.exists(self.part_path):
+                _remove(self.part_path)
+        for extra in self.extras.values():
+            if extra['dataset'] is not None:
+                extra['dataset'].close()
+                extra['dataset'] = None
+            if self.cog and os.path.exists(extra['part_path']):
+                _remove(extra['part_path'])
+        if self.vector is not None:
+            self.vector.abort()
+            self.polygonizer = None
+        self.mask = None
+
+    def _checkpoint(self, force=False):
+        """Закрывает и снова открывает промежуточный файл, чтобы читатели видели записанные полосы"""
+        import rasterio
+
+        now = time.monotonic()
+        if not force and now - self.checkpoint_time < self.preview_interval:
+            return
+        self.dataset.close()
+        self.dataset = rasterio.open(self.part_path, 'r+')
+        self.checkpoint_time = now
+
+    def _open_extra(self, kind, profile, descriptions):
+        """Открывает дополнительный растр с каналами descriptions"""
+        import rasterio
+
+        suffix = {'confidence': '_confidence', 'probabilities': '_probs'}[kind]
+        path = self.output_path.replace('.tif', suffix + '.tif')
+        part_path = os.path.splitext(path)[0] + '.part.tif' if self.cog else path
+        dataset = rasterio.open(part_path, 'w', compress=self.compress,
+                                **dict(profile, count=len(descriptions)))
+        dataset.scales = [1.0 / PROBABILITY_MAX] * len(descriptions)
+        for index, description in enumerate(descriptions, start=1):
+            dataset.set_band_description(index, description)
+        self.extras[kind] = {'path': path, 'part_path': part_path, 'dataset': dataset}
+
+    def _open_vector(self, transform, crs, simplify, min_area):
+        """Открывает <результат>_polygons.gpkg и векторизацию полос"""
+        from utils.geopackage import GeoPackageWriter
+        from utils.vectorize import Polygonizer
+
+        names = self.class_names or []
+        self.vector = GeoPackageWriter(self.output_path.replace('.tif', '_polygons.gpkg'), crs=crs)
+
+        def sink(polygons, value, area):
+            name = names[value] if value < len(names) else str(value)
+            self.vector.add(polygons, value, name, area)
+
+        self.polygonizer = Polygonizer(transform, self.width, sink, nodata=self.nodata,
+                                       simplify=simplify, min_area=min_area)
+
+    def _write_cog(self, part_path, output_path, resampling):
+        """Копия промежуточного файла в COG с обзорами"""
+        import rasterio
+        import rasterio.shutil
+        from rasterio.enums import Resampling
+
+        try:
+            rasterio.shutil.copy(
+                part_path,
+                output_path,
+                driver='COG',
+                COMPRESS=self.compress,
+                BLOCKSIZE=self.block_size,
+                RESAMPLING=resampling,
+                OVERVIEWS='AUTO',
+                BIGTIFF='IF_SAFER'
+            )
+            _remove(part_path)
+        except rasterio.errors.RasterioError:
+            # GDAL без драйвера COG: тайловый файл с внутренними обзорами
+            with rasterio.open(part_path, 'r+') as dst:
+                dst.build_overviews(overview_factors(self.width, self.height, self.block_size),
+                                    Resampling[resampling.lower()])
+            try:
+                os.replace(part_path, output_path)
+            except OSError:
+                # Файл предпросмотра открыт в QGIS
+                shutil.copyfile(part_path, output_path)
+                _remove(part_path)
+
+
+def _remove(path):
+    """Удаляет файл; открытый в другом процессе (Windows) остается, его удалит плагин"""
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def quantize_probabilities(probabilities):
+    """Вероятности 0..1 в uint8 0..PROBABILITY_MAX"""
+    return np.rint(np.clip(probabilities, 0.0, 1.0) * PROBABILITY_MAX).astype(np.uint8)
+
+
+def overview_factors(width, height, block_size):
+    """Уровни обзоров 2, 4, 8... пока предыдущий уровень больше блока, как в драйвере COG"""
+    factors = []
+    factor = 2
+    while max(width, height) / (factor // 2) > block_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def statistics_tags(histogram, nodata=None):
+    """Статистика канала (метаданные GDAL STATISTICS_*) по гистограмме значений"""
+    counts = histogram.astype(np.float64)
+    if nodata is not None:
+        counts[nodata] = 0
+    total = counts.sum()
+    if total == 0:
+        return {}
+
+    values = np.arange(len(counts))
+    present = np.flatnonzero(counts)
+    mean = float((values * counts).sum() / total)
+    std = float(np.sqrt(((values - mean) ** 2 * counts).sum() / total))
+    return {
+        'STATISTICS_MINIMUM': int(present[0]),
+        'STATISTICS_MAXIMUM': int(present[-1]),
+        'STATISTICS_MEAN': round(mean, 6),
+        'STATISTICS_STDDEV': round(std, 6),
+        'STATISTICS_VALID_PERCENT': round(total / histogram.sum() * 100, 3),
+    }
+
+
+def class_statistics(histogram, nb_classes, names=None, pixel_area=None, nodata=None):
+    """Пиксели, площадь и доля каждого класса по гистограмме маски"""
+    counts = histogram.astype(np.int64)
+    if nodata is not None:
+        counts = counts.copy()
+        counts[nodata] = 0
+    total = int(counts.sum())
+
+    rows = []
+    for value in range(nb_classes):
+        pixels = int(counts[value])
+        rows.append({
+            'class': value,
+            'name': names[value] if names and value < len(names) else str(value),
+            'pixels': pixels,
+            'area': round(pixels * pixel_area, 6) if pixel_area else None,
+            'percent': round(pixels / total * 100, 4) if total else 0.0,
+        })
+    return rows
+
+
+def write_class_csv(path, statistics):
+    """Площади классов в CSV: строки всего растра и строки полигонов AOI"""
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['feature', 'class', 'name', 'pixels', 'area', 'percent'])
+        groups = [('', statistics['classes'])]
+        groups.extend((feature['id'], feature['classes']) for feature in statistics.get('features', []))
+        for feature_id, rows in groups:
+            for row in rows:
+                writer.writerow([feature_id, row['class'], row['name'], row['pixels'],
+                                 '' if row['area'] is None else row['area'], row['percent']])
+
+
+def write_pam(raster_path, names=None, histogram=None):
+    """Имена классов и гистограмма одноканального растра в <растр>.aux.xml (GDAL PAM)"""
+    lines = [
+        '<PAMDataset>',
+        '  <PAMRasterBand band="1">',
+    ]
+    if names:
+        lines.append('    <CategoryNames>')
+        lines.extend(f'      <Category>{escape(name)}</Category>' for name in names)
+        lines.append('    </CategoryNames>')
+    if histogram is not None:
+        lines.extend([
+            '    <Histograms>',
+            '      <HistItem>',
+            '        <HistMin>-0.5</HistMin>',
+            '        <HistMax>255.5</HistMax>',
+            f'        <BucketCount>{len(histogram)}</BucketCount>',
+            '        <IncludeOutOfRange>0</IncludeOutOfRange>',
+            '        <Approximate>0</Approximate>',
+            f'        <HistCounts>{"|".join(str(int(count)) for count in histogram)}</HistCounts>',
+            '      </HistItem>',
+            '    </Histograms>',
+        ])
+    lines.extend([
+        '  </PAMRasterBand>',
+        '</PAMDataset>',
+    ])
+
+    with open(raster_path + '.aux.xml', 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
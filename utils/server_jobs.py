@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Асинхронные задания сервера инференса
+
+Задание - набор патчей одного размера. Клиент создает задание
+(POST /jobs), загружает патчи (PUT /jobs/<id>/tiles/<n>) и, не дожидаясь
+окончания загрузки, опрашивает готовность с ожиданием
+(GET /jobs/<id>?since=<n>&wait=<сек>), забирая готовые патчи по одному
+(GET /jobs/<id>/tiles/<n>). Повторная загрузка уже полученного патча
+игнорируется, поэтому клиент после перезапуска догружает только
+недостающие патчи.
+
+Результаты хранятся сжатыми (PNG с палитрой) до удаления задания
+(DELETE /jobs/<id>) или истечения JOB_TTL_SECONDS без обращений.
+"""
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.wire_codecs import encode
+
+
+JOB_TTL_SECONDS = 6 * 3600
+
+
+class ServerJob:
+    """Состояние одного задания"""
+
+    def __init__(self, tiles_total, tile_size):
+        self.id = uuid.uuid4().hex
+        self.tiles_total = tiles_total
+        self.tile_size = tile_size
+        self.received = bytearray(tiles_total)
+        self.results = {}
+        # Порядок готовности: клиент запрашивает готовые после позиции since
+        self.completed = []
+        self.errors = {}
+        self.last_access = time.time()
+        self.condition = threading.Condition()
+
+    def complete(self, index, data):
+        with self.condition:
+            self.results[index] = data
+            self.errors.pop(index, None)
+            self.completed.append(index)
+            self.condition.notify_all()
+
+    def fail(self, index, message):
+        with self.condition:
+            # Патч можно загрузить повторно
+            self.received[index] = 0
+            self.errors[index] = message
+            self.condition.notify_all()
+
+    def wait(self, since, timeout):
+        """Ждет готовых патчей после позиции since не дольше timeout"""
+        with self.condition:
+            self.condition.wait_for(
+                lambda: len(self.completed) > since or len(self.results) == self.tiles_total,
+                timeout=timeout
+            )
+
+    def status(self, since=0, missing=False):
+        with self.condition:
+            done = len(self.results)
+            report = {
+                'job': self.id,
+                'status': 'done' if done == self.tiles_total else 'running',
+                'tiles_total': self.tiles_total,
+                'tiles_received': sum(self.received),
+                'tiles_done': done,
+                'completed': self.completed[since:],
+                'seq': len(self.completed),
+                # Ошибки только по патчам, которые еще не загружены повторно
+                'errors': {
+                    index: message for index, message in self.errors.items()
+                    if not self.received[index]
+                },
+            }
+            if missing:
+                report['missing'] = [
+                    index for index, flag in enumerate(self.received) if not flag
+                ]
+            return report
+
+
+class JobManager:
+    """Задания сервера; патчи выполняются через общий батчер"""
+
+    def __init__(self, predict_tile, workers=32, ttl=JOB_TTL_SECONDS):
+        # predict_tile(patch) -> маска; вызывается из потоков пула,
+        # патчи объединяются в батчи на стороне батчера
+        self.predict_tile = predict_tile
+        self.ttl = ttl
+        self.jobs = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.queued = 0
+        self._lock = threading.Lock()
+
+    def create(self, tiles_total, tile_size):
+        if tiles_total <= 0 or tile_size <= 0:
+            raise ValueError("tiles и tile_size должны быть положительными")
+        job = ServerJob(tiles_total, tile_size)
+        with self._lock:
+            self._expire()
+            self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is not None:
+            job.last_access = time.time()
+        return job
+
+    def delete(self, job_id):
+        with self._lock:
+            return self.jobs.pop(job_id, None) is not None
+
+    def submit_tile(self, job, index, patch):
+        """Ставит патч в очередь; False если он уже получен"""
+        if not 0 <= index < job.tiles_total:
+            raise ValueError(f"Номер патча вне диапазона: {index}")
+        if patch.shape[:2] != (job.tile_size, job.tile_size):
+            raise ValueError(f"Размер патча {patch.shape[:2]} не равен {job.tile_size}")
+
+        with job.condition:
+            if job.received[index]:
+                return False
+            job.received[index] = 1
+
+        with self._lock:
+            self.queued += 1
+        self.executor.submit(self._process, job, index, patch)
+        return True
+
+    def _process(self, job, index, patch):
+        try:
+            mask = self.predict_tile(patch)
+            job.complete(index, encode(mask, 'png'))
+        except Exception as e:
+            job.fail(index, str(e))
+        finally:
+            with self._lock:
+                self.queued -= 1
+
+    def _expire(self):
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if now - job.last_access > self.ttl]:
+            del self.jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'jobs_active': len(self.jobs),
+                'job_tiles_queued': self.queued,
+            }
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Потоковая векторизация маски классов по полосам
+
+Каждая записанная полоса маски векторизуется сразу (rasterio.features.shapes,
+4-связность) в координатах пикселей всего растра. Полигон, касающийся
+нижнего края полосы, может продолжаться в следующей: номера полигонов на
+последней строке полосы и первой строке следующей сравниваются, и
+соседние полигоны одного класса объединяются в группу (union-find). Группа
+готова, когда ни один ее полигон не касается нижнего края последней полосы,
+- тогда она сливается в одну геометрию и отдается на запись, так что в
+памяти остаются только полигоны, пересекающие текущий шов.
+
+Слияние без shapely: границы полигонов группы - отрезки по краям пикселей,
+общие отрезки на швах проходятся соседями в противоположных направлениях и
+взаимно уничтожаются, из оставшихся собираются кольца. В вершине, где
+касаются два пикселя по диагонали, обход поворачивает внутрь, как при
+4-связности.
+
+Площадь объектов точная (по числу пикселей). Упрощение (Douglas-Peucker)
+выполняется в единицах карты после слияния, поэтому швы на него не влияют,
+но общие границы соседних объектов после упрощения могут не совпадать.
+"""
+import numpy as np
+
+
+class Polygonizer:
+    """Векторизация полос маски со слиянием полигонов через швы"""
+
+    def __init__(self, transform, width, sink, nodata=255, simplify=0.0, min_area=0.0):
+        """
+        Args:
+            transform: Affine растра результата
+            width: ширина растра в пикселях
+            sink: функция (polygons, value, area) для готовых объектов, polygons -
+                список полигонов из колец (n, 2) в координатах карты
+            nodata: значение маски вне данных
+            simplify: допуск упрощения в единицах карты (0 - без упрощения)
+            min_area: минимальная площадь объекта в единицах карты
+        """
+        self.transform = transform
+        self.width = width
+        self.sink = sink
+        self.nodata = nodata
+        self.simplify = simplify
+        self.min_area = min_area
+        self.pixel_area = abs(transform.a * transform.e - transform.b * transform.d)
+        self.pieces = {}
+        self.parent = {}
+        self.next_id = 1
+        # Значения и номера полигонов последней строки предыдущей полосы
+        self.previous = None
+        self.features = 0
+        self.skipped = 0
+
+    def add(self, row, band):
+        """Векторизует полосу маски (rows, W), начинающуюся со строки row"""
+        from rasterio.features import shapes
+        from rasterio.transform import Affine
+
+        rows = band.shape[0]
+        top, bottom = [], []
+        for geometry, value in shapes(band, mask=band != self.nodata, connectivity=4,
+                                      transform=Affine.translation(0, row)):
+            piece = _Piece(geometry['coordinates'], int(value), row, rows)
+            piece_id = self.next_id
+            self.next_id += 1
+            self.pieces[piece_id] = piece
+            self.parent[piece_id] = piece_id
+            if piece.top == row:
+                top.append(piece_id)
+            if piece.bottom == row + rows:
+                bottom.append(piece_id)
+
+        if self.previous is not None:
+            values, ids = self.previous
+            top_ids = self._edge_ids(top, row)
+            linked = (ids > 0) & (top_ids > 0) & (values == band[0])
+            if linked.any():
+                pairs = np.unique(np.stack([ids[linked], top_ids[linked]], axis=1), axis=0)
+                for above, below in pairs:
+                    self._union(int(above), int(below))
+
+        self.previous = (band[-1].copy(), self._edge_ids(bottom, row + rows))
+        self._emit_closed({self._find(piece_id) for piece_id in bottom})
+
+    def close(self):
+        """Отдает оставшиеся группы"""
+        self._emit_closed(set())
+        self.previous = None
+
+    def _edge_ids(self, piece_ids, y):
+        """Номера полигонов вдоль горизонтальной линии y по их отрезкам на ней"""
+        ids = np.zeros(self.width, dtype=np.int64)
+        for piece_id in piece_ids:
+            ring = self.pieces[piece_id].rings[0]
+            on_line = (ring[:-1, 1] == y) & (ring[1:, 1] == y)
+            for x0, x1 in zip(ring[:-1, 0][on_line], ring[1:, 0][on_line]):
+                ids[int(min(x0, x1)):int(max(x0, x1))] = piece_id
+        return ids
+
+    def _find(self, piece_id):
+        root = piece_id
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[piece_id] != root:
+            self.parent[piece_id], piece_id = root, self.parent[piece_id]
+        return root
+
+    def _union(self, a, b):
+        a, b = self._find(a), self._find(b)
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+
+    def _emit_closed(self, open_roots):
+        """Сливает и отдает группы, которые больше не продолжаются"""
+        groups = {}
+        for piece_id in self.pieces:
+            root = self._find(piece_id)
+            if root not in open_roots:
+                groups.setdefault(root, []).append(piece_id)
+
+        for piece_ids in groups.values():
+            pieces = [self.pieces.pop(piece_id) for piece_id in piece_ids]
+            for piece_id in piece_ids:
+                del self.parent[piece_id]
+            self._emit(pieces)
+
+    def _emit(self, pieces):
+        area = sum(piece.area for piece in pieces) * self.pixel_area
+        if area < self.min_area:
+            self.skipped += 1
+            return
+
+        if len(pieces) == 1:
+            polygons = [pieces[0].rings]
+        else:
+            polygons = merge_rings(pieces)
+
+        transform = self.transform
+        # Отражение по оси (обычно e < 0) меняет направление обхода колец
+        flip = transform.a * transform.e - transform.b * transform.d < 0
+        out = []
+        for rings in polygons:
+            converted = []
+            for index, ring in enumerate(rings):
+                ring = np.column_stack([
+                    transform.a * ring[:, 0] + transform.b * ring[:, 1] + transform.c,
+                    transform.d * ring[:, 0] + transform.e * ring[:, 1] + transform.f,
+                ])
+                if flip:
+                    ring = ring[::-1]
+                if self.simplify > 0:
+                    simplified = simplify_ring(ring, self.simplify)
+                    if simplified is None and index > 0:
+                        # Дырка меньше допуска
+                        continue
+                    if simplified is not None:
+                        ring = simplified
+                converted.append(ring)
+            out.append(converted)
+
+        self.features += 1
+        self.sink(out, pieces[0].value, area)
+
+
+class _Piece:
+    """Полигон полосы в координатах пикселей растра
+
+    Внешнее кольцо ориентировано с положительной площадью, дырки - с
+    отрицательной, так что область всегда лежит с одной стороны обхода.
+    """
+
+    __slots__ = ('rings', 'value', 'area', 'top', 'bottom', 'row', 'rows')
+
+    def __init__(self, coordinates, value, row, rows):
+        rings = []
+        for index, ring in enumerate(coordinates):
+            ring = np.asarray(ring, dtype=np.float64)
+            if (signed_area(ring) > 0) != (index == 0):
+                ring = ring[::-1]
+            rings.append(ring)
+        self.rings = rings
+        self.value = value
+        self.area = sum(signed_area(ring) for ring in rings)
+        self.top = rings[0][:, 1].min()
+        self.bottom = rings[0][:, 1].max()
+        self.row = row
+        self.rows = rows
+
+
+def signed_area(ring):
+    """Площадь замкнутого кольца со знаком направления обхода"""
+    x, y = ring[:, 0], ring[:, 1]
+    return 0.5 * float(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]))
+
+
+def merge_rings(pieces):
+    """Слияние соседних полигонов одного класса в список полигонов из колец
+
+    Отрезки на горизонталях швов разбиваются на единичные, общие отрезки
+    соседей (противоположного направления) удаляются, остальные собираются
+    в кольца.
+    """
+    seams = np.array(sorted({piece.row for piece in pieces} | {piece.row + piece.rows for piece in pieces}),
+                     dtype=np.float64)
+
+    starts, ends = [], []
+    for piece in pieces:
+        for ring in piece.rings:
+            a, b = ring[:-1], ring[1:]
+            split = (a[:, 1] == b[:, 1]) & np.isin(a[:, 1], seams)
+            starts.append(a[~split])
+            ends.append(b[~split])
+            if split.any():
+                # Горизонтальные отрезки на швах - по единичным отрезкам
+                sa, sb = a[split], b[split]
+                lengths = np.abs(sb[:, 0] - sa[:, 0]).astype(np.int64)
+                step = np.repeat(np.sign(sb[:, 0] - sa[:, 0]), lengths)
+                offset = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+                x = np.repeat(sa[:, 0], lengths) + step * offset
+                y = np.repeat(sa[:, 1], lengths)
+                starts.append(np.column_stack([x, y]))
+                ends.append(np.column_stack([x + step, y]))
+    starts = np.concatenate(starts)
+    ends = np.concatenate(ends)
+
+    # Общие отрезки встречаются дважды в противоположных направлениях
+    keys = np.concatenate([np.minimum(starts, ends), np.maximum(starts, ends)], axis=1)
+    _, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+    single = counts[inverse.ravel()] == 1
+    starts, ends = starts[single], ends[single]
+
+    rings = _trace(starts, ends)
+    exteriors = [ring for ring in rings if signed_area(ring) > 0]
+    holes = [ring for ring in rings if signed_area(ring) < 0]
+    if len(exteriors) == 1:
+        return [exteriors[0:1] + holes]
+
+    polygons = [[exterior] for exterior in exteriors]
+    for hole in holes:
+        point = (hole[0] + hole[1]) / 2
+        for polygon in polygons:
+            if point_in_ring(point, polygon[0]):
+                polygon.append(hole)
+                break
+    return polygons
+
+
+def _trace(starts, ends):
+    """Кольца из направленных отрезков; в вершине с выбором - поворот внутрь"""
+    outgoing = {}
+    for index, start in enumerate(map(tuple, starts)):
+        outgoing.setdefault(start, []).append(index)
+    directions = ends - starts
+
+    used = np.zeros(len(starts), dtype=bool)
+    rings = []
+    for first in range(len(starts)):
+        if used[first]:
+            continue
+        used[first] = True
+        chain = [first]
+        current = first
+        while True:
+            candidates = [index for index in outgoing[tuple(ends[current])]
+                          if index == first or not used[index]]
+            if len(candidates) > 1:
+                dx, dy = directions[current]
+                following = max(candidates,
+                                key=lambda index: dx * directions[index][1] - dy * directions[index][0])
+            else:
+                following = candidates[0]
+            if following == first:
+                break
+            used[following] = True
+            chain.append(following)
+            current = following
+
+        points = starts[chain]
+        # Убираем вершины внутри прямых участков
+        step = np.sign(directions[chain])
+        turn = np.any(step != np.roll(step, 1, axis=0), axis=1)
+        points = points[turn]
+        rings.append(np.vstack([points, points[:1]]))
+    return rings
+
+
+def point_in_ring(point, ring):
+    """Точка внутри замкнутого кольца (четность пересечений луча)"""
+    x, y = point
+    a, b = ring[:-1], ring[1:]
+    crosses = (a[:, 1] > y) != (b[:, 1] > y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        at = a[:, 0] + (y - a[:, 1]) * (b[:, 0] - a[:, 0]) / (b[:, 1] - a[:, 1])
+    return bool(np.count_nonzero(crosses & (x < at)) % 2)
+
+
+def simplify_ring(ring, tolerance):
+    """Douglas-Peucker для замкнутого кольца, None если кольцо вырождается"""
+    points = ring[:-1]
+    count = len(points)
+    if count <= 3:
+        return ring
+
+    # Кольцо делится на две ломаные: от первой точки до самой дальней от нее
+    far = int(np.argmax(((points - points[0]) ** 2).sum(axis=1)))
+    keep = np.zeros(count + 1, dtype=bool)
+    keep[[0, far, count]] = True
+    stack = [(0, far), (far, count)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        a, b = ring[i], ring[j]
+        between = ring[i + 1:j]
+        dx, dy = b - a
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distance = np.hypot(between[:, 0] - a[0], between[:, 1] - a[1])
+        else:
+            distance = np.abs(dx * (between[:, 1] - a[1]) - dy * (between[:, 0] - a[0])) / length
+        k = int(np.argmax(distance))
+        if distance[k] > tolerance:
+            middle = i + 1 + k
+            keep[middle] = True
+            stack.extend([(i, middle), (middle, j)])
+
+    simplified = ring[keep]
+    if len(simplified) < 4 or signed_area(simplified) == 0:
+        return None
+    return simplified
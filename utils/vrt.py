@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Сборка VRT-мозаики из одноканальных масок сегментации
+
+Модуль не зависит от GDAL: VRT формируется как XML по размерам и границам
+исходных растров.
+"""
+import os
+from xml.sax.saxutils import escape
+
+
+def build_vrt_mosaic(vrt_path, sources, crs_wkt, colors=None, nodata=255, class_names=None):
+    """Пишет VRT-мозаику
+
+    Args:
+        vrt_path: путь к создаваемому VRT
+        sources: список словарей с ключами path, width, height и
+            bounds (xmin, ymin, xmax, ymax) в единицах crs_wkt; необязательный
+            window (x_off, y_off, x_size, y_size) - используемая часть растра,
+            тогда bounds - границы этой части. Более поздние источники
+            перекрывают более ранние
+        crs_wkt: система координат мозаики
+        colors: палитра классов [[r, g, b], ...] для таблицы цветов
+        nodata: значение для областей без данных
+        class_names: имена классов для легенды
+
+    Returns:
+        (ширина, высота) мозаики в пикселях
+    """
+    if not sources:
+        raise ValueError("Нет растров для мозаики")
+
+    windows = [s.get('window') or (0, 0, s['width'], s['height']) for s in sources]
+
+    # Разрешение мозаики - самое детальное среди источников
+    res_x = min((s['bounds'][2] - s['bounds'][0]) / w[2] for s, w in zip(sources, windows))
+    res_y = min((s['bounds'][3] - s['bounds'][1]) / w[3] for s, w in zip(sources, windows))
+
+    xmin = min(s['bounds'][0] for s in sources)
+    ymin = min(s['bounds'][1] for s in sources)
+    xmax = max(s['bounds'][2] for s in sources)
+    ymax = max(s['bounds'][3] for s in sources)
+    width = int(round((xmax - xmin) / res_x))
+    height = int(round((ymax - ymin) / res_y))
+
+    vrt_dir = os.path.dirname(os.path.abspath(vrt_path))
+    lines = [
+        f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">',
+        f'  <SRS>{escape(crs_wkt)}</SRS>',
+        f'  <GeoTransform>{xmin!r}, {res_x!r}, 0.0, {ymax!r}, 0.0, {-res_y!r}</GeoTransform>',
+        '  <VRTRasterBand dataType="Byte" band="1">',
+        f'    <NoDataValue>{nodata}</NoDataValue>',
+    ]
+
+    if colors:
+        lines.append('    <ColorInterp>Palette</ColorInterp>')
+        lines.append('    <ColorTable>')
+        for color in colors:
+            lines.append(f'      <Entry c1="{color[0]}" c2="{color[1]}" c3="{color[2]}" c4="255"/>')
+        lines.append('    </ColorTable>')
+
+    if class_names:
+        lines.append('    <CategoryNames>')
+        for name in class_names:
+            lines.append(f'      <Category>{escape(name)}</Category>')
+        lines.append('    </CategoryNames>')
+
+    for source, window in zip(sources, windows):
+        path = os.path.abspath(source['path'])
+        try:
+            filename = os.path.relpath(path, vrt_dir)
+            relative = 1
+        except ValueError:
+            # Другой диск в Windows
+            filename = path
+            relative = 0
+
+        sxmin, symin, sxmax, symax = source['bounds']
+        dst_x = (sxmin - xmin) / res_x
+        dst_y = (ymax - symax) / res_y
+        dst_w = (sxmax - sxmin) / res_x
+        dst_h = (symax - symin) / res_y
+
+        lines.extend([
+            '    <SimpleSource resampling="nearest">',
+            f'      <SourceFilename relativeToVRT="{relative}">{escape(filename)}</SourceFilename>',
+            '      <SourceBand>1</SourceBand>',
+            f'      <SrcRect xOff="{window[0]}" yOff="{window[1]}" xSize="{window[2]}" ySize="{window[3]}"/>',
+            f'      <DstRect xOff="{dst_x:.6f}" yOff="{dst_y:.6f}" xSize="{dst_w:.6f}" ySize="{dst_h:.6f}"/>',
+            '    </SimpleSource>',
+        ])
+
+    lines.extend([
+        '  </VRTRasterBand>',
+        '</VRTDataset>',
+    ])
+
+    with open(vrt_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    return width, height
@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""
+Кодеки передачи изображений между клиентом и сервером API
+
+Поддерживаемые кодеки:
+    raw       - несжатый uint8 с заголовком размеров
+    raw+lz4   - raw, сжатый LZ4 (если установлен пакет lz4)
+    raw+zstd  - raw, сжатый zstd (если установлен пакет zstandard)
+    webp      - WebP без потерь
+    png       - PNG с низким уровнем сжатия (маска - PNG с палитрой)
+    rle       - кодирование длин серий, только для масок классов
+
+Потоковый ответ (FRAME_CONTENT_TYPE) - последовательность кадров: длина
+JSON-заголовка, заголовок и данные патча. Первый кадр описывает растр
+и сетку, затем идут готовые патчи по неубыванию строки, последний кадр
+отмечает конец ответа или ошибку.
+
+Клиент запрашивает у сервера список кодеков (GET /codecs) и выбирает первый
+общий по своему порядку предпочтения отдельно для изображения и для маски
+ответа. Сервер без /codecs считается поддерживающим только PNG.
+
+Запуск модуля сравнивает кодеки по времени кодирования и объему:
+    python utils/wire_codecs.py [растр.tif]
+"""
+import io
+import json
+import os
+import struct
+import sys
+import threading
+import time
+import uuid
+
+import numpy as np
+from PIL import Image, features
+
+PLUGIN_DIR = os.environ.get('PLUGIN_DIR', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if PLUGIN_DIR not in sys.path:
+    sys.path.insert(0, PLUGIN_DIR)
+
+from utils.palette import palette_bytes, colorize
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+PNG_COMPRESS_LEVEL = 1
+ZSTD_LEVEL = 1
+
+# Заголовок raw: высота, ширина, число каналов
+RAW_HEADER = struct.Struct('<III')
+# Заголовок rle: высота, ширина, число серий
+RLE_HEADER = struct.Struct('<III')
+# Кадр потокового ответа: длина JSON-заголовка
+FRAME_HEADER = struct.Struct('<I')
+FRAME_CONTENT_TYPE = 'application/x-tile-frames'
+
+CONTENT_TYPES = {
+    'raw': 'application/x-raw-uint8',
+    'raw+lz4': 'application/x-raw-uint8+lz4',
+    'raw+zstd': 'application/x-raw-uint8+zstd',
+    'webp': 'image/webp',
+    'png': 'image/png',
+    'rle': 'application/x-mask-rle',
+}
+
+FILE_EXTENSIONS = {
+    'raw': 'raw',
+    'raw+lz4': 'raw.lz4',
+    'raw+zstd': 'raw.zst',
+    'webp': 'webp',
+    'png': 'png',
+    'rle': 'rle',
+}
+
+
+def available_codecs():
+    """Кодеки, доступные в текущем окружении"""
+    codecs = ['raw']
+    if lz4_frame is not None:
+        codecs.append('raw+lz4')
+    if zstandard is not None:
+        codecs.append('raw+zstd')
+    if features.check('webp'):
+        codecs.append('webp')
+    codecs.extend(['png', 'rle'])
+    return codecs
+
+
+def choose_codec(preference, server_codecs):
+    """Первый кодек из preference, доступный на обеих сторонах"""
+    local = available_codecs()
+    for codec in preference:
+        if codec in local and codec in server_codecs:
+            return codec
+    return 'png'
+
+
+def server_info(session, api_url, timeout=10):
+    """Возможности сервера (GET /codecs); сервер без /codecs принимает только PNG"""
+    try:
+        response = session.get(f"{api_url.rstrip('/')}/codecs", timeout=timeout)
+        if response.status_code == 200:
+            return response.json()
+    except Exception:
+        pass
+    return {'codecs': ['png']}
+
+
+def negotiate_codecs(info, preference, mask_preference):
+    """Выбор кодеков запроса и маски ответа по возможностям сервера
+
+    Returns:
+        (кодек изображения, кодек маски)
+    """
+    server_codecs = info.get('codecs', ['png'])
+
+    # WebP хранит только цветные изображения и для маски не подходит
+    mask_preference = [codec for codec in mask_preference if codec != 'webp']
+    return choose_codec(preference, server_codecs), choose_codec(mask_preference, server_codecs)
+
+
+def codec_for_content_type(content_type):
+    """Кодек по заголовку Content-Type, None если неизвестен"""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    for codec, codec_type in CONTENT_TYPES.items():
+        if codec_type == content_type:
+            return codec
+    return None
+
+
+def encode_chunks(array, codec, palette=None):
+    """Кодирует uint8-изображение (H, W) или (H, W, C) в список фрагментов
+
+    Несжатый raw передается представлением массива без копирования.
+    palette - цвета классов для PNG-маски, индексы при этом сохраняются.
+    """
+    array = np.ascontiguousarray(array, dtype=np.uint8)
+
+    if codec == 'rle':
+        return encode_rle(array)
+
+    if codec.startswith('raw'):
+        channels = array.shape[2] if array.ndim == 3 else 1
+        header = RAW_HEADER.pack(array.shape[0], array.shape[1], channels)
+        data = memoryview(array).cast('B')
+        if codec == 'raw':
+            return [header, data]
+        if codec == 'raw+lz4':
+            return [lz4_frame.compress(header + data.tobytes())]
+        if codec == 'raw+zstd':
+            return [zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(header + data.tobytes())]
+
+    buffer = io.BytesIO()
+    image = Image.fromarray(array)
+    if codec == 'webp':
+        # quality при lossless задает усилие сжатия, 0 - самое быстрое
+        image.save(buffer, format='WEBP', lossless=True, quality=0, method=0)
+    elif codec == 'png':
+        if palette is not None and array.ndim == 2:
+            image.putpalette(palette_bytes(palette))
+        image.save(buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+    else:
+        raise ValueError(f"Неизвестный кодек: {codec}")
+    return [buffer.getvalue()]
+
+
+def encode(array, codec, palette=None):
+    """Кодирует изображение в bytes"""
+    return b''.join(bytes(chunk) for chunk in encode_chunks(array, codec, palette))
+
+
+def encode_rle(mask):
+    """Маска (H, W) как серии: заголовок, значения uint8, длины uint32"""
+    if mask.ndim != 2:
+        raise ValueError("RLE применяется только к одноканальной маске")
+
+    flat = mask.ravel()
+    if flat.size == 0:
+        return [RLE_HEADER.pack(mask.shape[0], mask.shape[1], 0)]
+
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    lengths = np.diff(np.append(starts, flat.size)).astype('<u4')
+    values = flat[starts]
+    header = RLE_HEADER.pack(mask.shape[0], mask.shape[1], len(starts))
+    return [header, values.tobytes(), lengths.tobytes()]
+
+
+def decode_rle(data):
+    """Маска (H, W) из RLE"""
+    height, width, runs = RLE_HEADER.unpack_from(data)
+    offset = RLE_HEADER.size
+    values = np.frombuffer(data, dtype=np.uint8, count=runs, offset=offset)
+    lengths = np.frombuffer(data, dtype='<u4', count=runs, offset=offset + runs)
+    return np.repeat(values, lengths).reshape(height, width)
+
+
+def decode(data, codec):
+    """Декодирует изображение в numpy array uint8
+
+    PNG с палитрой декодируется в индексы, а не в цвета.
+    """
+    if codec == 'rle':
+        return decode_rle(data)
+    if codec.startswith('raw'):
+        if codec == 'raw+lz4':
+            data = lz4_frame.decompress(data)
+        elif codec == 'raw+zstd':
+            data = zstandard.ZstdDecompressor().decompress(data)
+        height, width, channels = RAW_HEADER.unpack_from(data)
+        array = np.frombuffer(data, dtype=np.uint8, offset=RAW_HEADER.size)
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        return array.reshape(shape)
+
+    return np.array(Image.open(io.BytesIO(data)))
+
+
+def frame_bytes(header, payload=b''):
+    """Кадр потокового ответа: заголовок (dict) и данные"""
+    raw = json.dumps(dict(header, length=len(payload))).encode('utf-8')
+    return FRAME_HEADER.pack(len(raw)) + raw + bytes(payload)
+
+
+def iter_frames(stream):
+    """Кадры (заголовок, данные) из потока с методом read(n)"""
+    while True:
+        prefix = _read_exact(stream, FRAME_HEADER.size)
+        if not prefix:
+            return
+        if len(prefix) != FRAME_HEADER.size:
+            raise ValueError("Поток кадров оборван")
+        header = json.loads(_read_exact(stream, FRAME_HEADER.unpack(prefix)[0]))
+        length = header.get('length', 0)
+        payload = _read_exact(stream, length) if length else b''
+        if len(payload) != length:
+            raise ValueError("Поток кадров оборван")
+        yield header, payload
+
+
+def _read_exact(stream, size):
+    """Ровно size байт; меньше только в конце потока"""
+    parts = []
+    while size > 0:
+        data = stream.read(size)
+        if not data:
+            break
+        parts.append(data)
+        size -= len(data)
+    return b''.join(parts)
+
+
+class MultipartBody:
+    """Тело multipart/form-data, отдаваемое по частям
+
+    Фрагменты не склеиваются в один буфер: requests отправляет объект
+    чтением блоков, а длина известна заранее, поэтому Content-Length
+    передается как обычно.
+    """
+
+    def __init__(self, field, filename, content_type, chunks):
+        self.boundary = uuid.uuid4().hex
+        head = (
+            f'--{self.boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'
+        ).encode('utf-8')
+        tail = f'\r\n--{self.boundary}--\r\n'.encode('utf-8')
+        self.parts = [memoryview(head)] + [memoryview(chunk) for chunk in chunks] + [memoryview(tail)]
+        self.length = sum(part.nbytes for part in self.parts)
+        self.payload_bytes = self.length - len(head) - len(tail)
+        self._index = 0
+        self._offset = 0
+
+    @property
+    def content_type(self):
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+        out = []
+        while size > 0 and self._index < len(self.parts):
+            part = self.parts[self._index]
+            piece = part[self._offset:self._offset + size]
+            out.append(piece.tobytes())
+            size -= piece.nbytes
+            self._offset += piece.nbytes
+            if self._offset >= part.nbytes:
+                self._index += 1
+                self._offset = 0
+        return b''.join(out)
+
+
+def multipart_body(chunks, codec, field='file', name='image'):
+    """Потоковое тело запроса из закодированных фрагментов изображения
+
+    Тело читается один раз, для повтора запроса создается новое.
+    """
+    return MultipartBody(field, f"{name}.{FILE_EXTENSIONS[codec]}", CONTENT_TYPES[codec], chunks)
+
+
+class TransferStats:
+    """Статистика передачи для метаданных результата"""
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.encode_seconds = 0.0
+        self.cache_hits = 0
+        self._lock = threading.Lock()
+
+    def add(self, bytes_sent, bytes_received, encode_seconds, cached=False):
+        with self._lock:
+            self.cache_hits += int(cached)
+            self.requests += 1
+            self.bytes_sent += bytes_sent
+            self.bytes_received += bytes_received
+            self.encode_seconds += encode_seconds
+
+    def as_dict(self):
+        return {
+            'codec': self.codec,
+            'requests': self.requests,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'encode_seconds': round(self.encode_seconds, 3),
+            'cache_hits': self.cache_hits,
+        }
+
+
+def benchmark(array, codecs=None, repeats=3):
+    """Время кодирования/декодирования и объем для каждого кодека"""
+    if codecs is None:
+        # RLE только для масок, WebP только для цветных изображений
+        excluded = 'rle' if array.ndim == 3 else 'webp'
+        codecs = [codec for codec in available_codecs() if codec != excluded]
+
+    rows = []
+    for codec in codecs:
+        encode_times = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            data = encode(array, codec)
+            encode_times.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        decoded = decode(data, codec)
+        decode_seconds = time.perf_counter() - started
+
+        rows.append({
+            'codec': codec,
+            'bytes': len(data),
+            'ratio': array.nbytes / len(data),
+            'encode_seconds': min(encode_times),
+            'decode_seconds': decode_seconds,
+            'lossless': bool(np.array_equal(decoded.reshape(array.shape), array)),
+        })
+    return rows
+
+
+def _benchmark_image(path=None):
+    """Изображение для сравнения: первые три канала растра или синтетика"""
+    if path:
+        import rasterio
+        with rasterio.open(path) as src:
+            indexes = [1, 2, 3] if src.count >= 3 else [1, 1, 1]
+            array = np.moveaxis(src.read(indexes), 0, -1)
+        if array.dtype != np.uint8:
+            array = ((array - array.min()) / (array.max() - array.min() + 1e-8) * 255).astype(np.uint8)
+        return array
+
+    # Синтетика с плавными переходами и шумом, близкая к снимку
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:2048, 0:2048]
+    base = (np.sin(x / 97.0) + np.cos(y / 61.0) + 2) * 60
+    noise = rng.normal(0, 6, (2048, 2048, 3))
+    return np.clip(base[..., None] + noise, 0, 255).astype(np.uint8)
+
+
+def _print_rows(rows):
+    print(f"{'кодек':<10} {'МБ':>8} {'сжатие':>7} {'код., мс':>9} {'декод., мс':>11}")
+    for row in rows:
+        print(
+            f"{row['codec']:<10} {row['bytes'] / 1e6:>8.2f} {row['ratio']:>7.2f} "
+            f"{row['encode_seconds'] * 1000:>9.1f} {row['decode_seconds'] * 1000:>11.1f}"
+            f"{'' if row['lossless'] else '  (с потерями!)'}"
+        )
+
+
+if __name__ == '__main__':
+    from config import SEGMENTATION_COLORS
+
+    image = _benchmark_image(sys.argv[1] if len(sys.argv) > 1 else None)
+    print(f"Изображение {image.shape[1]}x{image.shape[0]}, {image.nbytes / 1e6:.1f} МБ")
+    _print_rows(benchmark(image))
+
+    # Ответ сервера: маска классов против раскрашенного RGB
+    # Маска из крупных однородных областей, как у реальной сегментации
+    coarse = (image[::32, ::32, 0] // 43).clip(0, len(SEGMENTATION_COLORS) - 1).astype(np.uint8)
+    mask = np.repeat(np.repeat(coarse, 32, axis=0), 32, axis=1)[:image.shape[0], :image.shape[1]]
+    print()
+    print("Ответ с маской классов (png-rgb - прежний ответ в виде RGB)")
+    rows = benchmark(mask)
+    rows.extend(benchmark(colorize(mask, SEGMENTATION_COLORS), codecs=['png']))
+    rows[-1]['codec'] = 'png-rgb'
+    _print_rows(rows)
+    missing = [name for name, module in (('lz4', lz4_frame), ('zstandard', zstandard)) if module is None]
+    if missing:
+        print(f"Не установлены пакеты: {', '.join(missing)}")
@@ -2,13 +2,11 @@
 """
 Worker для выполнения сегментации в отдельном потоке
 """
+import time
+
 from qgis.PyQt.QtCore import QThread, pyqtSignal
-import os
-import sys
-import subprocess
-import json
-import tempfile
-import locale
+
+from .inference_process import shared_process
 
 
 class SegmentationWorker(QThread):
@@ -17,12 +15,36 @@ class SegmentationWorker(QThread):
     error = pyqtSignal(str)
     progress = pyqtSignal(int)
     result_ready = pyqtSignal(str)
+    preview_ready = pyqtSignal(str)
+    telemetry = pyqtSignal(dict)
+    cancelled = pyqtSignal(dict)
+    
+    # Доля прогресса, отведенная экспорту слоя до отправки задания
+    EXPORT_PROGRESS = 10
     
-    def __init__(self, params, plugin_dir):
+    def __init__(self, params, plugin_dir, export=None):
         super().__init__()
         self.params = params
         self.plugin_dir = plugin_dir
-        self.process = None
+        # LayerExport, который выполняется в этом потоке перед заданием
+        self.export = export
+        self.job = None
+        self.timings = {}
+        self.is_cancelled = False
+        self.cancel_report = None
+    
+    def cancel(self):
+        """Запрашивает остановку обработки
+        
+        Процесс инференса завершает текущий батч и освобождает ресурсы;
+        если он не остановился за отведенное время, процесс завершается принудительно.
+        """
+        self.is_cancelled = True
+        if self.export is not None:
+            self.export.cancel()
+        job = self.job
+        if job is not None:
+            job.cancel()
     
     def run(self):
         try:
@@ -31,128 +53,84 @@ class SegmentationWorker(QThread):
             self.error.emit(str(e))
     
     def run_inference(self):
-        """Запускает единый скрипт инференса"""
-        self.progress.emit(10)
-        
-        # Путь к единому скрипту
-        inference_script = os.path.join(self.plugin_dir, 'utils', 'inference_runner.py')
+        """Выполняет задание в постоянном процессе инференса"""
+        # Модель остается загруженной в процессе между запусками
+        process = shared_process(self.plugin_dir)
         
-        # Python из venv или portable
-        python_exe = self._find_python()
+        if self.export is not None:
+            if not self.run_export(process):
+                self.cancelled.emit({})
+                self.finished.emit()
+                return
+            self.progress.emit(self.EXPORT_PROGRESS)
         
-        # Сохраняем параметры
-        params_file = tempfile.NamedTemporaryFile(
-            mode='w', suffix='.json', delete=False, encoding='utf-8'
-        )
-        json.dump(self.params, params_file, ensure_ascii=False)
-        params_file.close()
+        self.job = process.submit(self.params)
+        if self.is_cancelled:
+            self.job.cancel()
         
+        # Читаем сообщения протокола
+        error_message = None
         try:
-            # Чистое окружение
-            env = self._create_clean_env()
-            
-            # Запускаем процесс
-            cmd = [python_exe, '-u', inference_script, params_file.name]
-            self.process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                env=env,
-                universal_newlines=True,
-                encoding='utf-8'
-            )
-            
-            # Читаем вывод
-            for line in iter(self.process.stdout.readline, ''):
-                line = line.strip()
-                if not line:
-                    continue
-                    
-                if line.startswith('PROGRESS:'):
-                    try:
-                        progress = int(line.split(':')[1])
-                        self.progress.emit(progress)
-                    except:
-                        pass
-                elif line.startswith('RESULT:'):
-                    result_path = line.split(':', 1)[1].strip()
-                    self.result_ready.emit(result_path)
-            
-            self.process.wait()
-            
-            if self.process.returncode != 0:
-                stderr = self.process.stderr.read()
-                raise Exception(f"Ошибка инференса: {stderr}")
-            
-            self.finished.emit()
-            
+            for message in self.job.messages():
+                error_message = self._handle_message(message) or error_message
         finally:
-            if self.process:
-                self.process.stdout.close()
-                self.process.stderr.close()
-                self.process = None
-            
-            try:
-                os.unlink(params_file.name)
-            except:
-                pass
+            self.job = None
+        
+        if self.cancel_report is not None or (self.is_cancelled and error_message):
+            self.cancelled.emit(self.cancel_report or {})
+        elif error_message:
+            raise Exception(f"Ошибка инференса: {error_message}")
+        
+        self.finished.emit()
     
-    def _find_python(self):
-        """Поиск Python интерпретатора"""
-        # Сначала ищем в venv
-        venv_path = os.path.join(self.plugin_dir, '.venv')
-        if os.name == 'nt':
-            python_exe = os.path.join(venv_path, 'Scripts', 'python.exe')
-        else:
-            python_exe = os.path.join(venv_path, 'bin', 'python')
+    def run_export(self, process):
+        """Экспорт слоя, пока процесс инференса загружает модель
         
-        if os.path.exists(python_exe):
-            return python_exe
+        Returns:
+            False, если экспорт отменен
+        """
+        if not self.params.get('use_api') or self.params.get('use_hybrid'):
+            process.preload(self.params.get('model_path'))
         
-        # Потом в portable_python
-        portable_path = os.path.join(self.plugin_dir, 'portable_python', 'python.exe')
-        if os.path.exists(portable_path):
-            return portable_path
+        self.telemetry.emit({'type': 'stage', 'name': 'export', 'status': 'started'})
+        started = time.perf_counter()
+        path = self.export.run(
+            progress_callback=lambda fraction: self.progress.emit(int(fraction * self.EXPORT_PROGRESS))
+        )
+        if path is None:
+            return False
         
-        raise Exception("Python интерпретатор не найден")
+        seconds = round(time.perf_counter() - started, 3)
+        self.timings['export'] = seconds
+        self.telemetry.emit({'type': 'stage', 'name': 'export', 'status': 'finished', 'seconds': seconds})
+        return not self.is_cancelled
     
-    def _create_clean_env(self):
-        """Создает чистое окружение для subprocess"""
-        env = {}
-        
-        # Минимальные системные переменные
-        for var in ['SYSTEMROOT', 'SYSTEMDRIVE', 'TEMP', 'TMP', 'USERPROFILE', 'HOME']:
-            if var in os.environ:
-                env[var] = os.environ[var]
+    def _handle_message(self, message):
+        """Обработка сообщения от процесса инференса, возвращает текст ошибки"""
+        msg_type = message.get('type')
         
-        # Определяем пути в зависимости от типа Python
-        python_exe = self._find_python()
-        if '.venv' in python_exe:
-            # Для venv
-            venv_path = os.path.join(self.plugin_dir, '.venv')
-            if os.name == 'nt':
-                paths = [
-                    os.path.join(venv_path, 'Scripts'),
-                    os.path.join(os.environ.get('SYSTEMROOT', 'C:\\Windows'), 'System32')
-                ]
-            else:
-                paths = [
-                    os.path.join(venv_path, 'bin'),
-                    '/usr/bin',
-                    '/bin'
-                ]
-            env['PYTHONHOME'] = venv_path
-        else:
-            # Для portable Python
-            portable_dir = os.path.join(self.plugin_dir, 'portable_python')
-            paths = [
-                portable_dir,
-                os.path.join(portable_dir, 'Scripts'),
-                os.path.join(os.environ.get('SYSTEMROOT', 'C:\\Windows'), 'System32')
-            ]
+        if 'percent' in message:
+            self.progress.emit(self._job_percent(message['percent']))
         
-        env['PATH'] = os.pathsep.join(paths)
-        env['PLUGIN_DIR'] = self.plugin_dir
-        env['PYTHONIOENCODING'] = 'utf-8'
+        if msg_type in ('progress', 'stage'):
+            if msg_type == 'stage' and message.get('status') == 'finished':
+                self.timings[message['name']] = message.get('seconds')
+            self.telemetry.emit(message)
+        elif msg_type == 'preview':
+            self.preview_ready.emit(message['path'])
+        elif msg_type == 'result':
+            self.timings.update(message.get('timings', {}))
+            self.progress.emit(100)
+            self.result_ready.emit(message['metadata_path'])
+        elif msg_type == 'cancelled':
+            self.cancel_report = message
+        elif msg_type == 'error':
+            return message.get('message')
         
-        return env
+        return None
+    
+    def _job_percent(self, percent):
+        """Прогресс задания на общей шкале: после экспорта - от EXPORT_PROGRESS до 100"""
+        if self.export is None:
+            return int(percent)
+        return int(self.EXPORT_PROGRESS + percent * (100 - self.EXPORT_PROGRESS) / 100)